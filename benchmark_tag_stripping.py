@@ -0,0 +1,33 @@
+''' Times the one-pass HTML tag stripper of query_cqadupstack.py against the slow way (an HTMLParser, or a replace per tag), on the answer bodies of a subforum, and checks that both give the same results.
+    Usage: python benchmark_tag_stripping.py subforum.zip '''
+
+import sys, time, itertools
+import query_cqadupstack as qcqa
+
+
+def benchmark(o, answerids=None):
+    ''' Takes a Subforum and a list of answer ids as input (default: all answers) and removes the HTML tags from their bodies,
+        both the way strip_tags() does it and the way perform_cleaning() does it, with the one-pass tag stripper and the slow way.
+        Returns a dictionary with the number of seconds each took ('strip_tags' and 'remove_tags', each a tuple of the new and the old time), and a list of the ids of the answers for which the results differ ('different'). '''
+    if answerids is None:
+        answerids = o.answerdict.keys()
+    bodies = [o.get_answerbody(a) for a in answerids]
+    results = {'different': set()}
+    for name, keep_code in (('strip_tags', False), ('remove_tags', True)):
+        start = time.time()
+        new = [qcqa._strip_tags(b, keep_code) for b in bodies]
+        middle = time.time()
+        old = [qcqa._strip_tags_one_by_one(b, keep_code) for b in bodies]
+        results[name] = (middle - start, time.time() - middle)
+        results['different'].update(a for a, n, o in itertools.izip(answerids, new, old) if n != o)
+    results['different'] = sorted(results['different'])
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv[1:]) != 1:
+        sys.exit(__doc__)
+    results = benchmark(qcqa.load_subforum(sys.argv[1]))
+    for name in ('strip_tags', 'remove_tags'):
+        print '%s: %.2f seconds in one pass, %.2f seconds the slow way' % ((name,) + results[name])
+    print 'Answers with different results:', len(results['different'])
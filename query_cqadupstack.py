@@ -18,22 +18,118 @@
 import os, re, sys
 import nltk, json, codecs
 import pydoc, math
-import zipfile, random, datetime
-import itertools
+import zipfile, random, datetime, time
+import itertools, marshal, hashlib, tempfile, collections, multiprocessing, array, heapq, mmap, zlib
+import numpy as np
 from operator import truediv
 from scipy.misc import comb
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from random import randrange
 from HTMLParser import HTMLParser
+from xml.sax.saxutils import escape
+try:
+    import fcntl
+except ImportError: # Not available on Windows. The cleaned text cache is then not locked while it is written to.
+    fcntl = None
 
 # Written by Doris Hoogeveen Nov 2015. For a usage please call the script without arguments.
 
-def load_subforum(subforumzipped):
-    ''' Takes a subforum.zip file as input and returns a StackExchange Subforum class object.'''
-    return Subforum(subforumzipped)
+# Version of the on-disk snapshot format. Increase this whenever the layout of the snapshots changes, so old snapshots are ignored and rewritten.
+SNAPSHOT_VERSION = 3
+
+# Version of the cleaned text cache format. Increase this whenever the layout of the cache or the output of the cleaning changes, so old cleaned texts are thrown away.
+CLEANED_CACHE_VERSION = 1
+
+# Version of the file format of TermStatistics.save().
+TERM_STATISTICS_VERSION = 1
+
+# Version of the file format of BM25Index.save().
+BM25_INDEX_VERSION = 2
+
+# Tables that are loaded on first use, by attribute name.
+_LAZY_TABLES = {'answerdict': 'answers', 'commentdict': 'comments', 'userdict': 'users'}
+
+# The table of each type of entity, and for the fields that contain ids, the type of entity they point to.
+_ENTITY_TABLES = {'post': 'postdict', 'answer': 'answerdict', 'comment': 'commentdict', 'user': 'userdict'}
+_ID_FIELDS = {'post': {'userid': 'user', 'acceptedanswer': 'answer', 'answers': 'answer', 'comments': 'comment', 'dups': 'post', 'related': 'post'},
+              'answer': {'parentid': 'post', 'userid': 'user', 'comments': 'comment'},
+              'comment': {'userid': 'user'},
+              'user': {'questions': 'post', 'answers': 'answer'}}
+_SINGLE_ID_FIELDS = ('userid', 'acceptedanswer', 'parentid') # The other fields in _ID_FIELDS contain lists of ids.
+
+# The texts that clean_many() can clean: field -> (type of entity, method that returns the text).
+_TEXT_FIELDS = {'title': ('post', 'get_posttitle'), 'body': ('post', 'get_postbody'), 'title_and_body': ('post', 'get_post_title_and_body'),
+                'answer': ('answer', 'get_answerbody'), 'comment': ('comment', 'get_commentbody')}
+_EXPORT_FORMATS = ('jsonl', 'trec') # See export_cleaned_corpus().
+_BM25_FIELDS = ('title', 'body', 'answers') # The fields of the documents in a BM25Index.
+
+# Dates are stored as the number of milliseconds since 1970-01-01. _NO_DATE (the same as NumPy's NaT) stands for a date of 0, which means there is none.
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+_MS_PER_DAY = 86400000
+_NO_DATE = np.iinfo(np.int64).min
+
+def _parse_date(value):
+    ''' Takes a date in %Y-%m-%dT%H:%M:%S.%f format, or 0, as input and returns it as the number of milliseconds since 1970-01-01, or _NO_DATE. '''
+    if value == 0:
+        return _NO_DATE
+    return _to_timestamp(datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f"))
+
+_Chronology = collections.namedtuple('_Chronology', ['ordered', 'positions', 'bytime', 'timestamps', 'days'])
+
+def _to_timestamp(date):
+    ''' Takes a date as a string in YYYY-MM-DD or %Y-%m-%dT%H:%M:%S.%f format, a datetime.date or datetime.datetime object, or a number of seconds since 1970-01-01 as input,
+        and returns it as the number of milliseconds since 1970-01-01. '''
+    if isinstance(date, basestring):
+        if len(date) == 10:
+            date = datetime.datetime.strptime(date, '%Y-%m-%d')
+        else:
+            return _parse_date(date)
+    if isinstance(date, datetime.datetime):
+        delta = date - _EPOCH
+        return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+    if isinstance(date, datetime.date):
+        return (date.toordinal() - _EPOCH_ORDINAL) * _MS_PER_DAY
+    return int(round(date * 1000))
+
+def _to_datetime(timestamp):
+    return _EPOCH + datetime.timedelta(milliseconds=int(timestamp))
+
+def _to_date(timestamp):
+    return datetime.date.fromordinal(_EPOCH_ORDINAL + int(timestamp) // _MS_PER_DAY)
+
+def _format_date(timestamp):
+    ''' Takes a number of milliseconds since 1970-01-01 as input and returns the date in YYYY-MM-DD format. '''
+    d = _to_date(timestamp)
+    return '%d-%02d-%02d' % (d.year, d.month, d.day)
+
+def _format_time(timestamp):
+    ''' Takes a number of milliseconds since 1970-01-01 as input and returns the time in HH:MM:SS format. '''
+    seconds = int(timestamp) // 1000 % 86400
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def _seconds(timestamp):
+    if timestamp == _NO_DATE:
+        return 0
+    return int(timestamp) // 1000
+
+def load_subforum(subforumzipped, **kwargs):
+    ''' Takes a subforum.zip file as input and returns a StackExchange Subforum class object.
+        Any optional keyword arguments are passed on to Subforum (see there). '''
+    return Subforum(subforumzipped, **kwargs)
 
 class Subforum():
-    def __init__(self, zipped_catfile):
-	''' This class takes a StackExchange subforum.zip file as input and makes it queryable via the methods below. '''
+    def __init__(self, zipped_catfile, use_snapshot=True, cachedir=None, extract=True, preload=False, cache_cleaning=True):
+	''' This class takes a StackExchange subforum.zip file as input and makes it queryable via the methods below.
+	    OPTIONAL ARGUMENTS:
+	    use_snapshot: after the json files have been parsed once, a binary snapshot of each of them is written to cachedir, and used instead of the json files the next time the subforum is loaded.
+	                  Snapshots are ignored and rewritten when the zip file changes. (Values: True or False. Default: True)
+	    cachedir: the directory in which snapshots are stored. Default: the directory of the zip file, or, if extract is False, none, in which case no snapshots and no cache of cleaned texts are written.
+	    extract: if True, the zip file is unzipped next to itself (if that has not been done before) and the json files are read from there.
+	             If False, the json files are read straight from the zip file and nothing is written to the directory of the zip file, so it can be on a read-only or network file system. (Values: True or False. Default: True)
+	    preload: if True, the answers, comments and users are loaded straight away. If False, they are only loaded when they are first needed, which saves time and memory if you only use the questions. (Values: True or False. Default: False)
+	    cache_cleaning: if True, the texts cleaned by clean_many() and get_cleaned_text() are stored in a cache file in cachedir, and read from there the next time they are needed with the same cleaning options, also by other processes and in later runs. (Values: True or False. Default: True) '''
 	# Check to see if supplied file exists and is a valid zip file.
 	if not os.path.exists(zipped_catfile):
 	    sys.exit('The supplied zipfile does not exist. Please supply a valid StackExchange subforum.zip file.')
@@ -41,7 +137,16 @@ class Subforum():
 	    sys.exit('Please supply a valid StackExchange subforum.zip file.')
 
 	self.cat = os.path.basename(zipped_catfile).split('.')[0]
-	self._unzip_and_load(zipped_catfile)	
+	self._zipped_catfile = zipped_catfile
+	self._use_snapshot = use_snapshot
+	self._extract = extract
+	if cachedir is None and extract:
+	    cachedir = os.path.dirname(zipped_catfile)
+	self.cachedir = cachedir
+	self._checksum = None
+	self._cache_cleaning = cache_cleaning
+	self._cleaned_cache = None # Made by _cleaned_text_cache() when it is first needed.
+	self._unzip_and_load(zipped_catfile, preload)	
 
 	# Stopwords for cleaning. They need to be initialised here in case someone accesses self.stopwords.
 
@@ -56,35 +161,119 @@ class Subforum():
 	    self.__nltk_stopwords = []
 
 	self.__stopwords = self.__middle_stopwords # Default.
+	self._cleaners = {} # Cleaners used by perform_cleaning(), by their options. Emptied when the stop word list changes.
+	self._stemmer = Stemmer() # Shared by all Cleaners of this subforum.
+	self._tokenizer = 'nltk' # Used for removing stop words and stemming. See change_tokenizer().
+	self._timer = None # The CleaningTimer of the Cleaners, if cleaning is timed. See enable_cleaning_timer().
 	self.cutoffdate = False # Needed for classification splits.
+        self._chronology = None # Made by _chronological_index() when it is first needed.
+        self._graph = None # Made by _duplicate_graph() when it is first needed.
+        self._inverted = {} # (entity, field) -> _InvertedIndex, made by _inverted_index() when first needed.
 
 
-    def _unzip_and_load(self, zipped_catfile):
-	ziplocation = os.path.dirname(zipped_catfile)
-	cat = os.path.basename(zipped_catfile).split('.')[0]
-	questionfile = ziplocation + '/' + cat + '/' + cat + '_questions.json'
-	answerfile = ziplocation + '/' + cat + '/' + cat + '_answers.json'
-	commentfile = ziplocation + '/' + cat + '/' + cat + '_comments.json'
-	userfile = ziplocation + '/' + cat + '/' + cat + '_users.json'
-	if os.path.exists(questionfile) and os.path.exists(answerfile) and os.path.exists(userfile) and os.path.exists(commentfile):
-	    pass # All good, we don't need to unzip anything
-	else:
-	    zip_ref = zipfile.ZipFile(zipped_catfile, 'r')
-	    zip_ref.extractall(ziplocation)
-
-	qf = codecs.open(questionfile, 'r', encoding='utf-8')
-        self.postdict = json.load(qf)
-
-	af = codecs.open(answerfile, 'r', encoding='utf-8')
-        self.answerdict = json.load(af)
-
-        cf = codecs.open(commentfile, 'r', encoding='utf-8')
-        self.commentdict = json.load(cf)
-
-	uf = codecs.open(userfile, 'r', encoding='utf-8')
-        self.userdict = json.load(uf)
-
-        print "Loaded all data from", zipped_catfile
+    def _unzip_and_load(self, zipped_catfile, preload=False):
+        self.postdict = self._load_table('questions')
+        if preload:
+            for attribute in _LAZY_TABLES:
+                getattr(self, attribute)
+            print "Loaded all data from", zipped_catfile
+        else:
+            print "Loaded questions from", zipped_catfile
+
+    def __getattr__(self, name):
+        ''' Loads the answers, comments and users the first time self.answerdict, self.commentdict or self.userdict is used.
+            After that they are normal attributes, so this is only called once for each of them. '''
+        if name in _LAZY_TABLES:
+            table = self._load_table(_LAZY_TABLES[name])
+            setattr(self, name, table)
+            return table
+        raise AttributeError(name)
+
+    def _load_table(self, table):
+        ''' Takes the name of one of the json files in the zip file ('questions', 'answers', 'comments' or 'users') as input and returns its contents as a CompactTable, which can be used like a dictionary.
+            If there is a valid snapshot of the file it is read from there. If not, the json file is parsed and a snapshot is written for next time. '''
+        use_snapshot = self._use_snapshot and self.cachedir is not None
+        if use_snapshot:
+            snapshotfile = os.path.join(self.cachedir, self.cat + '_' + table + '.snapshot')
+            state = self._read_snapshot(snapshotfile)
+            if state is not None:
+                return CompactTable.from_state(state)
+
+        jf = self._open_json_file(table)
+        try:
+            compacttable = CompactTable(_iter_json_items(jf))
+        finally:
+            jf.close()
+        if use_snapshot:
+            self._write_snapshot(snapshotfile, compacttable.state())
+        return compacttable
+
+    def _open_json_file(self, table):
+        ''' Takes the name of one of the json files in the zip file as input and returns a file object from which its contents can be read as unicode.
+            If the zip file has been unzipped before, the unzipped file is opened. Otherwise the zip file is unzipped first, or, if the subforum was loaded with extract=False, the file is streamed straight out of the zip file. '''
+        ziplocation = os.path.dirname(self._zipped_catfile)
+        jsonfile = ziplocation + '/' + self.cat + '/' + self.cat + '_' + table + '.json'
+        if os.path.exists(jsonfile):
+            return codecs.open(jsonfile, 'r', encoding='utf-8')
+        zip_ref = zipfile.ZipFile(self._zipped_catfile, 'r')
+        if self._extract:
+            zip_ref.extractall(ziplocation)
+            zip_ref.close()
+            return codecs.open(jsonfile, 'r', encoding='utf-8')
+        return _ZipMemberReader(zip_ref, self.cat + '/' + self.cat + '_' + table + '.json')
+
+    def _snapshot_header(self):
+        ''' Takes no input and returns the first line of a valid snapshot file for this subforum.
+            It contains the snapshot format version, the marshal version and Python version (marshal data is not portable between them), and a checksum of the zip file. '''
+        return 'CQADupStack snapshot %d %d %d.%d %s\n' % (SNAPSHOT_VERSION, marshal.version, sys.version_info[0], sys.version_info[1], self._zip_checksum())
+
+    def _zip_checksum(self):
+        ''' Takes no input and returns a checksum of the contents of the zip file, as a string of hexadecimal digits. '''
+        if self._checksum is None:
+            # The central directory of the zip file contains a CRC for every file in it, so we can checksum the contents without reading (or unzipping) the whole zip file.
+            md5 = hashlib.md5()
+            zip_ref = zipfile.ZipFile(self._zipped_catfile, 'r')
+            for info in sorted(zip_ref.infolist(), key=lambda x: x.filename):
+                md5.update(repr((info.filename, info.CRC, info.file_size)))
+            zip_ref.close()
+            self._checksum = md5.hexdigest()
+        return self._checksum
+
+    def _read_snapshot(self, snapshotfile):
+        ''' Takes the name of a snapshot file as input and returns the data stored in it, or None if the file does not exist, is outdated or is damaged. '''
+        try:
+            sf = open(snapshotfile, 'rb')
+        except IOError:
+            return None
+        try:
+            if sf.readline() != self._snapshot_header():
+                return None
+            return marshal.load(sf) # Reads the rest of the file in one go.
+        except (EOFError, ValueError, TypeError):
+            return None
+        finally:
+            sf.close()
+
+    def _write_snapshot(self, snapshotfile, data):
+        ''' Takes the name of a snapshot file and the data to be stored in it as input and writes the snapshot.
+            The snapshot is written to a temporary file first and then renamed, so other processes never see a half written snapshot.
+            Failing to write a snapshot (for instance because the directory is read-only) is not an error: the data will simply be parsed again next time. '''
+        try:
+            fd, tmpname = tempfile.mkstemp(prefix='.' + os.path.basename(snapshotfile), dir=os.path.dirname(snapshotfile) or '.')
+        except (IOError, OSError):
+            return
+        try:
+            sf = os.fdopen(fd, 'wb')
+            sf.write(self._snapshot_header())
+            marshal.dump(data, sf, marshal.version)
+            sf.close()
+            os.chmod(tmpname, 0644)
+            os.rename(tmpname, snapshotfile)
+        except (IOError, OSError):
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
 
     def tokenize(self, s):
         ''' Takes a string as input, tokenizes it using NLTK (http://www.nltk.org) and returns a list of the tokens. '''
@@ -103,6 +292,20 @@ class Subforum():
                 dups.append(p)
         return dups
 
+    def get_posts_with_tag(self, tag):
+        ''' Takes a tag as input and returns a list of all posts that have that tag. '''
+        return self.get_strids(self._inverted_index('post', 'tags').get(tag))
+
+    def get_posts_with_any_tags(self, tags):
+        ''' Takes a list of tags as input and returns a list of all posts that have at least one of them. '''
+        index = self._inverted_index('post', 'tags')
+        return self.get_strids(np.unique(np.concatenate([index.rows[:0]] + [index.get(tag) for tag in tags])))
+
+    def get_posts_with_all_tags(self, tags):
+        ''' Takes a list of tags as input and returns a list of all posts that have all of them. '''
+        index = self._inverted_index('post', 'tags')
+        return self.get_strids(reduce(np.intersect1d, [index.get(tag) for tag in tags], self.get_all_intids()))
+
     def get_all_duplicate_pairs(self):
         ''' Takes no input an returns a list of duplicate question pairs as tuples of ids. '''
         duppairs = []
@@ -164,14 +367,55 @@ class Subforum():
         return dups, related, nodups
 
     def get_older_posts(self, postid):
-        ''' Takes a post id as input and returns a list of question ids that are older than the input post id. '''
-        allordered = [i[0] for i in self.get_ordered_list_of_posts()]
-        postindex = allordered.index(postid)
-        return allordered[postindex:]
+        ''' Takes a post id as input and returns a list of question ids that are older than the input post id, starting with the input post id itself, ordered from newest to oldest post.
+            This is the part of get_ordered_list_of_posts() that starts at the input post id. '''
+        chronology = self._chronological_index()
+        return self.get_strids(chronology.ordered[chronology.positions[self.postdict.intid(postid)]:])
+
+    def get_newer_posts(self, postid):
+        ''' Takes a post id as input and returns a list of question ids that are more recent than the input post id, ordered from newest to oldest post.
+            This is the part of get_ordered_list_of_posts() that comes before the input post id, so together with get_older_posts() it contains all posts. '''
+        chronology = self._chronological_index()
+        return self.get_strids(chronology.ordered[:chronology.positions[self.postdict.intid(postid)]])
+
+    def get_posts_between(self, startdate, enddate):
+        ''' Takes two dates as input and returns a list of question ids that were posted on or after the first date and before the second one, ordered from newest to oldest post.
+            The dates can be strings in YYYY-MM-DD or %Y-%m-%dT%H:%M:%S.%f format, datetime.date or datetime.datetime objects, or numbers of seconds since 1970-01-01 (UTC). '''
+        chronology = self._chronological_index()
+        start = np.searchsorted(chronology.timestamps, _to_timestamp(startdate), 'left')
+        end = np.searchsorted(chronology.timestamps, _to_timestamp(enddate), 'left')
+        return self.get_strids(chronology.bytime[start:max(start, end)][::-1])
+
+    def get_most_recent_posts_before(self, date, k):
+        ''' Takes a date and a number k as input and returns a list of the k most recent question ids that were posted before that date, ordered from newest to oldest post.
+            The date can be any of the formats get_posts_between() accepts, e.g. the output of get_post_timestamp(). '''
+        chronology = self._chronological_index()
+        end = np.searchsorted(chronology.timestamps, _to_timestamp(date), 'left')
+        return self.get_strids(chronology.bytime[max(0, end - k):end][::-1])
+
+    def _chronological_index(self):
+        ''' Takes no input and returns the chronological index of the posts, which is made the first time it is needed.
+            ordered contains the integer ids of the posts in the order of get_ordered_list_of_posts() (newest to oldest, by day) and positions the position of each post in it.
+            bytime contains the integer ids ordered from oldest to newest post by their exact time, and timestamps the times of the posts in that order, so they can be searched with bisection. '''
+        if self._chronology is None:
+            timestamps = self.postdict.timestamps(self.get_all_intids(), 'creationdate')
+            days = timestamps // _MS_PER_DAY
+            # A stable sort, so that posts from the same day stay in the same order as in self.postdict, just like with sorted(..., reverse=True).
+            ordered = np.argsort(-days, kind='mergesort').astype(np.int32)
+            positions = np.empty(len(ordered), dtype=np.int32)
+            positions[ordered] = np.arange(len(ordered), dtype=np.int32)
+            bytime = np.argsort(timestamps, kind='mergesort').astype(np.int32)
+            self._chronology = _Chronology(ordered, positions, bytime, timestamps[bytime], days)
+        return self._chronology
 
     def get_ordered_list_of_posts(self):
         ''' Takes no input and returns a list of tuples (postid, datetime object), ordered chronologically from newest to oldest post. '''
-        return sorted([(i, datetime.datetime.strptime(self.get_postdate(i), '%Y-%m-%d')) for i in self.postdict], key=lambda x: x[1], reverse=True)
+        chronology = self._chronological_index()
+        ids = self.postdict.keys()
+        datetimes = {}
+        for day in np.unique(chronology.days):
+            datetimes[day] = datetime.datetime.fromordinal(_EPOCH_ORDINAL + int(day))
+        return [(ids[row], datetimes[chronology.days[row]]) for row in chronology.ordered]
 
     def get_random_postid(self):
         ''' Takes no input and returns a random post id. '''
@@ -185,8 +429,10 @@ class Subforum():
         allids = self.postdict.keys()
         id1 = random.choice(allids)
         id2 = random.choice(allids)
-        while id2 >= id1:
+        while id2 == id1:
             id2 = random.choice(allids)
+        if int(id2) > int(id1): # Compare the ids as numbers, not as strings.
+            id1, id2 = id2, id1
         if id2 in self.postdict[id1]['dups']:
             return (id1, id2, 'dup')
         elif id2 in self.postdict[id1]['related']:
@@ -200,6 +446,8 @@ class Subforum():
 
     def get_true_label(self, postid1, postid2):
 	''' Takes two postids as input and returns the true label, which is one of "dup", "nodup" or "related". '''
+        if postid1 in self.postdict and postid2 in self.postdict:
+            return self._duplicate_graph().label(self.postdict.intid(postid1), self.postdict.intid(postid2))
 	if postid1 in self.postdict[postid2]['dups']:
 	    return "dup"
 	elif postid1 in self.postdict[postid2]['related']:
@@ -211,6 +459,82 @@ class Subforum():
 	else:
 	    return "nodup"
 
+    ###########################
+    # DUPLICATE GRAPH METHODS #
+    ###########################
+
+    # Duplicate and related links are only stored in one of the two posts they link. The methods below use a graph of these links that works in both directions.
+    # The label argument of these methods is 'dup' (duplicate links only), 'related' (related links only) or 'both'.
+
+    def _duplicate_graph(self):
+        ''' Takes no input and returns the graph of duplicate and related links between the posts, which is made the first time it is needed. '''
+        if self._graph is None:
+            allintids = self.get_all_intids()
+            self._graph = _DuplicateGraph(len(allintids), self.get_linked_intid_lists(allintids, 'dups'), self.get_linked_intid_lists(allintids, 'related'))
+        return self._graph
+
+    def get_neighbours(self, postid, label='dup'):
+        ''' Takes a post id and optionally a label ('dup' (default), 'related' or 'both') as input and returns a list of ids of the posts it is linked to, in either direction. '''
+        return self.get_strids(self._duplicate_graph().neighbours(self.postdict.intid(postid), label))
+
+    def iter_neighbourhoods(self, label='dup'):
+        ''' Takes optionally a label ('dup' (default), 'related' or 'both') as input and iterates over tuples of a post id and a list of the ids of the posts it is linked to, for all posts that are linked to at least one other post. '''
+        graph = self._duplicate_graph()
+        ids = self.postdict.keys()
+        offsets, neighbours = graph.adjacency(label)
+        for row in np.flatnonzero(np.diff(offsets)):
+            yield ids[row], [ids[n] for n in neighbours[offsets[row]:offsets[row + 1]]]
+
+    def get_cluster_id(self, postid, label='dup'):
+        ''' Takes a post id and optionally a label ('dup' (default), 'related' or 'both') as input and returns the id of its cluster: the group of posts that are linked to it directly or indirectly.
+            Posts that are not linked to any other post have a cluster of their own. '''
+        return int(self._duplicate_graph().clusters(label)[self.postdict.intid(postid)])
+
+    def get_cluster(self, postid, label='dup'):
+        ''' Takes a post id and optionally a label ('dup' (default), 'related' or 'both') as input and returns a list of the ids of all posts in its cluster, including itself. '''
+        graph = self._duplicate_graph()
+        return self.get_strids(graph.members(label, graph.clusters(label)[self.postdict.intid(postid)]))
+
+    def get_clusters(self, label='dup', min_size=2):
+        ''' Takes optionally a label ('dup' (default), 'related' or 'both') and a minimum size (default 2) as input and returns a list of clusters (lists of post ids) that contain at least min_size posts. '''
+        graph = self._duplicate_graph()
+        offsets, posts = graph.cluster_index(label)
+        return [self.get_strids(posts[offsets[c]:offsets[c + 1]]) for c in np.flatnonzero(np.diff(offsets) >= min_size)]
+
+    def in_same_cluster(self, postid1, postid2, label='dup'):
+        ''' Takes two post ids and optionally a label ('dup' (default), 'related' or 'both') as input and returns True if they are in the same cluster, so if they are duplicates of each other directly or via other posts, and False otherwise. '''
+        clusters = self._duplicate_graph().clusters(label)
+        return clusters[self.postdict.intid(postid1)] == clusters[self.postdict.intid(postid2)]
+
+    def get_negative_samples(self, postid, k, label='both'):
+        ''' Takes a post id, a number k and optionally a label ('dup', 'related' or 'both' (default)) as input and returns a list of k different random post ids that are not in the cluster of the input post id.
+            With the default label these are posts that are not a duplicate or related question of the input post id, not even indirectly. If there are fewer than k such posts, all of them are returned. '''
+        graph = self._duplicate_graph()
+        clusters = graph.clusters(label)
+        cluster = clusters[self.postdict.intid(postid)]
+        candidates = graph.size - len(graph.members(label, cluster))
+        if 2 * k >= candidates:
+            picked = random.sample(np.flatnonzero(clusters != cluster), min(k, candidates))
+        else:
+            # Most posts are not in the cluster, so picking random posts and skipping the ones that are is quicker than listing all candidates.
+            picked = set()
+            while len(picked) < k:
+                row = random.randrange(graph.size)
+                if clusters[row] != cluster:
+                    picked.add(row)
+            picked = list(picked)
+        return self.get_strids(picked)
+
+    def get_adjacency(self, label='dup'):
+        ''' Takes optionally a label ('dup' (default), 'related' or 'both') as input and returns the graph as two NumPy arrays of integer ids, offsets and neighbours,
+            such that neighbours[offsets[i]:offsets[i+1]] are the posts that the post with integer id i is linked to. '''
+        return self._duplicate_graph().adjacency(label)
+
+    def get_cluster_ids(self, label='dup'):
+        ''' Takes optionally a label ('dup' (default), 'related' or 'both') as input and returns a NumPy array with the cluster id of each post, by integer id. '''
+        return self._duplicate_graph().clusters(label)
+
+
     ###########################
     # PARTICULAR POST METHODS #
     ###########################
@@ -231,13 +555,15 @@ class Subforum():
 
     def get_postdate(self, postid):
 	''' Takes a post id as input and returns the date the post was posted in YYYY-MM-DD format. '''
-	cdate = datetime.datetime.strptime(self.postdict[postid]['creationdate'], "%Y-%m-%dT%H:%M:%S.%f")
-	return str(cdate.year) + '-' + cdate.strftime('%m') + '-' + cdate.strftime('%d')
+        return _format_date(self.postdict.timestamp(postid, 'creationdate'))
 
     def get_posttime(self, postid):
 	''' Takes a post id as input and returns the time the post was posted in HH:MM:SS format. '''
-	cdate = datetime.datetime.strptime(self.postdict[postid]['creationdate'], "%Y-%m-%dT%H:%M:%S.%f")
-        return cdate.strftime('%H') + ':' + cdate.strftime('%M') + ':' + cdate.strftime('%S')
+        return _format_time(self.postdict.timestamp(postid, 'creationdate'))
+
+    def get_post_timestamp(self, postid):
+        ''' Takes a post id as input and returns the time the post was posted as the number of seconds since 1970-01-01 (UTC). '''
+        return _seconds(self.postdict.timestamp(postid, 'creationdate'))
 
     def get_postviewcount(self, postid):
 	''' Takes a post id as input and returns the number of times the post has been looked at by users. '''
@@ -290,10 +616,8 @@ class Subforum():
         dupdates = []
         for dup in dups:
             checkdates = self.postdict[postid]['dups'][dup]['votedates']
-            for c in checkdates:
-                cdate = datetime.datetime.strptime(c, "%Y-%m-%dT%H:%M:%S.%f")
-                dupdates.append(c)
-        dupdates.sort()
+            dupdates.extend(checkdates)
+        dupdates.sort() # The dates all have the same format, so sorting them as strings sorts them chronologically.
         #print dupdates
         if len(dupdates) > 0:
             return dupdates[0]
@@ -334,11 +658,15 @@ class Subforum():
 
     def get_acceptedanswer_date(self, answerid):
         ''' Takes an answer id as input and returns the date at which it was selected as the best answer in YYYY-MM-DD format, if it exists. Else it returns 0. '''
-        if self.answerdict[answerid]['acceptedanswerdate'] == 0:
+        timestamp = self.answerdict.timestamp(answerid, 'acceptedanswerdate')
+        if timestamp == _NO_DATE:
             return 0
         else:
-            adate = datetime.datetime.strptime(self.answerdict[answerid]['acceptedanswerdate'], "%Y-%m-%dT%H:%M:%S.%f")
-            return str(adate.year) + '-' + adate.strftime('%m') + '-' + adate.strftime('%d')
+            return _format_date(timestamp)
+
+    def get_acceptedanswer_timestamp(self, answerid):
+        ''' Takes an answer id as input and returns the time at which it was selected as the best answer as the number of seconds since 1970-01-01 (UTC), if it exists. Else it returns 0. '''
+        return _seconds(self.answerdict.timestamp(answerid, 'acceptedanswerdate'))
 
     def get_answerbody(self, answerid):
 	''' Takes an answer id as input and returns the body of the answer. That is the text of the answer. '''
@@ -346,13 +674,15 @@ class Subforum():
 
     def get_answerdate(self, answerid):
         ''' Takes an answer id as input and returns the date the answer was posted in YYYY-MM-DD format. '''
-        cdate = datetime.datetime.strptime(self.answerdict[answerid]['creationdate'], "%Y-%m-%dT%H:%M:%S.%f")
-        return str(cdate.year) + '-' + cdate.strftime('%m') + '-' + cdate.strftime('%d')
+        return _format_date(self.answerdict.timestamp(answerid, 'creationdate'))
 
     def get_answertime(self, answerid):
         ''' Takes an answer id as input and returns the time the answer was posted in HH:MM:SS format. '''
-        cdate = datetime.datetime.strptime(self.answerdict[answerid]['creationdate'], "%Y-%m-%dT%H:%M:%S.%f")
-        return cdate.strftime('%H') + ':' + cdate.strftime('%M') + ':' + cdate.strftime('%S')
+        return _format_time(self.answerdict.timestamp(answerid, 'creationdate'))
+
+    def get_answer_timestamp(self, answerid):
+        ''' Takes an answer id as input and returns the time the answer was posted as the number of seconds since 1970-01-01 (UTC). '''
+        return _seconds(self.answerdict.timestamp(answerid, 'creationdate'))
 
     def get_answerscore(self, answerid):
 	''' Takes an answer id as input and returns an integer representing the score of the answer. This is the number of upvotes minus the number of downvotes is has received. ''' 
@@ -396,13 +726,15 @@ class Subforum():
 
     def get_commentdate(self, commentid):
 	''' Takes a comment id as input and returns the date the comment was posted, in YYYY-MM-DD format. '''
-	cdate = datetime.datetime.strptime(self.commentdict[commentid]['creationdate'], "%Y-%m-%dT%H:%M:%S.%f")
-        return str(cdate.year) + '-' + cdate.strftime('%m') + '-' + cdate.strftime('%d')
+        return _format_date(self.commentdict.timestamp(commentid, 'creationdate'))
 
     def get_commenttime(self, commentid):
  	''' Takes a comment id as input and returns the time the comment was posted, in HH:MM:SS format. '''
-        cdate = datetime.datetime.strptime(self.commentdict[commentid]['creationdate'], "%Y-%m-%dT%H:%M:%S.%f")
-        return cdate.strftime('%H') + ':' + cdate.strftime('%M') + ':' + cdate.strftime('%S')
+        return _format_time(self.commentdict.timestamp(commentid, 'creationdate'))
+
+    def get_comment_timestamp(self, commentid):
+        ''' Takes a comment id as input and returns the time the comment was posted as the number of seconds since 1970-01-01 (UTC). '''
+        return _seconds(self.commentdict.timestamp(commentid, 'creationdate'))
 
     def get_commentscore(self, commentid):
 	''' Takes a comment id as input and returns an integer representing the score of the comment. This is the number of upvotes minus the number of downvotes is has received. '''
@@ -412,6 +744,14 @@ class Subforum():
 	''' Takes a comment id as input and returns the id of the user that posted the comment. '''
 	return self.commentdict[commentid]['userid']
 
+    def get_thread(self, postid):
+        ''' Takes a post id as input and returns two lists: one with the ids of its answers and one with the ids of all comments in the thread, so both the comments on the post and the ones on its answers. '''
+        answers = self._inverted_index('answer', 'parentid').get(postid)
+        comments = self._inverted_index('comment', 'parentid')
+        answerids = self.get_strids(answers, 'answer')
+        threadcomments = np.unique(np.concatenate([comments.get(postid)] + [comments.get(answerid) for answerid in answerids]))
+        return answerids, self.get_strids(threadcomments, 'comment')
+
     ################
     # USER METHODS #
     ################
@@ -439,13 +779,19 @@ class Subforum():
 
     def get_user_joindate(self, userid):
 	''' Takes a user id as input and outputs the date this user joined this subforum, in YYYY-MM-DD format. '''
-	cdate = datetime.datetime.strptime(self.userdict[userid]['date_joined'], "%Y-%m-%dT%H:%M:%S.%f")
-        return str(cdate.year) + '-' + cdate.strftime('%m') + '-' + cdate.strftime('%d')
+        return _format_date(self.userdict.timestamp(userid, 'date_joined'))
 	
     def get_user_lastaccess(self, userid):
 	''' Takes a user id as input and outputs the last time this user has logged into this subforum, in YYYY-MM-DD format. '''
-	cdate = datetime.datetime.strptime(self.userdict[userid]['lastaccessdate'], "%Y-%m-%dT%H:%M:%S.%f")
-        return str(cdate.year) + '-' + cdate.strftime('%m') + '-' + cdate.strftime('%d')
+        return _format_date(self.userdict.timestamp(userid, 'lastaccessdate'))
+
+    def get_user_joindate_timestamp(self, userid):
+        ''' Takes a user id as input and outputs the time this user joined this subforum as the number of seconds since 1970-01-01 (UTC). '''
+        return _seconds(self.userdict.timestamp(userid, 'date_joined'))
+
+    def get_user_lastaccess_timestamp(self, userid):
+        ''' Takes a user id as input and outputs the last time this user has logged into this subforum as the number of seconds since 1970-01-01 (UTC). '''
+        return _seconds(self.userdict.timestamp(userid, 'lastaccessdate'))
 
     def get_user_age(self, userid):
 	''' Takes a user id as input and outputs the user's age as an integer, if known. Else it returns 'unknown'. '''
@@ -462,12 +808,102 @@ class Subforum():
 	''' Takes a user id as input and returns a list of the answers he/she has written. '''
         return self.userdict[userid]['answers']
 
+    def get_user_comments(self, userid):
+        ''' Takes a user id as input and returns a list of the comments he/she has written. '''
+        return self.get_strids(self._inverted_index('comment', 'userid').get(userid), 'comment')
+
     def get_user_badges(self, userid):
 	''' Takes a user id as input and returns a list of the badges this user has earned. 
 	    Information on what badges are and which ones can be earned can be found here: http://stackoverflow.com/help/badges '''
 	return self.userdict[userid]['badges']
 
 
+    ###############
+    # INTEGER IDS #
+    ###############
+
+    # All ids in the data are strings. Each post, answer, comment and user also has an integer id, from 0 to the number of posts, answers, etc., which is convenient for NumPy arrays.
+    # The methods below convert between the two, and return ids stored in the data (user ids of posts, duplicates of posts, etc.) as integer ids in bulk.
+    # The entity argument of these methods is one of 'post', 'answer', 'comment' or 'user'.
+
+    def _entity_table(self, entity):
+        if entity not in _ENTITY_TABLES:
+            raise ValueError(repr(entity) + " is not a valid entity. Please choose 'post', 'answer', 'comment' or 'user'.")
+        return getattr(self, _ENTITY_TABLES[entity])
+
+    def get_intid(self, strid, entity='post'):
+        ''' Takes an id and optionally the type of entity it belongs to ('post' (default), 'answer', 'comment' or 'user') as input and returns its integer id. '''
+        return self._entity_table(entity).intid(strid)
+
+    def get_strid(self, intid, entity='post'):
+        ''' Takes an integer id and optionally the type of entity it belongs to ('post' (default), 'answer', 'comment' or 'user') as input and returns the normal (string) id. '''
+        return self._entity_table(entity).strid(intid)
+
+    def get_intids(self, strids, entity='post'):
+        ''' Takes a list of ids and optionally the type of entity they belong to ('post' (default), 'answer', 'comment' or 'user') as input and returns a NumPy array of their integer ids.
+            Unknown users (False) become -1. Other unknown ids raise a KeyError. '''
+        return self._entity_table(entity).intids(strids)
+
+    def get_strids(self, intids, entity='post'):
+        ''' Takes a list or array of integer ids and optionally the type of entity they belong to ('post' (default), 'answer', 'comment' or 'user') as input and returns a list of the normal (string) ids. -1 becomes False. '''
+        return self._entity_table(entity).strids(intids)
+
+    def get_all_intids(self, entity='post'):
+        ''' Takes optionally a type of entity ('post' (default), 'answer', 'comment' or 'user') as input and returns a NumPy array with all its integer ids, in the same order as get_all_postids() and get_all_users(). '''
+        return np.arange(len(self._entity_table(entity)), dtype=np.int32)
+
+    def get_linked_intids(self, intids, field, entity='post'):
+        ''' Takes an array of integer ids, the name of a field that contains one id ('userid' or 'acceptedanswer' for posts, 'parentid' or 'userid' for answers, 'userid' for comments) and optionally the type of entity ('post' (default), 'answer', 'comment' or 'user') as input.
+            Returns a NumPy array with the integer id stored in that field for each of the input ids, or -1 if there is none (e.g. if the user is not known).
+            Example: o.get_linked_intids(o.get_all_intids(), 'userid') returns the integer user ids of all posts. '''
+        target = self._id_field_target(field, entity)
+        return self._entity_table(entity).linked_intids(np.asarray(intids, dtype=np.int64), field, self._entity_table(target))
+
+    def get_linked_intid_lists(self, intids, field, entity='post'):
+        ''' Takes an array of integer ids, the name of a field that contains a list of ids ('answers', 'comments', 'dups' or 'related' for posts, 'comments' for answers, 'questions' or 'answers' for users) and optionally the type of entity ('post' (default), 'answer', 'comment' or 'user') as input.
+            Returns two NumPy arrays, offsets and linked, such that linked[offsets[i]:offsets[i+1]] are the integer ids stored in that field for the i-th input id.
+            Example: offsets, dups = o.get_linked_intid_lists(o.get_all_intids(), 'dups') gives the duplicates of all posts. '''
+        target = self._id_field_target(field, entity)
+        return self._entity_table(entity).linked_intid_lists(np.asarray(intids, dtype=np.int64), field, self._entity_table(target))
+
+    def get_timestamps(self, intids, field='creationdate', entity='post'):
+        ''' Takes an array of integer ids and optionally the name of a date field ('creationdate' (default), 'acceptedanswerdate' for answers, 'date_joined' or 'lastaccessdate' for users) and the type of entity ('post' (default), 'answer', 'comment' or 'user') as input.
+            Returns a NumPy array with the dates as the number of seconds since 1970-01-01 (UTC), or 0 if there is no date (e.g. answers that have not been accepted). '''
+        milliseconds = self._entity_table(entity).timestamps(np.asarray(intids, dtype=np.int64), field)
+        return np.where(milliseconds == _NO_DATE, 0, milliseconds // 1000)
+
+    def get_field_array(self, ids, field, entity='post', missing=-1):
+        ''' Takes a list of ids (or a NumPy array of integer ids), the name of a field and optionally the type of entity ('post' (default), 'answer', 'comment' or 'user') and a value for missing data as input.
+            Returns a NumPy array with the value of that field for each of the ids:
+            - numbers (like 'score', 'viewcount', 'favoritecount', 'rep', 'views' or 'age') are returned as they are;
+            - dates (like 'creationdate' or 'date_joined') as the number of seconds since 1970-01-01 (UTC);
+            - lists (like 'answers', 'comments', 'dups', 'tags' or 'badges') as their length, so 'answers' gives the answer count of posts;
+            - single ids ('userid', 'acceptedanswer' of posts and 'parentid' of answers) as the integer id of the user, answer or post they refer to.
+            Records that do not have the field (like users without an age), unknown users (False), answers that were never accepted, etc. get the missing value (default -1).
+            Use missing=np.nan to get an array of floats with NaN for missing values. Fields that contain text raise a ValueError.
+            Example: o.get_field_array(o.get_all_postids(), 'score') returns the scores of all posts. '''
+        table = self._entity_table(entity)
+        if isinstance(ids, np.ndarray) and ids.dtype.kind in 'iu':
+            rows = ids.astype(np.int64)
+        else:
+            rows = table.intids(list(ids)).astype(np.int64)
+        if field in _SINGLE_ID_FIELDS and field in _ID_FIELDS[entity]:
+            linked = table.linked_intids(rows, field, self._entity_table(_ID_FIELDS[entity][field]))
+            return np.where(linked >= 0, linked, missing)
+        return table.field_array(rows, field, missing)
+
+    def _inverted_index(self, entity, field):
+        ''' Takes the type of entity and a field as input and returns an index from the values of that field to the integer ids of the records that have them, which is made the first time it is needed. '''
+        if (entity, field) not in self._inverted:
+            self._inverted[(entity, field)] = self._entity_table(entity).inverted_index(field)
+        return self._inverted[(entity, field)]
+
+    def _id_field_target(self, field, entity):
+        if field not in _ID_FIELDS.get(entity, {}):
+            raise ValueError(repr(field) + ' is not a field with ids of ' + repr(entity) + 's.')
+        return _ID_FIELDS[entity][field]
+
+
     ####################
     # Cleaning methods #
     ####################
@@ -477,10 +913,21 @@ class Subforum():
         ''' Returns the current list of words that is used as the stop word list. It can be accessed via self.stopwords'''
         return self.__stopwords
 
+    @property
+    def stemmer(self):
+        ''' Returns the Stemmer that is used for cleaning with stem=True. It can be accessed via self.stemmer, for instance to see how often its memo was used (self.stemmer.hits and self.stemmer.misses) or to fill it with self.stemmer.warm(filename). '''
+        return self._stemmer
+
+    @property
+    def cleaning_timer(self):
+        ''' Returns the CleaningTimer that times the stages of cleaning, or None if cleaning is not timed. See enable_cleaning_timer(). '''
+        return self._timer
+
     def supply_stopwords(self, filename):
 	''' Takes as input a plain text file encoded in UTF-8 with one stop word per line and saves these internally in a stop word list.
 	    This list will be used in cleaning if perform_cleaning() is called with remove_stopwords=True. '''
 	self.__stopwords = []
+	self._cleaners = {}
 	inputf_open = codecs.open(filename, 'r', encoding='utf-8')
 	inputf = inputf_open.readlines()
 	inputf_open.close()
@@ -497,6 +944,7 @@ class Subforum():
 	    To be able to use the NLTK stopwords, they need to be downloaded first. See: http://www.nltk.org/data.html for more info.
 	    If the data is not downloaded first, the script will default to the NLTK stopword list of November 2015.
 	'''
+	self._cleaners = {}
 	if stopwordset == 'nltk':
 	    if self.__nltk_stopwords != []:
                 self.__stopwords = self.__nltk_stopwords
@@ -509,6 +957,47 @@ class Subforum():
 	else:
 	    self.__stopwords = self.__middle_stopwords # DEFAULT
 
+    def change_tokenizer(self, tokenizer='nltk'):
+        ''' Changes the way strings are split into words when stop words are removed or words are stemmed during cleaning: 'nltk' (the default) or 'regex'.
+            'nltk' tokenizes with the NLTK tokenizer and glues back together the words that it splits differently from a plain split on whitespace.
+            'regex' splits on whitespace straight away, and removes stop words and stems in the same pass, which is a lot quicker.
+            The two are NOT interchangeable. 'regex' gives the same result for most strings (see test_query_cqadupstack.py), but not for:
+            - strings with double quotes, which the NLTK tokenizer turns into `` and '', after which 'nltk' glues the following words together ('said "hello" to the server' becomes 'said ``hello``totheserver'), while 'regex' keeps the quotes as separate words;
+            - strings in which 'cannot' occurs more than once: 'nltk' only turns the first one into 'can not' (the first two if words are also stemmed), 'regex' all of them.
+            Texts cleaned with one tokenizer should therefore not be compared with, or searched in an index of, texts cleaned with the other. The cleaned text cache keeps them apart.
+            compare_tokenizers() shows for which posts the two differ. '''
+        if tokenizer not in _TOKENIZERS:
+            raise ValueError(repr(tokenizer) + " is not a valid tokenizer. Please choose 'nltk' or 'regex'.")
+        self._tokenizer = tokenizer
+        self._cleaners = {}
+
+    def enable_cleaning_timer(self, slowest=10):
+        ''' Starts timing each stage of cleaning, for perform_cleaning(), clean_many() (also in its other processes) and the Cleaners of get_cleaner(). Texts read from the cache are not cleaned, and so not timed.
+            Returns a new CleaningTimer, which can also be accessed via self.cleaning_timer. Its summary() gives the number of calls and the total, mean, percentile and maximum time of each stage,
+            and the ids and lengths of the slowest texts (slowest is how many of them are kept). to_json(filename) writes this to a file. '''
+        self._timer = CleaningTimer(slowest)
+        self._cleaners = {}
+        return self._timer
+
+    def disable_cleaning_timer(self):
+        ''' Stops timing the stages of cleaning. Cleaning is not timed by default, which costs next to nothing. '''
+        self._timer = None
+        self._cleaners = {}
+
+    def compare_tokenizers(self, ids, field='title_and_body', maxcodelength=150, remove_stopwords=True, remove_punct=False, stem=True):
+        ''' Takes a list of ids as input, cleans their texts with both tokenizers (see change_tokenizer()) and returns a list of the ids for which the results differ.
+            The optional arguments are those of clean_many(). The cache is not used. '''
+        if field not in _TEXT_FIELDS:
+            raise ValueError(repr(field) + " is not a valid field. Please choose 'title', 'body', 'title_and_body', 'answer' or 'comment'.")
+        gettext = getattr(self, _TEXT_FIELDS[field][1])
+        cleaners = [Cleaner(maxcodelength, remove_stopwords, remove_punct, stem, self.__stopwords, self._stemmer, tokenizer) for tokenizer in _TOKENIZERS]
+        different = []
+        for i in ids:
+            s = gettext(i)
+            if cleaners[0].clean(s) != cleaners[1].clean(s):
+                different.append(i)
+        return different
+
     def perform_cleaning(self, s, maxcodelength=150, remove_stopwords=False, remove_punct=False, stem=False):
 	''' Takes a string as input and returns a cleaned version.
 	    - The string will be lowercased and newlines removed.
@@ -526,60 +1015,124 @@ class Subforum():
 	    remove_punct: punctuation is removed, except for punctuation in URLs and numbers. (Values: True or False)
 	    stem: stemming is performed via the Porter stemmer as implemented in the NLTK (http://www.nltk.org/). (Values: True or False)
 	'''
-	s, codes = self._deal_with_code(s,maxcodelength)
-        s = s.lower()
-        s = re.sub('\n', ' ', s)
-        s = self._remove_tags(s)
-        s = self._expand_contractions(s)
-        s = self._general_cleaning(s,codes,remove_punct)
-        if remove_stopwords:
-            s = self._remove_stopwords(s)
-        if stem:
-            s = self._stem(s)
-	s = self._fix_exceptions(s)
+	# The work is done by a Cleaner, which is kept for the next call with the same options.
+	options = (maxcodelength, remove_stopwords, remove_punct, stem)
+	if options not in self._cleaners:
+	    self._cleaners[options] = self.get_cleaner(*options)
+	s = self._cleaners[options].clean(s)
 
 	# TODO: consider removing dashes between hyphenated words (far-off -> faroff), and removing full stops in acronyms/initials (U.N. -> UN). It helps for METEOR apparently (http://www.cs.cmu.edu/~alavie/METEOR/pdf/meteor-wmt11.pdf). U.S.-based will become US based.
 
 	return s
 
 
-    def _fix_exceptions(self, s):
-	''' Takes a string as input, applies a bunch of regexes to it to fix exceptions that have accidentally been changed, and returns the new string. '''
-	s = re.sub(' \. net ', ' .net', s)
-	s = re.sub(' i \. e ', ' i.e. ', s)
-	# fix extensions
-	s = re.sub(' \. jpeg ', '.jpeg ', s)
-	s = re.sub(' \. jpg ', '.jpg ', s)
-	return s
-
-    def _deal_with_code(self, s, maxcodelength):
-	''' Takes a string as input, finds all code blocks in it and replace them with HHHH to protect them from whitespace addition, lower casing etc. Then returns the new string and a list of the code blocks so we can replace them after more cleaning. '''
-        codepat = re.compile(r'<code>[^<]+</code>')
-        codes = re.findall(codepat, s) # re.M for multiline matching not necessary?
-        n = 0
-        newcodes = []
-        for c in codes:
-	    if len(c) < maxcodelength + 13: # two code tags are 13 characters
-		s = re.sub(re.escape(c), 'HHHH' + str(n), s)
-               
-		# Remove brackets if other half is missing. Else we'll have problems when we try to put them back. 
-		if re.search(r'\)', c) and not re.search(r'\(', c):
-                    c = re.sub(r'\)', '', c)
-                if re.search(r'\(', c) and not re.search(r'\)', c):
-                    c = re.sub(r'\(', '', c)
-
-		c = re.sub(r'\n', ' ', c, re.M) # remove real newlines
-		c = re.sub(r'\\n', r'\\\\n', c) # keep and escape \n in things like latex's \newcommand{}.
-		c = re.sub(r'\s+', ' ', c)
-		c = re.sub(r'<code>', '', c)
-		c = re.sub(r'</code>', '', c)
-                newcodes.append(c)
-                n += 1
-	    else:
-		s = re.sub(re.escape(c), '', s) # Remove large code blocks
-
-	return s, newcodes
-
+    def get_cleaner(self, maxcodelength=150, remove_stopwords=False, remove_punct=False, stem=False):
+        ''' Takes the same optional arguments as perform_cleaning() as input and returns a Cleaner object that cleans strings with those options, using the current stop word list.
+            cleaner.clean(s) gives exactly the same result as perform_cleaning(s, ...), but all the regular expressions it uses are compiled only once. '''
+        return Cleaner(maxcodelength, remove_stopwords, remove_punct, stem, self.__stopwords, self._stemmer, self._tokenizer, self._timer)
+
+    def clean_many(self, ids, field='title_and_body', processes=None, chunksize=50, maxcodelength=150, remove_stopwords=False, remove_punct=False, stem=False):
+        ''' Takes a list of ids as input and cleans the text of each of them with perform_cleaning(), spread over several processes.
+            Returns an iterator over the cleaned texts, in the same order as the ids. They are returned as soon as they are ready, and no more than 4 chunks per process are cleaned ahead of the texts that have been used, so they don't all need to fit in memory.
+            Example: for postid, cleaned in itertools.izip(postids, o.clean_many(postids, processes=8)): ...
+            OPTIONAL ARGUMENTS:
+            field: the text to clean: 'title', 'body' or 'title_and_body' (default) of posts, or 'answer' or 'comment' for the bodies of answers or comments (in which case ids should be answer or comment ids).
+            processes: the number of processes to use. Default: the number of CPUs. With 1 process, everything is done in this process.
+            chunksize: the number of texts that is sent to a process at a time. Default: 50.
+            maxcodelength, remove_stopwords, remove_punct and stem: see perform_cleaning().
+            Unless the subforum was loaded with cache_cleaning=False, the cleaned texts are stored in a cache file in cachedir, and only the texts that are not in there yet are cleaned. '''
+        if field not in _TEXT_FIELDS:
+            raise ValueError(repr(field) + " is not a valid field. Please choose 'title', 'body', 'title_and_body', 'answer' or 'comment'.")
+        return self._clean_items(((field, i) for i in ids), [field], processes, chunksize, (maxcodelength, remove_stopwords, remove_punct, stem))
+
+    def get_cleaned_text(self, id, field='title_and_body', maxcodelength=150, remove_stopwords=False, remove_punct=False, stem=False):
+        ''' Takes an id as input and returns its cleaned text, like clean_many() does for a list of ids (see there for the optional arguments).
+            The text is only cleaned if it is not in the cache yet. '''
+        return next(self.clean_many([id], field, 1, 1, maxcodelength, remove_stopwords, remove_punct, stem))
+
+    def get_term_statistics(self, ids=None, field='title_and_body', processes=None, chunksize=50, maxcodelength=150, remove_stopwords=False, remove_punct=False, stem=False):
+        ''' Takes a list of ids as input (default: all ids of the field) and returns a TermStatistics object with the vocabulary, document frequencies, collection frequencies and document lengths of their cleaned texts.
+            The texts are cleaned with clean_many() (see there for the optional arguments) and counted in one pass while they come in, so they never all need to be in memory.
+            The statistics can be saved with save(filename) and read back with TermStatistics.load(filename), and statistics of other subforums (made with the same field and options) can be added with merge(). '''
+        if field not in _TEXT_FIELDS:
+            raise ValueError(repr(field) + " is not a valid field. Please choose 'title', 'body', 'title_and_body', 'answer' or 'comment'.")
+        if ids is None:
+            ids = self._entity_table(_TEXT_FIELDS[field][0]).keys()
+        else:
+            ids = list(ids)
+        options = (maxcodelength, remove_stopwords, remove_punct, stem)
+        stats = TermStatistics(field, self._cleaning_key(options))
+        stats.add_documents(itertools.izip(ids, self.clean_many(ids, field, processes, chunksize, *options)), self.cat)
+        return stats
+
+    def _clean_items(self, items, fields, processes, chunksize, options):
+        ''' Like clean_many(), but takes (field, id) tuples as input, so that texts of different kinds are cleaned by one pool of processes, in the order in which they are needed.
+            fields are the fields that occur in the items. options is a tuple of the cleaning options. '''
+        for field in fields:
+            self._entity_table(_TEXT_FIELDS[field][0]) # Load the answers or comments now if they haven't been yet, before the processes of the pool are forked.
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        cache = self._cleaned_text_cache()
+        if cache is None or not cache.refresh():
+            return self._clean_texts(items, processes, chunksize, options)
+        return self._clean_with_cache(items, processes, chunksize, options, cache)
+
+    def _clean_texts(self, items, processes, chunksize, options):
+        ''' Cleans the texts of the (field, id) items without looking at the cache, and returns an iterator over the results. '''
+        gettext = lambda field, i: getattr(self, _TEXT_FIELDS[field][1])(i)
+        if processes <= 1:
+            cleaner = self.get_cleaner(*options)
+            return (cleaner.clean(gettext(field, i), i) for field, i in items)
+        if self._timer is not None:
+            return _clean_in_pool(((i, gettext(field, i)) for field, i in items), processes, chunksize, options, self.__stopwords, self._stemmer, self._tokenizer, self._timer)
+        return _clean_in_pool((gettext(field, i) for field, i in items), processes, chunksize, options, self.__stopwords, self._stemmer, self._tokenizer)
+
+    def _clean_with_cache(self, items, processes, chunksize, options, cache):
+        ''' Like _clean_texts(), but the texts that are in the cache are read from there, and the others are cleaned and added to it. '''
+        key = self._cleaning_key(options)
+        items = list(items)
+        missing = [] # The items that need to be cleaned, in the order in which they are needed, without duplicates.
+        uses = collections.Counter() # How often each of them is needed.
+        for item in items:
+            if item in uses:
+                uses[item] += 1
+            elif (key,) + item not in cache:
+                missing.append(item)
+                uses[item] = 1
+        cleaned = self._clean_texts(missing, processes, chunksize, options)
+        fresh = {} # Texts cleaned here that are needed again. They are not read back from the cache, in case adding them to it failed.
+        for item in items:
+            if item not in uses:
+                s = cache.get((key,) + item)
+            else:
+                if item in fresh:
+                    s = fresh[item]
+                else:
+                    s = next(cleaned)
+                    cache.add((key,) + item, s)
+                uses[item] -= 1
+                if uses[item]:
+                    fresh[item] = s
+                else:
+                    fresh.pop(item, None)
+            yield s
+
+    def _cleaning_key(self, options):
+        ''' Takes a tuple of cleaning options as input and returns a hash of them that identifies their cleaned texts in the cache.
+            The stop word list is part of it if stop words are removed, and the tokenizer if it is not the default one and stop words are removed or words are stemmed. '''
+        key = options
+        if options[1]: # remove_stopwords
+            key = (options, list(self.__stopwords))
+        if self._tokenizer != 'nltk' and (options[1] or options[3]): # remove_stopwords or stem
+            key = (key, self._tokenizer)
+        return hashlib.md5(repr(key)).hexdigest()
+
+    def _cleaned_text_cache(self):
+        ''' Takes no input and returns the _CleanedTextCache of this subforum, or None if cache_cleaning is False or there is no cachedir. '''
+        if self._cache_cleaning and self.cachedir is not None and self._cleaned_cache is None:
+            cachefile = os.path.join(self.cachedir, self.cat + '_cleaned.cache')
+            self._cleaned_cache = _CleanedTextCache(cachefile, 'CQADupStack cleaned text cache %d %s\n' % (CLEANED_CACHE_VERSION, self._zip_checksum()))
+        return self._cleaned_cache
 
     def very_basic_cleaning(self, s):
         s = self.url_cleaning(s)
@@ -599,319 +1152,10 @@ class Subforum():
 
         return s
 
-    def strip_tags(self, html): # Source: http://stackoverflow.com/questions/753052/strip-html-from-strings-in-python
-        s = MLStripper()
-        s.feed(html)
-        return s.get_data()
+    def strip_tags(self, html):
+        ''' Takes a string as input and returns it without HTML tags and HTML entities. '''
+        return _strip_tags(html)
 
-    def _remove_stopwords(self, s):
-	''' Takes a string as input, removes the stop words in the current stop word list, and returns the result.
-	    The current stop word list can be accessed via self.stopwords, or altered by calling supply_stopwords(). '''
-
-	words = nltk.word_tokenize(s) # The NLTK tokenizer cuts things like 'cannot' into 'can' and 'not'.
-	words_split = s.split()
-	if 'cannot' in words_split: # which we'd like to keep.
-	    location = words_split.index('cannot')
-	    words_split[location] = 'can'
-	    words_split.insert(location + 1, 'not')
-	counter = 0
-
-	filteredwords = []
-	prevw_in_split = True
-	for w in words:
-	    # It used to be so beautifully simple, until I found out NLTK sometimes splits things wrongly.
-	    #if w in self.__stopwords:
-            #    pass # skip it, we don't want it.
-            #else:
-            #    filteredwords.append(w)
-
-	    if words_split[counter] == w: # word was correctly split
-		if w not in self.__stopwords:
-		    filteredwords.append(w)
-		counter += 1
-		prevw_in_split = True
-	    elif prevw_in_split: # previous word was fine, but this is the first part of a wrongly split word.
-		filteredwords.append(w)
-		prevw_in_split = False
-	    else: # this is a subsequent part of a wrongly split word
-		newword = filteredwords[-1] + w
-		filteredwords[-1] = newword
-		if words_split[counter] == newword:
-		    counter += 1
-		    prevw_in_split = True
-		else:
-		    prevw_in_split = False
-	cleanstring = ' '.join(filteredwords)
-	cleanstring = self._fix_abbreviations(cleanstring)
-	return cleanstring
-
-
-    def _stem(self, s):
-	''' Takes a string as input and applies the Porter stemmer as implemented in the NLTK (http://www.nltk.org/). Returns the result. '''
-	words = nltk.word_tokenize(s)
-
-	words_split = s.split()
-        if 'cannot' in words_split:
-            location = words_split.index('cannot')
-            words_split[location] = 'can'
-            words_split.insert(location + 1, 'not')
-        counter = 0
-
-	newwords = []
-        prevw_in_split = True
-	for w in words:
-	    # It used to be so beautiful and simple, until I found out that NLTK splits some things wrongly...
-	    #neww = nltk.PorterStemmer().stem_word(w)
-	    #newwords.append(neww)
-
-	    if words_split[counter] == w: # word was correctly split
-		neww = nltk.PorterStemmer().stem_word(w)
-                newwords.append(neww)
-                counter += 1
-                prevw_in_split = True
-            elif prevw_in_split: # previous word was fine, but this is the first part of a wrongly split word.
-                newwords.append(w)
-                prevw_in_split = False
-            else: # this is a subsequent part of a wrongly split word
-                newword = newwords[-1] + w
-                if words_split[counter] == newword:
-		    newwords[-1] = nltk.PorterStemmer().stem_word(newword)
-                    counter += 1
-                    prevw_in_split = True
-                else:
-		    newwords[-1] = newword
-                    prevw_in_split = False
-
-
-	news = ' '.join(newwords)
-	news = self._fix_abbreviations(news)
-	return news
-
-    def _fix_abbreviations(self, s):
-	''' Takes as input a string tokenized by nltk and joined again, and outputs a version in which the abbreviations have been fixed.
-	    That means the final dot has been glued to the abbreviation once more.'''
-	if re.search(r' ([a-z]\.[a-z])+ \.', s):
-            found = re.search(r'( ([a-z]\.[a-z])+ \.)', s)
-            abbr = found.group(1)
-            newabbr = re.sub(' ', '', abbr)
-            s = re.sub(abbr, ' ' + newabbr, s)
-	return s
-
-    def _remove_tags(self, s):
-	''' Takes a string as input and removes HTML tags, except for code tags, which are remove in general_cleaning.
-	    Also removes mentions of possible duplicates and changes URLs that point to other StackExchange threads into 'stackexahcnge-url'. '''
-
-	s = re.sub(r"<blockquote.+possible duplicate.+/blockquote>", " ", s)
-	s = re.sub(r"<a href=\"https?://[a-z]+\.stackexchange\.com[^\"]+\">([^<]+)</a>", r"\1", s)
-	s = re.sub(r"<a href=\"[^\"]+\">([^<]+)</a>", r"\1", s)
-
-	# Put some space between tags and urls or other things. So we don't accidentally remove more than we should a few lines further below this line.
-	s = re.sub(r"<", " <", s)
-	s = re.sub(r">", "> ", s)
-
-	s = re.sub(r"https?://([a-z]+\.)?stackexchange\.com[^ ]+", "stackexchange-url", s)
-	s = re.sub(r"https?://stackoverflow\.com[^ ]+", "stackexchange-url", s)
-
-	# Remove all tags except for code tags
-	alltags = re.findall(r'(</?)([^>]+)(>)', s) # list of tuples
-	for tag in alltags:
-	    if tag[1] != u'code':
-                codetag = tag[0] + tag[1] + tag[2]
-		s = re.sub(re.escape(codetag), '', s)
-	return s
-
-
-    def _expand_contractions(self, s):
-	''' Takes a string as input, expands the contracted forms in it and returns the result. '''
-
-	# Source: http://www.englishcoursemalta.com/learn/list-of-contracted-forms-in-english/
-	c = {'i\'m': 'i am', 
-	    'you\'re': 'you are',
-	    'he\'s': 'he is',
-	    'she\'s': 'she is',
-	    'we\'re': 'we are',
-	    'it\'s': 'it is',
-	    'isn\'t': 'is not',
-	    'aren\'t': 'are not',
-	    'they\'re': 'they are',
-	    'there\'s': 'there is',
-	    'wasn\'t': 'was not',
-	    'weren\'t': ' were not',
-	    'i\'ve': 'i have',
-	    'you\'ve': 'you have',
-	    'we\'ve': 'we have',
-	    'they\'ve': 'they have',
-	    'hasn\'t': 'has not',
-	    'haven\'t': 'have not',
-	    'you\'d': 'you had',
-	    'he\'d': 'he had',
-	    'she\'d': 'she had',
-	    'we\'d': 'we had',
-	    'they\'d': 'they had',
-	    'doesn\'t': 'does not',
-	    'don\'t': 'do not',
-	    'didn\'t': 'did not',
-	    'i\'ll': 'i will',
-	    'you\'ll': 'you will',
-	    'he\'ll': 'he will',
-	    'she\'ll': 'she will',
-	    'we\'ll': 'we will',
-	    'they\'ll': 'they will',
-	    'there\'ll': 'there will',
-	    'i\'d': 'i would',
-	    'it\'d': 'it would',
-	    'there\'d': 'there had',
-	    'there\'d': 'there would',
-	    'can\'t': 'can not',
-	    'couldn\'t': 'could not',
-	    'daren\'t': 'dare not',
-	    'hadn\'t': 'had not',
-	    'mightn\'t': 'might not',
-	    'mustn\'t': 'must not',
-	    'needn\'t': 'need not',
-	    'oughtn\'t': 'ought not',
-	    'shan\'t': 'shall not',
-	    'shouldn\'t': 'should not',
-	    'usedn\'t': 'used not',
-	    'won\'t': 'will not',
-	    'wouldn\'t': 'would not',
-	    'what\'s': 'what is',
-	    'that\'s': 'that is',
-	    'who\'s': 'who is',}
-	# Some forms of 's could either mean 'is' or 'has' but we've made a choice here.
-	# Some forms of 'd could either mean 'had' or 'would' but we've made a choice here.
-	# Some forms of 'll could wither mean 'will' or 'shall' but we've made a choice here.
-	for pat in c:
-	    s = re.sub(pat, c[pat], s)
-	return s
-
-
-    def _general_cleaning(self, s, codes, remove_punct=False):
-	''' Takes a string as input and False or True for the argument 'remove_punct'.
-	    Depending on the value of 'remove_punct', all punctuation is either removed, or a space is added before and after.
-	    In both cases the punctuation un URLs and numbers is retained. 
-	    
-	    Also transforms "&amp;" into "and", and removes all other HTML entities.
-	    Removes excessive white space. '''
-
-	# Find all URLs and replace them with GGGG to protect them from whitespace addition.
-	urlpat = re.compile(r'https?://[^ ]+')
-	wwwpat = re.compile(r'www\.[^ ]+')
-	compat = re.compile(r'[^ ]+\.com[^ ]+')
-	coms = re.findall(compat, s)
-	wwws = re.findall(wwwpat, s)
-	urls = re.findall(urlpat, s)
-	urls += wwws + coms
-	n = 0
-	newurls = []
-	for url in set(urls):
-	    if re.search(r'\)', url) and not re.search('\(', url):
-		url = re.sub(r'\).*$', '', url)
-	    if re.search(r'\\', url): # Get rid of backslashes because else we get regex problems when trying to put the URLs back.
-		url = re.sub(r'\\', '/', url)
-	    s = re.sub(re.escape(url), 'GGGG' + str(n), s)
-	    newurls.append(url)
-	    n += 1
-
-	# Protect points, commas and colon in numbers
-	while re.search(r'([0-9])\.([0-9])', s):
-	    s = re.sub(r'([0-9])\.([0-9])', r'\1BBB\2', s)
-	while re.search(r'([0-9]),([0-9])', s):
-            s = re.sub(r'([0-9]),([0-9])', r'\1CCC\2', s)
-	while re.search(r'([0-9]):([0-9])', s):
-            s = re.sub(r'([0-9]):([0-9])', r'\1DDD\2', s)
-
-	s = re.sub(r'&amp;', ' and ', s)
-
-	if remove_punct:
-	    # Remove all sorts of punctuation
-	    #s = re.sub('[^a-zA-Z0-9_-]', ' ', s) # Too agressive!
-	    p = re.compile(r'( [a-z] \.)( [a-z] \.)+')
-	    l = p.finditer(s)
-	    if l:
-                for m in l:
-                    newbit = re.sub(r' ', '', m.group()) # Get rid of white space in abbreviations
-		    newabbr = re.sub(r'\.', 'PPPP', newbit) # change dots in abbreviations into 'PPPP'
-                    s = re.sub(m.group() + ' +', ' ' + newabbr + ' ', s) # protect abbreviations
-		    s = re.sub(r'\.', '', s) # remove all points that are not in abbreviations
-		    s = re.sub(newabbr, newbit, s) # place dots back in abbreviations
-	    else:
-		s = re.sub(r'\.', ' ', s)
-            s = re.sub(r',', ' ', s)
-            s = re.sub(r'\?', ' ', s)
-            s = re.sub(r'!', ' ', s)
-            s = re.sub(r' \'([a-z])', r'  \1', s)
-            s = re.sub(r'([a-z])\' ', r'\1 ', s)
-            s = re.sub(r' \"([a-z])', r' \1', s)
-            s = re.sub(r'([a-z])\" ', r'\1 ', s)
-            s = re.sub(r'\(', ' ', s)
-            s = re.sub(r'\)', ' ', s)
-            s = re.sub(r'\[', ' ', s)
-            s = re.sub(r'\]', ' ', s)
-            s = re.sub(r'([a-z]): ', r'\1 ', s)
-            s = re.sub(r';', ' ', s)
-	    s = re.sub(r" - ", " ", s)
-            s = re.sub(r"- ", " ", s)
-            s = re.sub("`", "", s)
-            s = re.sub('“', '', s)
-            s = re.sub('”', '', s)
-            s = re.sub('"', '', s)
-	else:
-	    # Add space around all sorts of punctuation.
-	    #s = re.sub('([^a-zA-Z0-9_-])', r' \1 ', s) # Too agressive!
-	    s = re.sub(r'\.', ' . ', s)
-
-	    # Remove space around abbreviations
-	    p = re.compile(r'( [a-z] \.)( [a-z] \.)+')
-	    for m in p.finditer(s):
-    		#print m.start(), '###' + m.group() + '###'
-		#print s[m.start() - 20: m.start() + 20]
-		newbit = re.sub(' ', '', m.group())
-		s = re.sub(m.group() + ' +', ' ' + newbit + ' ', s)
-		#print s[m.start() - 20: m.start() + 20]
-
-	    s = re.sub(r',', ' , ', s)
-	    s = re.sub(r'\?', ' ? ', s)
-	    s = re.sub(r'!', ' ! ', s)
-	    s = re.sub(r' \'([a-z])', r" ' \1", s)
-	    s = re.sub(r'([a-z])\' ', r"\1 ' ", s)
-	    s = re.sub(r' \"([a-z])', r' " \1', s)
-            s = re.sub(r'([a-z])\" ', r'\1 " ', s)
-	    s = re.sub(r'\(', ' ( ', s)
-	    s = re.sub(r'\)', ' ) ', s)
-	    s = re.sub(r'\[', ' [ ', s)
-            s = re.sub(r'\]', ' ] ', s)
-	    s = re.sub(r'([a-z]): ', r'\1 : ', s)
-	    s = re.sub(r';', ' ; ', s)
-	    s = re.sub(r"'s", " 's", s)
-
-
-	# Restore points, commas and colons in numbers
-	while re.search(r'([0-9])BBB([0-9])', s):
-	    s = re.sub(r'([0-9])BBB([0-9])', r'\1.\2', s)
-        while re.search(r'([0-9])CCC([0-9])', s):
-            s = re.sub(r'([0-9])CCC([0-9])', r'\1,\2', s)
-        while re.search(r'([0-9])DDD([0-9])', s):
-            s = re.sub(r'([0-9])DDD([0-9])', r'\1:\2', s)
-
-	# restore URLs
-	newurllist = itertools.izip(reversed(xrange(len(newurls))), reversed(newurls)) # reverse list to GGGG1 does not match GGG10. (Source: http://galvanist.com/post/53478841501/python-reverse-enumerate)
-	for i, u in newurllist:
-	    s = re.sub('GGGG' + str(i), u, s) # Escaping u here leads to backslashes in URLs.
-
-	# Get rid of things we don't want, like HTML entities.
-	s = re.sub(r"&[a-z]+;", "", s)
-	s = re.sub(r"&#?[a-z]+;", "", s) # &#xA; == '\n'
-	# Remove excessive whitespace
-	s = re.sub(r"\s+", " ", s)
-	s = re.sub(r"^\s", "", s)
-	s = re.sub(r"\s$", "", s)
-
-        # restore codeblocks
-	newlist = itertools.izip(reversed(xrange(len(codes))), reversed(codes)) # reverse list to hhhh1 does not match hhhh10 (Source: http://galvanist.com/post/53478841501/python-reverse-enumerate)
-	for i, c in newlist:
-            s = re.sub('hhhh' + str(i), c.encode('unicode-escape'), s) # Escaping here leads to backslashes being added in the code blocks.
-	return s
 
 
     #################
@@ -1050,12 +1294,10 @@ class Subforum():
 
 	# Generate duplicate pairs
 	for postid in postswithdups:
-	    y, m, d = self.get_postdate(postid).split('-')
-	    d = datetime.date(int(y), int(m), int(d))
+	    d = _to_date(self.postdict.timestamp(postid, 'creationdate'))
 	    dups = self.get_duplicates(postid)
 	    for dup in dups:
-		y2, m2, d2 = self.get_postdate(dup).split('-')
-		d2 = datetime.date(int(y2), int(m2), int(d2))
+		d2 = _to_date(self.postdict.timestamp(dup, 'creationdate'))
 		duppairs.append((d, d2))
 
 	duppairs = sorted(duppairs)
@@ -1063,18 +1305,18 @@ class Subforum():
 	datelist = []
 
 	# Calculate the number of duplicate pairs in the test set, train set and the ones we lose, based on different cutoff dates
+	# A pair is in the train set if its first post is older than the cutoff date, and in the test set if both posts are at least as recent as the cutoff date.
+	# Counting them with binary searches in the sorted dates avoids comparing every pair with every cutoff date.
+	firstdays = np.array([pair[0].toordinal() for pair in duppairs], dtype=np.int64)
+	bothdays = np.sort(np.array([min(pair).toordinal() for pair in duppairs], dtype=np.int64))
 	for pair in duppairs:
 	    thresdate = pair[0] # This is the cutoff date
+	    if thresdate in t:
+		continue
 	    datelist.append(thresdate)
-	    t[thresdate] = {'test': 0, 'train': 0, 'lost': 0}
-	    for combo in duppairs:
-		if combo[0] >= thresdate:
-		    if combo[1] >= thresdate:
-			t[thresdate]['test'] += 1
-		    else:
-			t[thresdate]['lost'] += 1
-		else:
-		    t[thresdate]['train'] += 1
+	    train = int(np.searchsorted(firstdays, thresdate.toordinal(), 'left')) # firstdays is sorted, because duppairs is.
+	    test = len(duppairs) - int(np.searchsorted(bothdays, thresdate.toordinal(), 'left'))
+	    t[thresdate] = {'test': test, 'train': train, 'lost': len(duppairs) - train - test}
 
 	datelist = sorted(list(set(datelist)))
 
@@ -1163,6 +1405,275 @@ class Subforum():
 	#print "Nr of dups in develset:", len(develdups)
 	return testids, develids, toindex
 
+    ##################
+    # Export methods #
+    ##################
+
+    def iter_cleaned_documents(self, ids=None, answers=False, comments=False, processes=None, chunksize=50, maxcodelength=150, remove_stopwords=False, remove_punct=False, stem=False):
+        ''' Takes a list of post ids as input (default: all posts), for instance the toindex list of split_for_retrieval(), and returns an iterator over (id, cleaned text, metadata) tuples, one per post, in the same order.
+            The texts are cleaned with clean_many() (see there for the other optional arguments) while the iterator is used, so the cleaned corpus never needs to fit in memory.
+            The text is the cleaned title and body. With answers=True, the cleaned bodies of the answers are added to it, and with comments=True the cleaned comments on the post and, if answers are added, on its answers.
+            The metadata is a dictionary with the date, tags and score of the post, and the ids of the answers and comments that were added ('answers' and 'comments'). '''
+        if ids is None:
+            ids = self.get_all_postids()
+        elif not isinstance(ids, list):
+            ids = list(ids) # The ids are gone through twice: for cleaning and for putting the documents together.
+        # All texts go through one stream, in the order in which they are put together, so cleaning never gets far ahead of the documents that are returned.
+        fields = ['title_and_body'] + ['answer'] * answers + ['comment'] * comments
+        items = (item for postid in ids for item in self._document_items(postid, answers, comments))
+        cleaned = self._clean_items(items, fields, processes, chunksize, (maxcodelength, remove_stopwords, remove_punct, stem))
+        for postid in ids:
+            texts = [next(cleaned)]
+            answerids = []
+            commentids = []
+            if answers:
+                answerids = self.get_answers(postid)
+                texts.extend(next(cleaned) for a in answerids)
+            if comments:
+                commentids = self._inlined_comments(postid, answers)
+                texts.extend(next(cleaned) for c in commentids)
+            metadata = {'date': self.get_postdate(postid), 'tags': self.get_posttags(postid), 'score': self.get_postscore(postid), 'answers': answerids, 'comments': commentids}
+            yield postid, ' '.join(t for t in texts if t), metadata
+
+    def _document_items(self, postid, answers, comments):
+        ''' Takes a post id as input and returns the (field, id) items of the texts of its document in iter_cleaned_documents(). '''
+        items = [('title_and_body', postid)]
+        if answers:
+            items.extend(('answer', a) for a in self.get_answers(postid))
+        if comments:
+            items.extend(('comment', c) for c in self._inlined_comments(postid, answers))
+        return items
+
+    def _inlined_comments(self, postid, answers):
+        ''' Takes a post id as input and returns a list of the ids of its comments, followed by those of the comments on its answers if answers is True. '''
+        commentids = list(self.get_post_comments(postid))
+        if answers:
+            for answerid in self.get_answers(postid):
+                commentids.extend(self.get_answer_comments(answerid))
+        return commentids
+
+    def export_cleaned_corpus(self, outputdir='.', ids=None, format='jsonl', shardsize=67108864, answers=False, comments=False, processes=None, chunksize=50, maxcodelength=150, remove_stopwords=False, remove_punct=False, stem=False):
+        ''' Takes a directory as input and writes the documents of iter_cleaned_documents() to files in it (see there for the other optional arguments), one document after the other, so the cleaned corpus never needs to fit in memory.
+            Returns a list of the files that were written: subforum_corpus_00000.jsonl, subforum_corpus_00001.jsonl, etc.
+            OPTIONAL ARGUMENTS:
+            format: 'jsonl' (default) for one JSON object per line with the id, the text and the metadata, or 'trec' for <DOC> elements with a <DOCNO> and a <TEXT>, as read by Indri, Terrier, Anserini and the like. In 'trec' files, &, < and > in the texts are escaped as &amp;, &lt; and &gt;.
+            shardsize: the maximum number of bytes in a file. A new file is started when the next document does not fit in the current one anymore. Default: 64MB. '''
+        if format not in _EXPORT_FORMATS:
+            raise ValueError(repr(format) + " is not a valid format. Please choose 'jsonl' or 'trec'.")
+        documents = self.iter_cleaned_documents(ids, answers, comments, processes, chunksize, maxcodelength, remove_stopwords, remove_punct, stem)
+        shards = []
+        outputf = None
+        try:
+            for postid, text, metadata in documents:
+                if format == 'jsonl':
+                    record = collections.OrderedDict([('id', postid), ('text', text)])
+                    record.update(sorted(metadata.items()))
+                    document = json.dumps(record, ensure_ascii=False) + u'\n'
+                else:
+                    # Cleaned texts contain markup of their own: the <code> markers that cleaning leaves, and <, > and & from the code in the posts.
+                    document = u'<DOC>\n<DOCNO>' + escape(postid) + u'</DOCNO>\n<TEXT>\n' + escape(text) + u'\n</TEXT>\n</DOC>\n'
+                document = document.encode('utf-8')
+                if outputf is None or (size > 0 and size + len(document) > shardsize):
+                    if outputf is not None:
+                        outputf.close()
+                    shards.append(os.path.join(outputdir, self.cat + '_corpus_%05d.%s' % (len(shards), format)))
+                    outputf = open(shards[-1], 'wb', 1048576)
+                    size = 0
+                outputf.write(document)
+                size += len(document)
+        finally:
+            if outputf is not None:
+                outputf.close()
+        return shards
+
+    ######################
+    # Retrieval baseline #
+    ######################
+
+    def get_bm25_index(self, ids=None, answers=True, processes=None, chunksize=50, maxcodelength=150, remove_stopwords=False, remove_punct=False, stem=False):
+        ''' Takes a list of post ids as input (default: the ids to be indexed of split_for_retrieval()) and returns a BM25Index of their cleaned titles, bodies and, if answers is True, answers.
+            The texts are cleaned with clean_many(), see there for the other optional arguments. The queries of write_bm25_scorefile() are cleaned with the same options. '''
+        if ids is None:
+            ids = self.split_for_retrieval()[2]
+        else:
+            ids = list(ids)
+        options = (maxcodelength, remove_stopwords, remove_punct, stem)
+        # All texts go through one stream, in the order in which they are added to the index.
+        fields = ['title', 'body'] + ['answer'] * answers
+        items = (item for postid in ids for item in [('title', postid), ('body', postid)] + [('answer', a) for a in (self.get_answers(postid) if answers else [])])
+        cleaned = self._clean_items(items, fields, processes, chunksize, options)
+        def documents():
+            for postid in ids:
+                title = next(cleaned)
+                body = next(cleaned)
+                if answers:
+                    answertext = ' '.join(next(cleaned) for a in self.get_answers(postid))
+                else:
+                    answertext = ''
+                yield postid, [title, body, answertext]
+        index = BM25Index(options)
+        index.add_documents(documents())
+        index.finish()
+        return index
+
+    def write_bm25_scorefile(self, index, queryids, scorefile, k1=1.2, b=0.75, weights=None, cutoff=100, processes=None, chunksize=50):
+        ''' Takes a BM25Index (see get_bm25_index()), a list of query post ids (for instance the test or development ids of split_for_retrieval()) and the name of a file as input.
+            Ranks the documents in the index with BM25 for the cleaned title and body of each query, and writes one line per query to the file: the query id followed by the ids of the results, best first, separated by spaces.
+            This is the format the evaluation methods (like mean_average_precision()) read. A query is never returned as a result for itself.
+            OPTIONAL ARGUMENTS:
+            k1, b, weights and cutoff: see BM25Index.search(). weights is a dictionary with a weight for 'title', 'body' and/or 'answers'. Default: 1 for each.
+            processes and chunksize: for cleaning the queries, see clean_many(). '''
+        queryids = list(queryids)
+        queries = self.clean_many(queryids, 'title_and_body', processes, chunksize, *index.options)
+        outputf = open(scorefile, 'w')
+        for queryid, text in itertools.izip(queryids, queries):
+            results = index.search(text, k1, b, weights, cutoff, exclude=[queryid])[0]
+            outputf.write((u' '.join([queryid] + results) + u'\n').encode('utf-8'))
+        outputf.close()
+
+    def get_tfidf_matrix(self, processes=None, chunksize=50, maxcodelength=150, remove_stopwords=False, remove_punct=False, stem=False):
+        ''' Takes no input and returns a SciPy CSR matrix with a row for each post, in the order of the integer ids (see get_intid()), and a list of the terms of the columns.
+            Each row holds the TF-IDF weights of the terms in the cleaned title and body of the post (the number of times the term occurs, times the log of the number of posts divided by the number of posts that contain it), scaled to length 1, so the dot product of two rows is their cosine similarity.
+            The texts are cleaned with clean_many(), see there for the optional arguments. The terms and document frequencies are counted with a TermStatistics object (see get_term_statistics()).
+            Use get_tfidf_rankings() or write_tfidf_scorefile() to search with the matrix. '''
+        ids = self.get_all_postids()
+        options = (maxcodelength, remove_stopwords, remove_punct, stem)
+        stats = TermStatistics('title_and_body', self._cleaning_key(options))
+        columns = array.array('i')
+        stats.add_documents(itertools.izip(ids, self.clean_many(ids, 'title_and_body', processes, chunksize, *options)), self.cat, termids=columns)
+        columns = np.frombuffer(columns, dtype=np.int32)
+        rows = np.repeat(np.arange(len(stats), dtype=np.int32), stats.doclengths)
+        matrix = csr_matrix((np.ones(len(columns)), (rows, columns)), shape=(len(stats), len(stats.terms)))
+        matrix.sum_duplicates()
+        matrix.data *= np.log(truediv(len(stats), np.maximum(stats.df, 1)))[matrix.indices]
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        matrix.data /= np.repeat(np.where(norms > 0, norms, 1), np.diff(matrix.indptr))
+        return matrix, stats.terms
+
+    def get_tfidf_rankings(self, matrix, queryids, candidateids=None, cutoff=100, blocksize=256):
+        ''' Takes the matrix of get_tfidf_matrix(), a list of query post ids (for instance the test or development ids of split_for_retrieval()) and optionally a list of candidate post ids (default: the ids to be indexed of split_for_retrieval()) as input.
+            Returns an iterator over (query id, ids, scores) tuples, one per query, in the same order: the ids of the (at most cutoff) candidates with the highest cosine similarity to the query, best first, and a NumPy array with their similarities.
+            Candidates that have no terms in common with the query are left out, and a query is never returned as a result for itself.
+            The similarities are computed with one sparse matrix product per block of blocksize queries, which takes blocksize times the number of candidates floats of memory. '''
+        if candidateids is None:
+            candidateids = self.split_for_retrieval()[2]
+        candidateids = list(candidateids)
+        queryids = list(queryids)
+        candidaterows = self.get_intids(candidateids)
+        positions = np.empty(matrix.shape[0], dtype=np.int64) # The position of each post in candidateids, or -1.
+        positions.fill(-1)
+        positions[candidaterows] = np.arange(len(candidaterows))
+        candidates = matrix[candidaterows].T.tocsc()
+        queryrows = self.get_intids(queryids)
+        for start in xrange(0, len(queryids), blocksize):
+            block = queryrows[start:start + blocksize]
+            scores = (matrix[block] * candidates).toarray()
+            self_hits = np.flatnonzero(positions[block] >= 0)
+            scores[self_hits, positions[block][self_hits]] = 0
+            for queryid, results, resultscores in itertools.izip(queryids[start:start + blocksize], *_top_k_rows(scores, cutoff)):
+                yield queryid, [candidateids[i] for i in results], resultscores
+
+    def write_tfidf_scorefile(self, matrix, queryids, scorefile, candidateids=None, cutoff=100, blocksize=256):
+        ''' Takes the matrix of get_tfidf_matrix(), a list of query post ids and the name of a file as input, and writes the rankings of get_tfidf_rankings() (see there for the optional arguments) to the file, in the format of write_bm25_scorefile(). '''
+        outputf = open(scorefile, 'w')
+        for queryid, results, scores in self.get_tfidf_rankings(matrix, queryids, candidateids, cutoff, blocksize):
+            outputf.write((u' '.join([queryid] + results) + u'\n').encode('utf-8'))
+        outputf.close()
+
+    def rank_queries(self, scorer, queries, candidates, k=100, processes=None, chunksize=10, older=False, scorefile=None):
+        ''' Takes a function, a list of query post ids and a list of candidate post ids as input, and ranks the candidates for each query with the function.
+            scorer is called as scorer(subforum, queryid, candidateid) and should return a number: the higher, the better the candidate matches the query.
+            Returns an iterator over (query id, ids, scores) tuples, one per query, in the same order: the ids of the k candidates with the highest scores, best first (and in the order of candidates for equal scores), and their scores.
+            A query is never returned as a result for itself.
+            OPTIONAL ARGUMENTS:
+            processes: the number of processes to use. Default: the number of CPUs. The processes are forked from this one, so they share this subforum and scorer without copying them, and scorer may be any function, also one that is not defined at the top of a module.
+            chunksize: the number of queries that is sent to a process at a time. Default: 10.
+            older: if True, only the candidates that were posted before the query (to the millisecond) are ranked.
+            scorefile: if given, the rankings are written to this file in the format of write_bm25_scorefile() as soon as they are ready, instead of being returned.
+            Example: o.rank_queries(lambda o, q, c: len(set(o.get_posttags(q)) & set(o.get_posttags(c))), devel, toindex, 100, processes=8, scorefile='tags_devel.txt') '''
+        queries = list(queries)
+        candidates = list(candidates)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if older:
+            # Compare the dates in milliseconds, as they are stored, so posts from the same second are still told apart. Posts without a date get _NO_DATE, which is earlier than all dates.
+            table = self._entity_table('post')
+            candidatedates = table.timestamps(self.get_intids(candidates), 'creationdate')
+            querydates = table.timestamps(self.get_intids(queries), 'creationdate').tolist()
+        else:
+            candidatedates = None
+            querydates = [None] * len(queries)
+        state = (self, scorer, candidates, candidatedates, k)
+        if processes <= 1:
+            rankings = (_rank_query(state, item) for item in itertools.izip(queries, querydates))
+        else:
+            rankings = _rank_in_pool(itertools.izip(queries, querydates), processes, chunksize, state)
+        if scorefile is None:
+            return rankings
+        outputf = open(scorefile, 'w')
+        for queryid, results, scores in rankings:
+            outputf.write((u' '.join([queryid] + results) + u'\n').encode('utf-8'))
+        outputf.close()
+
+    #############################
+    # Near-duplicate candidates #
+    #############################
+
+    # split_for_classification() pairs each post with all older posts, but nearly all of these pairs are clearly not duplicates.
+    # The methods below find the pairs of posts that share many word n-grams (shingles) with MinHash and locality-sensitive hashing (LSH), so only those need to be classified.
+
+    def get_minhash_signatures(self, ids=None, numhashes=128, shinglesize=3, seed=0, processes=None, chunksize=50, maxcodelength=150, remove_stopwords=False, remove_punct=False, stem=False):
+        ''' Takes a list of post ids as input (default: all posts) and returns a NumPy array with a row of numhashes MinHash values (uint32) for each of them, in the same order.
+            The values are computed over the shingles (sequences of shinglesize words) of the cleaned title and body of the posts. Posts with fewer words than that have their whole text as one shingle.
+            The fraction of the values that two rows have in common is an estimate of the Jaccard similarity of the shingles of the two posts. Rows of posts without any words consist of 2**32-1 only.
+            seed determines the hash functions: only signatures made with the same seed, numhashes and shinglesize can be compared.
+            The shingles are hashed with CRC32 of their UTF-8 bytes, not with hash(), so the signatures are the same in every run and on every platform.
+            The texts are cleaned with clean_many(), see there for the other optional arguments. '''
+        if ids is None:
+            ids = self.get_all_postids()
+        else:
+            ids = list(ids)
+        hashes = array.array('I')
+        counts = array.array('l')
+        for text in self.clean_many(ids, 'title_and_body', processes, chunksize, maxcodelength, remove_stopwords, remove_punct, stem):
+            words = text.split()
+            shingles = set(u' '.join(words[i:i + shinglesize]) for i in xrange(max(len(words) - shinglesize + 1, 1 if words else 0)))
+            hashes.extend(zlib.crc32(shingle.encode('utf-8')) & 0xffffffff for shingle in shingles)
+            counts.append(len(shingles))
+        return _minhash_signatures(np.frombuffer(hashes, dtype=np.uint32).astype(np.uint64), np.frombuffer(counts, dtype=np.int_), numhashes, seed)
+
+    def get_candidate_pairs(self, signatures, ids=None, threshold=0.5, bands=None):
+        ''' Takes the output of get_minhash_signatures() and the ids it was made for (default: all posts) as input and returns a list of pairs of post ids (as tuples) that are likely to be near-duplicates.
+            The rows of the signatures are cut into bands, and two posts become a candidate if all values in at least one band are the same (locality-sensitive hashing).
+            Of these candidates only the pairs with an estimated Jaccard similarity (the fraction of equal MinHash values) of at least threshold are returned.
+            The number of bands should divide the number of values per post. More bands find more pairs with a low similarity. By default, the number of bands is chosen such that pairs with a similarity of about the threshold have a 50% chance of becoming a candidate.
+            In each pair, the first post comes before the second in ids. Use candidate_recall() to see how many of the duplicates are found. '''
+        if ids is None:
+            ids = self.get_all_postids()
+        else:
+            ids = list(ids)
+        if len(ids) != len(signatures):
+            raise ValueError("There are " + str(len(signatures)) + " signatures for " + str(len(ids)) + " ids.")
+        firsts, seconds = _lsh_candidate_pairs(signatures, threshold, bands)
+        return [(ids[i], ids[j]) for i, j in itertools.izip(firsts, seconds)]
+
+    def candidate_recall(self, pairs):
+        ''' Takes a list of pairs of post ids as input, for instance the output of get_candidate_pairs(), and returns the fraction of the duplicate pairs (see get_all_duplicate_pairs()) that is in it, in either order. '''
+        duplicates = set(frozenset(pair) for pair in self.get_all_duplicate_pairs())
+        if not duplicates:
+            return 0.0
+        return truediv(len(duplicates.intersection(frozenset(pair) for pair in pairs)), len(duplicates))
+
+    def write_candidate_pairs(self, pairs, outputfile):
+        ''' Takes a list of pairs of post ids as input, for instance the output of get_candidate_pairs(), and writes them to a file in the same format as split_for_classification(): one pair per line, followed by 1 if they are duplicates and 0 otherwise. '''
+        outputf = open(outputfile, 'w')
+        for postid, otherpostid in pairs:
+            if otherpostid in self.postdict[postid]['dups'] or postid in self.postdict[otherpostid]['dups']:
+                outputf.write(postid + ' ' + otherpostid + ' 1\n')
+            else:
+                outputf.write(postid + ' ' + otherpostid + ' 0\n')
+        outputf.close()
+
     ####################################
     # Evaluation metrics for retrieval #
     ####################################
@@ -1572,6 +2083,2062 @@ class Subforum():
         return recall_for_positives, recall_for_negatives
 
 
+# Regular expressions used by Cleaner. They are compiled once here instead of on every call.
+# (Python's own cache of compiled patterns only holds 100 of them, so cleaning a string used to recompile most of them each time.)
+_CODE_PAT = re.compile(r'<code>[^<]+</code>')
+_WHITESPACE = re.compile(r'\s+')
+_POSSIBLE_DUPLICATE = re.compile(r"<blockquote.+possible duplicate.+/blockquote>")
+_STACKEXCHANGE_LINK = re.compile(r"<a href=\"https?://[a-z]+\.stackexchange\.com[^\"]+\">([^<]+)</a>")
+_LINK = re.compile(r"<a href=\"[^\"]+\">([^<]+)</a>")
+_STACKEXCHANGE_URL = re.compile(r"https?://([a-z]+\.)?stackexchange\.com[^ ]+")
+_STACKOVERFLOW_URL = re.compile(r"https?://stackoverflow\.com[^ ]+")
+_TAG = re.compile(r'(</?)([^>]+)(>)')
+_URL = re.compile(r'https?://[^ ]+')
+_WWW = re.compile(r'www\.[^ ]+')
+_COM = re.compile(r'[^ ]+\.com[^ ]+')
+_AFTER_BRACKET = re.compile(r'\).*$')
+# Points, commas and colons between two digits are protected by replacing them with BBB, CCC and DDD. Replacing them never changes which characters are digits, so one pass does it all.
+_NUMBER_PUNCT = re.compile(r'(?<=[0-9])[.,:](?=[0-9])')
+_PROTECTED_PUNCT = re.compile(r'(?<=[0-9])(?:BBB|CCC|DDD)(?=[0-9])')
+_PUNCT_PLACEHOLDERS = {'.': 'BBB', ',': 'CCC', ':': 'DDD'}
+_PLACEHOLDER_PUNCT = {'BBB': '.', 'CCC': ',', 'DDD': ':'}
+_URL_PLACEHOLDER = re.compile(r'GGGG([0-9]+)')
+_CODE_PLACEHOLDER = re.compile(r'hhhh([0-9]+)') # HHHH, lowercased with the rest of the string.
+_NO_GROUPS = re.compile('') # For turning a replacement template into the string it stands for.
+_MAX_URLS_ONE_BY_ONE = 10 # Up to this many URLs, replacing them one by one is quicker than making a pattern that finds them all at once.
+_HTML_MARKUP = re.compile(r'''
+      <([a-zA-Z][-a-zA-Z0-9]*)(?:\s+[a-zA-Z_:][-a-zA-Z0-9_:.]*(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'=<>`]+))?)*\s*/?>  # start tag
+    | </[a-zA-Z][-.a-zA-Z0-9:_]*\s*>                           # end tag
+    | &\#(?:[0-9]+|[xX][0-9a-fA-F]+)(?:;|(?=[^0-9a-fA-F]))     # character reference
+    | &[a-zA-Z][-.a-zA-Z0-9]*(?:;|(?=[^a-zA-Z0-9]))             # entity reference
+    | (<(?=[^a-zA-Z/!?])|&(?=[^a-zA-Z\#]))                      # a < or & that is just text
+    | [<&]                                                      # anything else, which is left to an HTMLParser
+    ''', re.VERBOSE) # The markup that an HTMLParser deals with in a simple way (see HTMLParser.goahead()).
+_CDATA_ELEMENTS = ('script', 'style') # An HTMLParser does not look for tags inside these.
+_ABBREVIATION = re.compile(r'( [a-z] \.)( [a-z] \.)+')
+_TOKENIZED_ABBREVIATION = re.compile(r'( ([a-z]\.[a-z])+ \.)')
+# ',', '?' and '!' (and the brackets) are handled in one go: adding space around (or removing) one of them never changes where the others are.
+_SENTENCE_PUNCT = re.compile(r'([,?!])')
+_BRACKETS = re.compile(r'([()\[\]])')
+_OPENING_SINGLE_QUOTE = re.compile(r' \'([a-z])')
+_CLOSING_SINGLE_QUOTE = re.compile(r'([a-z])\' ')
+_OPENING_DOUBLE_QUOTE = re.compile(r' \"([a-z])')
+_CLOSING_DOUBLE_QUOTE = re.compile(r'([a-z])\" ')
+_COLON = re.compile(r'([a-z]): ')
+_LEFT_DOUBLE_QUOTE = re.compile('“')
+_RIGHT_DOUBLE_QUOTE = re.compile('”')
+_ENTITY = re.compile(r"&[a-z]+;")
+_NUMERIC_ENTITY = re.compile(r"&#?[a-z]+;")
+_LEADING_WHITESPACE = re.compile(r"^\s")
+_TRAILING_WHITESPACE = re.compile(r"\s$")
+
+# Source: http://www.englishcoursemalta.com/learn/list-of-contracted-forms-in-english/
+_CONTRACTIONS = {'i\'m': 'i am',
+                 'you\'re': 'you are',
+                 'he\'s': 'he is',
+                 'she\'s': 'she is',
+                 'we\'re': 'we are',
+                 'it\'s': 'it is',
+                 'isn\'t': 'is not',
+                 'aren\'t': 'are not',
+                 'they\'re': 'they are',
+                 'there\'s': 'there is',
+                 'wasn\'t': 'was not',
+                 'weren\'t': ' were not',
+                 'i\'ve': 'i have',
+                 'you\'ve': 'you have',
+                 'we\'ve': 'we have',
+                 'they\'ve': 'they have',
+                 'hasn\'t': 'has not',
+                 'haven\'t': 'have not',
+                 'you\'d': 'you had',
+                 'he\'d': 'he had',
+                 'she\'d': 'she had',
+                 'we\'d': 'we had',
+                 'they\'d': 'they had',
+                 'doesn\'t': 'does not',
+                 'don\'t': 'do not',
+                 'didn\'t': 'did not',
+                 'i\'ll': 'i will',
+                 'you\'ll': 'you will',
+                 'he\'ll': 'he will',
+                 'she\'ll': 'she will',
+                 'we\'ll': 'we will',
+                 'they\'ll': 'they will',
+                 'there\'ll': 'there will',
+                 'i\'d': 'i would',
+                 'it\'d': 'it would',
+                 'there\'d': 'there had',
+                 'there\'d': 'there would',
+                 'can\'t': 'can not',
+                 'couldn\'t': 'could not',
+                 'daren\'t': 'dare not',
+                 'hadn\'t': 'had not',
+                 'mightn\'t': 'might not',
+                 'mustn\'t': 'must not',
+                 'needn\'t': 'need not',
+                 'oughtn\'t': 'ought not',
+                 'shan\'t': 'shall not',
+                 'shouldn\'t': 'should not',
+                 'usedn\'t': 'used not',
+                 'won\'t': 'will not',
+                 'wouldn\'t': 'would not',
+                 'what\'s': 'what is',
+                 'that\'s': 'that is',
+                 'who\'s': 'who is',}
+# Some forms of 's could either mean 'is' or 'has' but we've made a choice here.
+# Some forms of 'd could either mean 'had' or 'would' but we've made a choice here.
+# Some forms of 'll could wither mean 'will' or 'shall' but we've made a choice here.
+# All contracted forms are replaced in a single pass of this regex. The longest forms come first, so "she's" is found rather than "he's".
+_CONTRACTION = re.compile('|'.join(re.escape(c) for c in sorted(_CONTRACTIONS, key=len, reverse=True)))
+# Each contracted form contains exactly one apostrophe, with at most 7 characters before and 2 after it.
+# If two apostrophes are close enough for their forms to overlap, the single pass could pick a different form than replacing them one by one does.
+_CLOSE_APOSTROPHES = re.compile(r"'[^']{0,8}'")
+
+# The tokenizers that can be used for removing stop words and stemming. See Subforum.change_tokenizer().
+_TOKENIZERS = ('nltk', 'regex')
+_CANNOT = {'cannot': ('can', 'not')} # The NLTK tokenizer splits 'cannot' into two words, and so does the 'regex' tokenizer.
+
+
+class Stemmer(object):
+    ''' The Porter stemmer as implemented in the NLTK (http://www.nltk.org/), with a memo of the stems it has computed before.
+        The same words come up over and over again, so most words only need to be looked up.
+        self.hits and self.misses count how often a word was and wasn't found in the memo.
+        OPTIONAL ARGUMENTS:
+        maxsize: the maximum number of words in the memo. When it is full, the stems of new words are still computed, but no longer memorised. Default: 500000. '''
+
+    def __init__(self, maxsize=500000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._stemmer = nltk.PorterStemmer()
+        self._memo = {}
+
+    def __len__(self):
+        return len(self._memo)
+
+    def stem(self, w):
+        ''' Takes a word as input and returns its stem. '''
+        try:
+            neww = self._memo[w]
+        except KeyError:
+            self.misses += 1
+            neww = self._stemmer.stem_word(w)
+            if len(self._memo) < self.maxsize:
+                self._memo[w] = neww
+            return neww
+        self.hits += 1
+        return neww
+
+    def warm(self, filename):
+        ''' Takes as input a plain text file encoded in UTF-8 with one word per line (anything after the first whitespace on a line, like a count, is ignored), and memorises the stems of these words, most frequent first if the file is sorted that way.
+            Returns the number of words that were added to the memo. Warming does not count as hits or misses. '''
+        before = len(self._memo)
+        inputf = codecs.open(filename, 'r', encoding='utf-8')
+        for line in inputf:
+            if len(self._memo) >= self.maxsize:
+                break
+            words = line.split()
+            if words and words[0] not in self._memo:
+                self._memo[words[0]] = self._stemmer.stem_word(words[0])
+        inputf.close()
+        return len(self._memo) - before
+
+    def reset_counts(self):
+        ''' Sets self.hits and self.misses back to 0. '''
+        self.hits = 0
+        self.misses = 0
+
+
+class CleaningTimer(object):
+    ''' Keeps track of how long each stage of cleaning takes, for the strings cleaned by a Cleaner that was given this timer.
+        The stages are 'deal_with_code', 'lowercase', 'remove_tags', 'expand_contractions', 'general_cleaning', 'remove_stopwords', 'stem' (or 'remove_stopwords_and_stem' with the 'regex' tokenizer) and 'fix_exceptions'. 'total' is the time of all of them together.
+        OPTIONAL ARGUMENTS:
+        slowest: the number of slowest strings to remember, with their ids and lengths. Default: 10. '''
+
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.reset()
+
+    def reset(self):
+        ''' Forgets all timings. '''
+        self.texts = 0
+        self._seconds = collections.OrderedDict() # Stage name -> array of the seconds each string took in that stage.
+        self._slowest = [] # A heap of (seconds, count, id, length, stage seconds) of the slowest strings.
+        self._count = itertools.count()
+
+    def add(self, id, length, laps):
+        ''' Takes the id (or None) and length of a string, and the time cleaning started followed by a (stage, time) tuple for each stage that was done, and adds them to the timings. '''
+        stages = []
+        previous = laps[0]
+        for stage, t in laps[1:]:
+            seconds = t - previous
+            self._seconds.setdefault(stage, array.array('d')).append(seconds)
+            stages.append((stage, seconds))
+            previous = t
+        total = previous - laps[0]
+        self._seconds.setdefault('total', array.array('d')).append(total)
+        self.texts += 1
+        if self.slowest > 0:
+            item = (total, next(self._count), id, length, stages)
+            if len(self._slowest) < self.slowest:
+                heapq.heappush(self._slowest, item)
+            elif total > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, item)
+
+    def summary(self):
+        ''' Returns a dictionary with the number of strings that were timed ('texts'), a dictionary with for each stage the number of calls and the total, mean, median (p50), p90, p99 and maximum number of seconds ('stages'),
+            and a list of the slowest strings, slowest first, each a dictionary with its id, length, seconds and the seconds of each stage ('slowest'). '''
+        stages = collections.OrderedDict()
+        for stage, seconds in self._seconds.iteritems():
+            values = np.frombuffer(seconds, dtype=np.float64)
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            stages[stage] = {'calls': len(values), 'seconds': float(values.sum()), 'mean': float(values.mean()), 'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(values.max())}
+        slowest = [{'id': id, 'length': length, 'seconds': total, 'stages': dict(s)} for total, n, id, length, s in sorted(self._slowest, reverse=True)]
+        return {'texts': self.texts, 'stages': stages, 'slowest': slowest}
+
+    def to_json(self, filename=None):
+        ''' Returns the summary() as a JSON string, or, if a filename is given, writes it to that file. '''
+        s = json.dumps(self.summary(), indent=2)
+        if filename is None:
+            return s
+        outputf = open(filename, 'w')
+        outputf.write(s)
+        outputf.close()
+
+
+class TermStatistics(object):
+    ''' The vocabulary, document frequencies, collection frequencies and document lengths of a collection of cleaned texts, in which terms are separated by whitespace (like the output of Subforum.perform_cleaning()).
+        self.vocabulary maps each term to an int id, which is its position in self.terms and in the NumPy arrays self.df (the number of documents a term occurs in) and self.cf (the number of times it occurs in all documents together).
+        self.docids and self.doclengths give the id and the number of terms of each document, in the order in which they were added. self.sources is a list of (name, number of documents) tuples, for instance one per subforum.
+        Statistics of other texts can be added with add_documents(), or with merge() if they were built elsewhere, for instance in another process or for another subforum.
+        OPTIONAL ARGUMENTS:
+        field and options: the field the texts come from and a description of how they were cleaned. Only statistics with the same field and options can be merged. '''
+
+    def __init__(self, field=None, options=None):
+        self.field = field
+        self.options = options
+        self.vocabulary = {}
+        self.terms = []
+        self.df = np.zeros(0, dtype=np.int64)
+        self.cf = np.zeros(0, dtype=np.int64)
+        self.docids = []
+        self.doclengths = np.zeros(0, dtype=np.int32)
+        self.sources = []
+
+    def __len__(self):
+        return len(self.docids)
+
+    def add_documents(self, documents, source=None, batchsize=10000, termids=None):
+        ''' Takes an iterable of (id, text) tuples as input and adds their terms to the statistics, in one pass, batchsize documents at a time.
+            source is the name under which the documents are counted in self.sources.
+            If termids is a list or an array.array, the ids of the terms of the documents are added to it, in order, so that vectors or postings can be made without looking up the terms again. The new part of self.doclengths tells which ids belong to which document. '''
+        vocabulary = self.vocabulary
+        terms = self.terms
+        lengths = array.array('i') # The lengths of all documents of this call, added to self.doclengths at the end.
+        documents = iter(documents)
+        try:
+            while True:
+                batch = list(itertools.islice(documents, batchsize))
+                if not batch:
+                    break
+                batchids = [] # All term ids of the batch, for the cf.
+                uniqueids = [] # The distinct term ids of each document, for the df.
+                for docid, text in batch:
+                    ids = []
+                    for term in text.split():
+                        termid = vocabulary.get(term)
+                        if termid is None:
+                            termid = vocabulary[term] = len(terms)
+                            terms.append(term)
+                        ids.append(termid)
+                    batchids.extend(ids)
+                    uniqueids.extend(set(ids))
+                    lengths.append(len(ids))
+                    self.docids.append(docid)
+                if termids is not None:
+                    termids.extend(batchids)
+                self._grow()
+                self.cf += np.bincount(np.asarray(batchids, dtype=np.int64), minlength=len(terms))
+                self.df += np.bincount(np.asarray(uniqueids, dtype=np.int64), minlength=len(terms))
+        finally: # Also if cleaning the documents fails halfway, so that the statistics of the documents that were added stay consistent.
+            self.doclengths = np.concatenate([self.doclengths, np.frombuffer(lengths, dtype=np.int32)])
+            self._add_source(source, len(lengths))
+
+    def merge(self, other):
+        ''' Takes another TermStatistics object as input and adds its terms and documents to this one. Raises a ValueError if it was made for another field or with other options. '''
+        if (other.field, other.options) != (self.field, self.options):
+            raise ValueError("Term statistics of different fields or cleaning options cannot be merged.")
+        mapping = np.empty(len(other.terms), dtype=np.int64) # Term id in other -> term id in self.
+        for i, term in enumerate(other.terms):
+            termid = self.vocabulary.get(term)
+            if termid is None:
+                termid = self.vocabulary[term] = len(self.terms)
+                self.terms.append(term)
+            mapping[i] = termid
+        self._grow()
+        self.df[mapping] += other.df # Each term occurs only once in mapping, so this adds everything.
+        self.cf[mapping] += other.cf
+        self.docids.extend(other.docids)
+        self.doclengths = np.concatenate([self.doclengths, other.doclengths])
+        for name, count in other.sources:
+            self._add_source(name, count)
+
+    def _grow(self):
+        ''' Makes self.df and self.cf as long as the vocabulary. '''
+        extra = len(self.terms) - len(self.df)
+        if extra > 0:
+            self.df = np.concatenate([self.df, np.zeros(extra, dtype=np.int64)])
+            self.cf = np.concatenate([self.cf, np.zeros(extra, dtype=np.int64)])
+
+    def _add_source(self, name, count):
+        if self.sources and self.sources[-1][0] == name:
+            self.sources[-1] = (name, self.sources[-1][1] + count)
+        elif count > 0:
+            self.sources.append((name, count))
+
+    def save(self, filename):
+        ''' Takes a file name as input and writes the statistics to it. The file is written under another name first and then renamed, so other processes never see half of it. '''
+        data = self._state()
+        fd, tmpname = tempfile.mkstemp(prefix='.' + os.path.basename(filename), dir=os.path.dirname(filename) or '.')
+        try:
+            outputf = os.fdopen(fd, 'wb')
+            outputf.write(_term_statistics_header())
+            marshal.dump(data, outputf, marshal.version)
+            outputf.close()
+            os.chmod(tmpname, 0644)
+            os.rename(tmpname, filename)
+        except:
+            os.remove(tmpname)
+            raise
+
+    @classmethod
+    def load(cls, filename):
+        ''' Takes the name of a file written by save() as input and returns the TermStatistics stored in it. Raises a ValueError if it is not such a file, or was written by another version of Python. '''
+        inputf = open(filename, 'rb')
+        try:
+            if inputf.readline() != _term_statistics_header():
+                raise ValueError(filename + " does not contain term statistics of this version.")
+            data = marshal.load(inputf)
+        finally:
+            inputf.close()
+        return cls._from_state(data)
+
+    def _state(self):
+        ''' Returns the statistics as a dictionary that marshal can write. '''
+        return {'field': self.field, 'options': self.options, 'terms': self.terms, 'df': self.df.tostring(), 'cf': self.cf.tostring(),
+                'docids': self.docids, 'doclengths': self.doclengths.tostring(), 'sources': [list(s) for s in self.sources]}
+
+    @classmethod
+    def _from_state(cls, data):
+        ''' Takes a dictionary made by _state() as input and returns the TermStatistics it describes. '''
+        stats = cls(data['field'], data['options'])
+        stats.terms = data['terms']
+        stats.vocabulary = dict(itertools.izip(stats.terms, itertools.count()))
+        stats.df = np.frombuffer(data['df'], dtype=np.int64).copy()
+        stats.cf = np.frombuffer(data['cf'], dtype=np.int64).copy()
+        stats.docids = data['docids']
+        stats.doclengths = np.frombuffer(data['doclengths'], dtype=np.int32).copy()
+        stats.sources = [tuple(s) for s in data['sources']]
+        return stats
+
+
+def _term_statistics_header():
+    ''' Returns the first line of a file written by TermStatistics.save(), with the format version, and the marshal and Python versions (marshal data is not portable between them). '''
+    return 'CQADupStack term statistics %d %d %d.%d\n' % (TERM_STATISTICS_VERSION, marshal.version, sys.version_info[0], sys.version_info[1])
+
+
+class BM25Index(object):
+    ''' An inverted index of documents with a title, a body and answers (see _BM25_FIELDS), for ranking them with BM25.
+        The postings are stored as NumPy arrays: for each term, the numbers of the documents it occurs in (their positions in self.docids) and how often it occurs in each field of them.
+        Documents are added with add_documents(), after which finish() makes the postings. Subforum.get_bm25_index() does all this for the posts of a subforum.
+        The vocabulary, the document ids and the document frequencies are kept in a TermStatistics object, self.statistics, in which all fields of a document together count as one text.
+        The document numbers are dense ids of their own, 0 to len(self) - 1 in the order in which the documents were added, and not the integer ids of the posts in the subforum (see Subforum.get_intid()):
+        the index only holds the posts it was made for, and a saved index can be used without the subforum. subforum.get_intids(index.docids) gives the integer id of the post of each document number.
+        OPTIONAL ARGUMENTS:
+        options: the cleaning options the texts were cleaned with, so queries can be cleaned the same way. '''
+
+    def __init__(self, options=None):
+        self.options = options
+        self.statistics = TermStatistics('title_body_and_answers', options)
+        self.vocabulary = self.statistics.vocabulary
+        self.docids = self.statistics.docids
+        self.docindex = {} # Document id -> document number.
+        self._doclengths = [array.array('i') for f in _BM25_FIELDS]
+        self._entries = (array.array('i'), array.array('i'), array.array('b'), array.array('i')) # Term id, document number, field number and term frequency of each term in each field of each document.
+        self.offsets = None
+
+    def __len__(self):
+        return len(self.docids)
+
+    def add_documents(self, documents, batchsize=10000):
+        ''' Takes an iterable of (id, texts) tuples as input, where texts is a list of the cleaned texts of the document, one for each field in _BM25_FIELDS, with whitespace between the terms.
+            The terms are looked up in self.statistics, batchsize documents at a time, and their frequencies in each field are kept until finish() is called. '''
+        if self.offsets is not None:
+            raise ValueError("No documents can be added to a BM25Index after finish() has been called.")
+        termids, docnumbers, fields, tfs = self._entries
+        documents = iter(documents)
+        while True:
+            batch = list(itertools.islice(documents, batchsize))
+            if not batch:
+                break
+            first = len(self.docids)
+            ids = array.array('i')
+            self.statistics.add_documents(((docid, u' '.join(texts)) for docid, texts in batch), batchsize=len(batch), termids=ids)
+            start = 0
+            for docnumber, (docid, texts) in enumerate(batch, first):
+                self.docindex[docid] = docnumber
+                for field, text in enumerate(texts):
+                    end = start + len(text.split())
+                    self._doclengths[field].append(end - start)
+                    for termid, tf in collections.Counter(ids[start:end]).iteritems():
+                        termids.append(termid)
+                        docnumbers.append(docnumber)
+                        fields.append(field)
+                        tfs.append(tf)
+                    start = end
+
+    def finish(self):
+        ''' Makes the postings of the documents that were added: self.offsets, self.postdocs, self.tfs, self.doclengths and self.df. '''
+        ndocs = max(len(self.docids), 1)
+        termids, docnumbers, fields, tfs = [np.frombuffer(a, dtype=a.typecode) for a in self._entries]
+        keys = termids.astype(np.int64) * ndocs + docnumbers # Sorted by term, and then by document.
+        keys, positions = np.unique(keys, return_inverse=True)
+        self.tfs = np.zeros((len(_BM25_FIELDS), len(keys)), dtype=np.int32)
+        for field in xrange(len(_BM25_FIELDS)):
+            infield = fields == field
+            self.tfs[field] = np.bincount(positions[infield], weights=tfs[infield], minlength=len(keys))
+        self.postdocs = (keys % ndocs).astype(np.int32)
+        self.offsets = np.searchsorted(keys // ndocs, np.arange(len(self.vocabulary) + 1))
+        self.df = self.statistics.df
+        self.doclengths = np.array([np.frombuffer(a, dtype=np.int32) for a in self._doclengths], dtype=np.int32).reshape(len(_BM25_FIELDS), len(self.docids))
+        self._entries = self._doclengths = None
+        self._norms = {}
+
+    def postings(self, termid):
+        ''' Takes a term id as input and returns a NumPy array with the numbers of the documents the term occurs in, and an array with how often it occurs in each field of them (one row per field). '''
+        start, end = self.offsets[termid], self.offsets[termid + 1]
+        return self.postdocs[start:end], self.tfs[:, start:end]
+
+    def search(self, text, k1=1.2, b=0.75, weights=None, cutoff=100, exclude=()):
+        ''' Takes a cleaned query text as input and returns a list of the ids of the best matching documents according to BM25, best first, and a list of their scores.
+            The term frequencies and lengths of the fields are added up with weights (a dictionary from field to weight, default 1 for each field) before they are used, as in BM25F.
+            The idf is log(1 + (N - df + 0.5) / (df + 0.5)), which is never negative. A query term that occurs more than once counts that many times.
+            OPTIONAL ARGUMENTS:
+            k1 and b: the BM25 parameters. Defaults: 1.2 and 0.75.
+            cutoff: the maximum number of documents to return. Default: 100.
+            exclude: ids of documents that should not be returned, like the query itself. '''
+        weights = self._field_weights(weights)
+        norms = self._doc_norms(k1, b, weights)
+        allfields = (weights > 0).all()
+        ndocs = len(self.docids)
+        scores = np.zeros(ndocs)
+        for term, qtf in collections.Counter(text.split()).iteritems():
+            termid = self.vocabulary.get(term)
+            if termid is None:
+                continue
+            docs, tfs = self.postings(termid)
+            idf = math.log(1 + (ndocs - len(docs) + 0.5) / (len(docs) + 0.5))
+            tf = np.dot(weights, tfs)
+            if not allfields: # Leave out the documents that only have the term in fields with weight 0.
+                found = tf > 0
+                docs, tf = docs[found], tf[found]
+            scores[docs] += qtf * idf * tf * (k1 + 1) / (tf + norms[docs])
+        for docid in exclude:
+            if docid in self.docindex:
+                scores[self.docindex[docid]] = 0
+        hits = np.flatnonzero(scores)
+        if len(hits) > cutoff:
+            hits = hits[np.argpartition(-scores[hits], cutoff - 1)[:cutoff]]
+        hits = hits[np.lexsort((hits, -scores[hits]))] # Best first, and documents with the same score in the order they were added.
+        return [self.docids[d] for d in hits], scores[hits].tolist()
+
+    def _field_weights(self, weights):
+        ''' Takes a dictionary from field to weight as input and returns an array with the weight of each field in _BM25_FIELDS. '''
+        if weights is None:
+            return np.ones(len(_BM25_FIELDS))
+        for field in weights:
+            if field not in _BM25_FIELDS:
+                raise ValueError(repr(field) + " is not a valid field. Please choose 'title', 'body' or 'answers'.")
+        return np.array([weights.get(field, 1.0) for field in _BM25_FIELDS], dtype=np.float64)
+
+    def _doc_norms(self, k1, b, weights):
+        ''' Returns k1 * (1 - b + b * length / average length) for each document, where the length is the weighted sum of the lengths of its fields. '''
+        key = (k1, b, tuple(weights))
+        if key not in self._norms:
+            lengths = np.dot(weights, self.doclengths)
+            average = lengths.mean() if len(lengths) and lengths.mean() > 0 else 1.0
+            self._norms = {key: k1 * (1 - b + b * lengths / average)} # Only the last one is kept.
+        return self._norms[key]
+
+    def save(self, filename):
+        ''' Takes a file name as input and writes the index to it, in a format that MappedBM25Index (or load_bm25_index()) reads without loading the postings into memory.
+            The postings of each term are compressed: the differences between the document numbers, followed by the term frequencies of each field, in variable-byte encoding.
+            The file is written under another name first and then renamed, so other processes never see half of it. '''
+        nfields = len(_BM25_FIELDS)
+        # Put the numbers of all terms after each other: for a term with n postings, first n document number differences and then n term frequencies per field.
+        df = self.df.astype(np.int64)
+        termstarts = np.repeat(self.offsets[:-1], df) # The first posting of the term of each posting.
+        gaps = self.postdocs.astype(np.int64)
+        gaps[1:] -= self.postdocs[:-1]
+        gaps[self.offsets[:-1][df > 0]] = self.postdocs[self.offsets[:-1][df > 0]] # The first document number of each term is not a difference.
+        postings = np.arange(len(self.postdocs))
+        values = np.empty((nfields + 1) * len(self.postdocs), dtype=np.int64)
+        values[nfields * termstarts + postings] = gaps
+        for field in xrange(nfields):
+            values[nfields * termstarts + (field + 1) * np.repeat(df, df) + postings] = self.tfs[field]
+        data, sizes = _varbyte_encode(values)
+        byteoffsets = np.concatenate([[0], np.cumsum(sizes)])[(nfields + 1) * self.offsets] # Where the postings of each term start in data.
+        meta = marshal.dumps({'options': self.options, 'statistics': self.statistics._state(),
+                              'byteoffsets': byteoffsets.astype(np.int64).tostring(), 'doclengths': self.doclengths.tostring()}, marshal.version)
+        fd, tmpname = tempfile.mkstemp(prefix='.' + os.path.basename(filename), dir=os.path.dirname(filename) or '.')
+        try:
+            outputf = os.fdopen(fd, 'wb')
+            outputf.write(_bm25_index_header())
+            outputf.write('%d\n' % len(meta))
+            outputf.write(meta)
+            outputf.write(data.tostring())
+            outputf.close()
+            os.chmod(tmpname, 0644)
+            os.rename(tmpname, filename)
+        except:
+            os.remove(tmpname)
+            raise
+
+
+class MappedBM25Index(BM25Index):
+    ''' A BM25Index read from a file written by BM25Index.save(). Searching works the same, but the postings stay on disk:
+        the file is opened with mmap, so several processes that use the same index share it through the page cache, and only the postings of the terms of a query are read and decoded.
+        The vocabulary, the document ids and the document lengths are read into memory, and self.statistics is the TermStatistics of the index that was saved. '''
+
+    def __init__(self, filename):
+        inputf = open(filename, 'rb')
+        try:
+            if inputf.readline() != _bm25_index_header():
+                raise ValueError(filename + " is not a BM25 index file of this version.")
+            meta = marshal.loads(inputf.read(int(inputf.readline())))
+            start = inputf.tell()
+            self._map = mmap.mmap(inputf.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            inputf.close()
+        self.options = meta['options']
+        self.statistics = TermStatistics._from_state(meta['statistics'])
+        self.vocabulary = self.statistics.vocabulary
+        self.docids = self.statistics.docids
+        self.docindex = dict(itertools.izip(self.docids, itertools.count()))
+        self.df = self.statistics.df
+        self._byteoffsets = np.frombuffer(meta['byteoffsets'], dtype=np.int64) + start
+        self.doclengths = np.frombuffer(meta['doclengths'], dtype=np.int32).reshape(len(_BM25_FIELDS), len(self.docids))
+        self.offsets = None
+        self._norms = {}
+
+    def add_documents(self, documents, batchsize=10000):
+        raise ValueError("No documents can be added to a MappedBM25Index.")
+
+    def save(self, filename):
+        raise ValueError("A MappedBM25Index is already saved.")
+
+    def postings(self, termid):
+        ''' Takes a term id as input, decodes its postings from the file and returns them like BM25Index.postings() does. '''
+        start, end = self._byteoffsets[termid], self._byteoffsets[termid + 1]
+        values = _varbyte_decode(np.frombuffer(self._map, dtype=np.uint8, count=end - start, offset=start))
+        n = self.df[termid]
+        return np.cumsum(values[:n]).astype(np.int32), values[n:].reshape(len(_BM25_FIELDS), n)
+
+    def close(self):
+        ''' Closes the file. The index cannot be searched anymore after this. '''
+        self._map.close()
+
+
+def load_bm25_index(filename):
+    ''' Takes the name of a file written by BM25Index.save() as input and returns a MappedBM25Index, which reads the postings from the file when they are needed. '''
+    return MappedBM25Index(filename)
+
+def _bm25_index_header():
+    ''' Returns the first line of a file written by BM25Index.save(), with the format version, and the marshal and Python versions (marshal data is not portable between them). '''
+    return 'CQADupStack BM25 index %d %d %d.%d\n' % (BM25_INDEX_VERSION, marshal.version, sys.version_info[0], sys.version_info[1])
+
+def _varbyte_encode(values):
+    ''' Takes a NumPy array of non-negative integers as input and returns a uint8 array with the numbers in variable-byte encoding, and an array with the number of bytes of each number.
+        Each byte holds 7 bits of a number, lowest bits first, and has its highest bit set if more bytes of the same number follow. '''
+    values = np.asarray(values, dtype=np.uint64)
+    sizes = np.ones(len(values), dtype=np.int64)
+    for k in xrange(1, 10):
+        sizes += values >= np.uint64(1 << (7 * k))
+    ends = np.cumsum(sizes)
+    data = np.zeros(ends[-1] if len(values) else 0, dtype=np.uint8)
+    for k in xrange(sizes.max() if len(values) else 0):
+        which = np.flatnonzero(sizes > k)
+        bits = (values[which] >> np.uint64(7 * k)) & np.uint64(127)
+        data[ends[which] - sizes[which] + k] = bits.astype(np.uint8) | np.where(sizes[which] > k + 1, 128, 0).astype(np.uint8)
+    return data, sizes
+
+def _varbyte_decode(data):
+    ''' Takes a uint8 array made by _varbyte_encode() as input and returns an int64 array with the numbers in it. '''
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 128) # The last byte of each number.
+    if len(ends) == len(data): # All numbers are below 128, which is true for most term frequencies.
+        return data.astype(np.int64)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shifts = 7 * (np.arange(len(data)) - np.repeat(starts, ends - starts + 1))
+    return np.add.reduceat((data & 127).astype(np.int64) << shifts, starts)
+
+
+def _minhash_signatures(hashes, counts, numhashes, seed):
+    ''' Takes a NumPy array with the hash values of the shingles of all documents after each other, an array with the number of shingles of each document, the number of MinHash values per document and a seed as input.
+        Returns an array with a row of MinHash values (uint32) per document: the minimum of each hash function over its shingles, or 2**32-1 if it has none.
+        The hash functions are h(x) = ((a * x + b) mod 2**64) >> 32 with random a and b (multiply-shift hashing). '''
+    generator = np.random.RandomState(seed)
+    multipliers = generator.randint(0, 2 ** 64, numhashes, dtype=np.uint64) | np.uint64(1)
+    increments = generator.randint(0, 2 ** 64, numhashes, dtype=np.uint64)
+    signatures = np.empty((len(counts), numhashes), dtype=np.uint32)
+    signatures.fill(0xffffffff)
+    nonempty = np.flatnonzero(counts > 0)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+    if len(hashes) > 0:
+        for i in xrange(numhashes):
+            signatures[nonempty, i] = np.minimum.reduceat((multipliers[i] * hashes + increments[i]) >> np.uint64(32), starts)
+    return signatures
+
+def _lsh_candidate_pairs(signatures, threshold, bands=None, maxpairs=100000):
+    ''' Takes an array of MinHash signatures (see _minhash_signatures()), a Jaccard similarity threshold and optionally a number of bands as input.
+        Returns two arrays with the row numbers of the pairs of rows that are equal in at least one band and have at least threshold of their values in common, with the first row number lower than the second.
+        The signatures of at most about maxpairs pairs are compared at a time, also when one bucket has more pairs than that, to keep the memory use bounded. '''
+    nrows, numhashes = signatures.shape
+    if bands is None:
+        # With r rows per band, pairs with similarity s become a candidate with probability 1 - (1 - s**r)**bands, which is about 50% at (1/bands)**(1/r).
+        bands = min((b for b in xrange(1, numhashes + 1) if numhashes % b == 0), key=lambda b: abs((1.0 / b) ** (float(b) / numhashes) - threshold))
+    elif bands < 1 or numhashes % bands != 0:
+        raise ValueError(repr(bands) + " is not a valid number of bands. Please choose a number that divides the number of MinHash values per post (" + str(numhashes) + ").")
+    rows = numhashes // bands
+    documents = np.flatnonzero((signatures != 0xffffffff).any(axis=1)) # Leave out documents without shingles, which would all be the same.
+    found = [np.zeros(0, dtype=np.int64)]
+    for band in xrange(bands):
+        keys = np.ascontiguousarray(signatures[documents, band * rows:(band + 1) * rows]).view(np.dtype((np.void, 4 * rows))).ravel()
+        order = np.argsort(keys, kind='mergesort') # Stable, so the documents in each bucket stay in order.
+        sortedkeys = keys[order]
+        boundaries = np.flatnonzero(np.concatenate([[True], sortedkeys[1:] != sortedkeys[:-1], [True]]))
+        sizes = np.diff(boundaries)
+        # Make the pairs of all buckets with the same number of documents at once.
+        for size in np.unique(sizes[sizes > 1]):
+            buckets = documents[order[boundaries[:-1][sizes == size][:, np.newaxis] + np.arange(size)]]
+            for firsts, seconds in _pair_blocks(size, maxpairs):
+                blocksize = max(1, maxpairs // len(firsts)) # Small buckets are compared several at a time.
+                for block in xrange(0, len(buckets), blocksize):
+                    first = buckets[block:block + blocksize, firsts].ravel()
+                    second = buckets[block:block + blocksize, seconds].ravel()
+                    similar = (signatures[first] == signatures[second]).mean(axis=1) >= threshold
+                    found.append(first[similar] * nrows + second[similar])
+    pairs = np.unique(np.concatenate(found))
+    return pairs // nrows, pairs % nrows
+
+def _pair_blocks(size, maxpairs):
+    ''' Takes a number of items and a maximum number of pairs as input, and yields blocks of the pairs (i, j) with i < j of the positions of the items, as two arrays with the i's and the j's.
+        All pairs come in one block if there are at most maxpairs of them. Else each block has the pairs of a square of about maxpairs (i, j) combinations, so no more than that are made at once. '''
+    if size * (size - 1) // 2 <= maxpairs:
+        yield np.triu_indices(size, 1)
+        return
+    width = max(1, int(math.sqrt(maxpairs)))
+    for istart in xrange(0, size, width):
+        for jstart in xrange(istart, size, width):
+            firsts, seconds = np.meshgrid(np.arange(istart, min(istart + width, size)), np.arange(jstart, min(jstart + width, size)), indexing='ij')
+            keep = firsts < seconds
+            yield firsts[keep], seconds[keep]
+
+def _top_k_rows(scores, k):
+    ''' Takes a 2-dimensional NumPy array of scores and a number k as input, and returns two lists with an array per row: the column numbers of the (at most k) highest positive scores, highest first (and lowest column number first for equal scores), and these scores. '''
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return [np.zeros(0, dtype=np.int64)] * len(scores), [np.zeros(0)] * len(scores)
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    topscores = scores[np.arange(len(scores))[:, np.newaxis], top]
+    order = np.lexsort((top, -topscores))
+    top = top[np.arange(len(scores))[:, np.newaxis], order]
+    topscores = topscores[np.arange(len(scores))[:, np.newaxis], order]
+    positive = (topscores > 0).sum(axis=1)
+    return [top[i, :positive[i]] for i in xrange(len(scores))], [topscores[i, :positive[i]] for i in xrange(len(scores))]
+
+class Cleaner(object):
+    ''' Cleans strings exactly like Subforum.perform_cleaning() does, with the options fixed when the Cleaner is made.
+        All regular expressions are compiled only once, so a Cleaner is the quickest way to clean many strings with the same options.
+        Example: cleaner = Cleaner(remove_punct=True); cleaned = [cleaner.clean(o.get_postbody(p)) for p in o.get_all_postids()]
+        OPTIONAL ARGUMENTS:
+        maxcodelength, remove_stopwords, remove_punct and stem: see Subforum.perform_cleaning().
+        stopwords: the list of stop words to remove if remove_stopwords is True. Default: the 'middle' list of Subforum.change_to_default_stopwords().
+        stemmer: the Stemmer to use if stem is True. Default: a new one.
+        tokenizer: how to split strings into words when stop words are removed or words are stemmed: 'nltk' (default) or 'regex'. See Subforum.change_tokenizer().
+        timer: a CleaningTimer that times each stage of cleaning. Default: None (no timing). '''
+
+    def __init__(self, maxcodelength=150, remove_stopwords=False, remove_punct=False, stem=False, stopwords=None, stemmer=None, tokenizer='nltk', timer=None):
+        self.maxcodelength = maxcodelength
+        self.remove_stopwords = remove_stopwords
+        self.remove_punct = remove_punct
+        self.stem = stem
+        if stopwords is None:
+            stopwords = ["in", "on", "at", "a", "an", "is", "be", "was", "I", "you", "the", "do", "did", "of", "so", "for", "with", "yes", "thanks"]
+        self.stopwords = stopwords
+        self._stopwordset = frozenset(stopwords)
+        if stemmer is None:
+            stemmer = Stemmer()
+        self.stemmer = stemmer
+        if tokenizer not in _TOKENIZERS:
+            raise ValueError(repr(tokenizer) + " is not a valid tokenizer. Please choose 'nltk' or 'regex'.")
+        self.tokenizer = tokenizer
+        self.timer = timer
+
+    def clean(self, s, id=None):
+        ''' Takes a string as input and returns a cleaned version. See Subforum.perform_cleaning() for what is done to it.
+            If the Cleaner has a timer, the time each stage takes is added to it, under the id of the string if one is given. '''
+        if self.timer is None:
+            return self._clean(s, None)
+        laps = [time.time()]
+        cleaned = self._clean(s, laps)
+        self.timer.add(id, len(s), laps)
+        return cleaned
+
+    def _clean(self, s, laps):
+        ''' Cleans a string. If laps is a list, a (stage, time) tuple is appended to it after each stage. '''
+        s, codes = self._deal_with_code(s)
+        if laps is not None: laps.append(('deal_with_code', time.time()))
+        s = s.lower()
+        s = s.replace('\n', ' ')
+        if laps is not None: laps.append(('lowercase', time.time()))
+        s = self._remove_tags(s)
+        if laps is not None: laps.append(('remove_tags', time.time()))
+        s = self._expand_contractions(s)
+        if laps is not None: laps.append(('expand_contractions', time.time()))
+        s = self._general_cleaning(s, codes)
+        if laps is not None: laps.append(('general_cleaning', time.time()))
+        if self.tokenizer == 'regex':
+            if self.remove_stopwords or self.stem:
+                s = self._remove_stopwords_and_stem(s)
+                if laps is not None: laps.append(('remove_stopwords_and_stem', time.time()))
+        else:
+            if self.remove_stopwords:
+                s = self._remove_stopwords(s)
+                if laps is not None: laps.append(('remove_stopwords', time.time()))
+            if self.stem:
+                s = self._stem(s)
+                if laps is not None: laps.append(('stem', time.time()))
+        s = self._fix_exceptions(s)
+        if laps is not None: laps.append(('fix_exceptions', time.time()))
+        return s
+
+    def _fix_exceptions(self, s):
+        ''' Takes a string as input, fixes exceptions that have accidentally been changed, and returns the new string. '''
+        s = s.replace(' . net ', ' .net')
+        s = s.replace(' i . e ', ' i.e. ')
+        # fix extensions
+        s = s.replace(' . jpeg ', '.jpeg ')
+        s = s.replace(' . jpg ', '.jpg ')
+        return s
+
+    def _deal_with_code(self, s):
+        ''' Takes a string as input, finds all code blocks in it and replace them with HHHH to protect them from whitespace addition, lower casing etc. Then returns the new string and a list of the code blocks so we can replace them after more cleaning.
+            All code blocks are replaced in one pass. Each distinct code block is numbered by its first occurrence, but every short code block adds one to the count, just like replacing them one by one did. '''
+        placeholders = {}
+        newcodes = []
+        def protect(m):
+            c = m.group()
+            if len(c) < self.maxcodelength + 13: # two code tags are 13 characters
+                if c not in placeholders:
+                    placeholders[c] = ('HHHH' + str(len(newcodes)), self._tidy_code(c))
+                placeholder, newc = placeholders[c]
+                newcodes.append(newc)
+                return placeholder
+            return '' # Remove large code blocks
+        protected = _CODE_PAT.sub(protect, s)
+        if _CODE_PAT.search(protected):
+            # Taking code blocks out made a new one from the text around them. Replacing them one by one would replace that too if it is the same as a later one, so that is what we do.
+            return self._deal_with_code_one_by_one(s)
+        return protected, newcodes
+
+    def _deal_with_code_one_by_one(self, s):
+        ''' Does the same as _deal_with_code(), by replacing each code block in turn. '''
+        codes = _CODE_PAT.findall(s)
+        n = 0
+        newcodes = []
+        for c in codes:
+            if len(c) < self.maxcodelength + 13:
+                s = s.replace(c, 'HHHH' + str(n))
+                newcodes.append(self._tidy_code(c))
+                n += 1
+            else:
+                s = s.replace(c, '')
+        return s, newcodes
+
+    def _tidy_code(self, c):
+        ''' Takes a code block as input and returns the version of it that will be put back into the string after cleaning. '''
+        # Remove brackets if other half is missing. Else we'll have problems when we try to put them back.
+        if ')' in c and '(' not in c:
+            c = c.replace(')', '')
+        if '(' in c and ')' not in c:
+            c = c.replace('(', '')
+
+        c = c.replace('\n', ' ', 8) # remove real newlines (only the first 8, like the re.sub(r'\n', ' ', c, re.M) this used to be. The rest are removed with the other whitespace below.)
+        c = c.replace('\\n', '\\\\n') # keep and escape \n in things like latex's \newcommand{}.
+        c = _WHITESPACE.sub(' ', c)
+        c = c.replace('<code>', '')
+        c = c.replace('</code>', '')
+        return c
+
+    def _remove_stopwords(self, s):
+        ''' Takes a string as input, removes the stop words in self.stopwords, and returns the result. '''
+
+        words = nltk.word_tokenize(s) # The NLTK tokenizer cuts things like 'cannot' into 'can' and 'not'.
+        words_split = s.split()
+        if 'cannot' in words_split: # which we'd like to keep.
+            location = words_split.index('cannot')
+            words_split[location] = 'can'
+            words_split.insert(location + 1, 'not')
+        counter = 0
+
+        filteredwords = []
+        prevw_in_split = True
+        for w in words:
+            # NLTK sometimes splits things wrongly, so the tokens are checked against a plain split of the string.
+            if words_split[counter] == w: # word was correctly split
+                if w not in self._stopwordset:
+                    filteredwords.append(w)
+                counter += 1
+                prevw_in_split = True
+            elif prevw_in_split: # previous word was fine, but this is the first part of a wrongly split word.
+                filteredwords.append(w)
+                prevw_in_split = False
+            else: # this is a subsequent part of a wrongly split word
+                newword = filteredwords[-1] + w
+                filteredwords[-1] = newword
+                if words_split[counter] == newword:
+                    counter += 1
+                    prevw_in_split = True
+                else:
+                    prevw_in_split = False
+        cleanstring = ' '.join(filteredwords)
+        cleanstring = self._fix_abbreviations(cleanstring)
+        return cleanstring
+
+    def _remove_stopwords_and_stem(self, s):
+        ''' Takes a string as input, splits it on whitespace, removes the stop words if self.remove_stopwords is True and stems the other words if self.stem is True, all in one go. Returns the result.
+            This does the work of _remove_stopwords() and _stem() when the tokenizer is 'regex'. '''
+        words = s.split()
+        if 'cannot' in words:
+            words = [part for w in words for part in _CANNOT.get(w, (w,))]
+        if self.remove_stopwords:
+            stopwords = self._stopwordset
+            words = [w for w in words if w not in stopwords]
+        if self.stem:
+            stem = self.stemmer.stem
+            words = [stem(w) for w in words]
+        news = ' '.join(words)
+        news = self._fix_abbreviations(news)
+        if self.remove_stopwords and self.stem:
+            news = self._fix_abbreviations(news) # _remove_stopwords() and _stem() each do this once, and it only fixes one abbreviation at a time.
+        return news
+
+    def _stem(self, s):
+        ''' Takes a string as input and applies the Porter stemmer as implemented in the NLTK (http://www.nltk.org/), via self.stemmer. Returns the result. '''
+        words = nltk.word_tokenize(s)
+
+        words_split = s.split()
+        if 'cannot' in words_split:
+            location = words_split.index('cannot')
+            words_split[location] = 'can'
+            words_split.insert(location + 1, 'not')
+        counter = 0
+
+        newwords = []
+        prevw_in_split = True
+        for w in words:
+            # NLTK sometimes splits things wrongly, so the tokens are checked against a plain split of the string.
+            if words_split[counter] == w: # word was correctly split
+                neww = self.stemmer.stem(w)
+                newwords.append(neww)
+                counter += 1
+                prevw_in_split = True
+            elif prevw_in_split: # previous word was fine, but this is the first part of a wrongly split word.
+                newwords.append(w)
+                prevw_in_split = False
+            else: # this is a subsequent part of a wrongly split word
+                newword = newwords[-1] + w
+                if words_split[counter] == newword:
+                    newwords[-1] = self.stemmer.stem(newword)
+                    counter += 1
+                    prevw_in_split = True
+                else:
+                    newwords[-1] = newword
+                    prevw_in_split = False
+
+        news = ' '.join(newwords)
+        news = self._fix_abbreviations(news)
+        return news
+
+    def _fix_abbreviations(self, s):
+        ''' Takes as input a string tokenized by nltk and joined again, and outputs a version in which the abbreviations have been fixed.
+            That means the final dot has been glued to the abbreviation once more.'''
+        found = _TOKENIZED_ABBREVIATION.search(s)
+        if found:
+            abbr = found.group(1)
+            newabbr = abbr.replace(' ', '')
+            s = re.sub(abbr, ' ' + newabbr, s)
+        return s
+
+    def _remove_tags(self, s):
+        ''' Takes a string as input and removes HTML tags, except for code tags, which are remove in general_cleaning.
+            Also removes mentions of possible duplicates and changes URLs that point to other StackExchange threads into 'stackexchange-url'. '''
+
+        s = _POSSIBLE_DUPLICATE.sub(" ", s)
+        s = _STACKEXCHANGE_LINK.sub(r"\1", s)
+        s = _LINK.sub(r"\1", s)
+
+        # Put some space between tags and urls or other things. So we don't accidentally remove more than we should a few lines further below this line.
+        s = s.replace("<", " <")
+        s = s.replace(">", "> ")
+
+        s = _STACKEXCHANGE_URL.sub("stackexchange-url", s)
+        s = _STACKOVERFLOW_URL.sub("stackexchange-url", s)
+
+        # Remove all tags except for code tags
+        return _strip_tags(s, keep_code=True)
+
+    def _expand_contractions(self, s):
+        ''' Takes a string as input, expands the contracted forms in it and returns the result. '''
+        if "'" not in s:
+            return s
+        if _CLOSE_APOSTROPHES.search(s):
+            # Replace the forms one by one, in the same order as always.
+            for pat in _CONTRACTIONS:
+                s = s.replace(pat, _CONTRACTIONS[pat])
+            return s
+        return _CONTRACTION.sub(lambda m: _CONTRACTIONS[m.group()], s)
+
+    def _general_cleaning(self, s, codes):
+        ''' Takes a string and the code blocks found by _deal_with_code() as input.
+            Depending on self.remove_punct, all punctuation is either removed, or a space is added before and after.
+            In both cases the punctuation in URLs and numbers is retained.
+
+            Also transforms "&amp;" into "and", and removes all other HTML entities.
+            Removes excessive white space, and puts the code blocks back. '''
+
+        # Find all URLs and replace them with GGGG to protect them from whitespace addition.
+        coms = _COM.findall(s)
+        wwws = _WWW.findall(s)
+        urls = _URL.findall(s)
+        urls += wwws + coms
+        newurls = []
+        for url in set(urls):
+            if ')' in url and '(' not in url:
+                url = _AFTER_BRACKET.sub('', url)
+            if '\\' in url: # Get rid of backslashes because else we get regex problems when trying to put the URLs back.
+                url = url.replace('\\', '/')
+            newurls.append(url)
+        s = self._protect_urls(s, newurls)
+
+        # Protect points, commas and colon in numbers
+        s = _NUMBER_PUNCT.sub(lambda m: _PUNCT_PLACEHOLDERS[m.group()], s)
+
+        s = s.replace('&amp;', ' and ')
+
+        if self.remove_punct:
+            # Remove all sorts of punctuation
+            l = _ABBREVIATION.finditer(s)
+            if l:
+                for m in l:
+                    newbit = m.group().replace(' ', '') # Get rid of white space in abbreviations
+                    newabbr = newbit.replace('.', 'PPPP') # change dots in abbreviations into 'PPPP'
+                    s = re.sub(m.group() + ' +', ' ' + newabbr + ' ', s) # protect abbreviations
+                    s = s.replace('.', '') # remove all points that are not in abbreviations
+                    s = s.replace(newabbr, newbit) # place dots back in abbreviations
+            else:
+                s = s.replace('.', ' ')
+            s = _SENTENCE_PUNCT.sub(' ', s)
+            s = _OPENING_SINGLE_QUOTE.sub(r'  \1', s)
+            s = _CLOSING_SINGLE_QUOTE.sub(r'\1 ', s)
+            s = _OPENING_DOUBLE_QUOTE.sub(r' \1', s)
+            s = _CLOSING_DOUBLE_QUOTE.sub(r'\1 ', s)
+            s = _BRACKETS.sub(' ', s)
+            s = _COLON.sub(r'\1 ', s)
+            s = s.replace(';', ' ')
+            s = s.replace(" - ", " ")
+            s = s.replace("- ", " ")
+            s = s.replace("`", "")
+            s = _LEFT_DOUBLE_QUOTE.sub('', s)
+            s = _RIGHT_DOUBLE_QUOTE.sub('', s)
+            s = s.replace('"', '')
+        else:
+            # Add space around all sorts of punctuation.
+            s = s.replace('.', ' . ')
+
+            # Remove space around abbreviations
+            for m in _ABBREVIATION.finditer(s):
+                newbit = m.group().replace(' ', '')
+                s = re.sub(m.group() + ' +', ' ' + newbit + ' ', s)
+
+            s = _SENTENCE_PUNCT.sub(r' \1 ', s)
+            s = _OPENING_SINGLE_QUOTE.sub(r" ' \1", s)
+            s = _CLOSING_SINGLE_QUOTE.sub(r"\1 ' ", s)
+            s = _OPENING_DOUBLE_QUOTE.sub(r' " \1', s)
+            s = _CLOSING_DOUBLE_QUOTE.sub(r'\1 " ', s)
+            s = _BRACKETS.sub(r' \1 ', s)
+            s = _COLON.sub(r'\1 : ', s)
+            s = s.replace(';', ' ; ')
+            s = s.replace("'s", " 's")
+
+        # Restore points, commas and colons in numbers
+        s = _PROTECTED_PUNCT.sub(lambda m: _PLACEHOLDER_PUNCT[m.group()], s)
+
+        # restore URLs
+        restored = _restore_placeholders(s, _URL_PLACEHOLDER, 'G', newurls)
+        if restored is None:
+            newurllist = itertools.izip(reversed(xrange(len(newurls))), reversed(newurls)) # reverse list to GGGG1 does not match GGG10. (Source: http://galvanist.com/post/53478841501/python-reverse-enumerate)
+            for i, u in newurllist:
+                s = s.replace('GGGG' + str(i), u)
+        else:
+            s = restored
+
+        # Get rid of things we don't want, like HTML entities.
+        s = _ENTITY.sub("", s)
+        s = _NUMERIC_ENTITY.sub("", s) # &#xA; == '\n'
+        # Remove excessive whitespace
+        s = _WHITESPACE.sub(" ", s)
+        s = _LEADING_WHITESPACE.sub("", s)
+        s = _TRAILING_WHITESPACE.sub("", s)
+
+        # restore codeblocks
+        templates = [c.encode('unicode-escape') for c in codes] # The code block is used as a replacement template, which turns its escaped characters back into the real ones.
+        restored = _restore_placeholders(s, _CODE_PLACEHOLDER, 'h', [_NO_GROUPS.match('').expand(t) if '\\' in t else t for t in templates])
+        if restored is None:
+            newlist = itertools.izip(reversed(xrange(len(templates))), reversed(templates)) # reverse list to hhhh1 does not match hhhh10 (Source: http://galvanist.com/post/53478841501/python-reverse-enumerate)
+            for i, t in newlist:
+                s = re.sub('hhhh' + str(i), t, s)
+        else:
+            s = restored
+        return s
+
+    def _protect_urls(self, s, urls):
+        ''' Takes a string and a list of URLs as input, replaces each URL in the string by GGGG followed by its position in the list, and returns the result.
+            The first time a URL occurs in the list is the one that counts. If there are more than a few URLs, this is done in one pass, which gives the same result as replacing the URLs one by one,
+            unless they can overlap or one of them could be found partly inside an earlier placeholder (because it starts with G or a digit, ends with G or contains GGGG). In that case, and for a few URLs, they are replaced one by one. '''
+        numbers = {}
+        for n, url in enumerate(urls):
+            numbers.setdefault(url, n)
+        if len(numbers) > _MAX_URLS_ONE_BY_ONE and '' not in numbers and not any(url[0].isdigit() or url[0] == 'G' or url[-1] == 'G' or 'GGGG' in url for url in numbers):
+            try:
+                pattern, prefixes = _trie_pattern(numbers)
+            except (RuntimeError, OverflowError): # Too deeply nested for the regular expression compiler.
+                pattern = None
+        else:
+            pattern = None
+        if pattern is not None:
+            overlaps = []
+            def protect(m):
+                url = m.group() # The longest URL that starts here.
+                # Replacing them one by one, a shorter URL that also starts here is replaced instead if it comes earlier in the list.
+                first = min([url] + prefixes.get(url, []), key=numbers.get)
+                following = pattern.search(s, m.start() + 1)
+                if following is not None and following.start() < m.end():
+                    overlaps.append(m.start())
+                return 'GGGG' + str(numbers[first]) + url[len(first):]
+            protected = pattern.sub(protect, s)
+            if not overlaps:
+                return protected
+        for n, url in enumerate(urls):
+            s = s.replace(url, 'GGGG' + str(n))
+        return s
+
+
+def _trie_pattern(strings):
+    ''' Takes a collection of strings as input and returns a compiled regular expression that finds the longest of them that starts at a given place, and a dictionary from each string to the other strings that it starts with.
+        The strings are stored in a tree of their characters first, so the expression only needs to follow the characters of the text, rather than try each string in turn. '''
+    tree = {}
+    for string in strings:
+        node = tree
+        for char in string:
+            node = node.setdefault(char, {})
+        node[''] = string
+    prefixes = {}
+    for string in strings:
+        node = tree
+        for char in string[:-1]:
+            node = node[char]
+            if '' in node:
+                prefixes.setdefault(string, []).append(node[''])
+    return re.compile(_tree_regex(tree)), prefixes
+
+def _tree_regex(node):
+    ''' Takes a tree made by _trie_pattern() as input and returns a regular expression for the strings in it, which prefers longer strings over shorter ones. '''
+    chars = []
+    while len(node) == 1 and '' not in node: # Characters without a choice are written out without recursing, so that long strings are no problem.
+        char, node = node.items()[0]
+        chars.append(re.escape(char))
+    alternatives = [re.escape(char) + _tree_regex(child) for char, child in node.iteritems() if char != '']
+    if not alternatives:
+        return ''.join(chars)
+    if len(alternatives) == 1 and '' not in node:
+        return ''.join(chars) + alternatives[0]
+    regex = '(?:' + '|'.join(alternatives) + ')'
+    if '' in node:
+        regex += '?'
+    return ''.join(chars) + regex
+
+
+def _strip_tags(s, keep_code=False):
+    ''' Takes a string as input and removes HTML tags from it in one pass.
+        With keep_code=False, it removes the tags and entities that an HTMLParser finds, like an MLStripper does. Markup for which that is not straightforward (comments, declarations, <script> and <style>, unusual attributes, a < or & at the very end) is left to an MLStripper.
+        With keep_code=True, it removes everything from a < to the next >, except for <code> and </code>, like perform_cleaning() does. Entities are left alone. If a tag contains another <, the tags are removed one by one, because removing one tag can then break up another. '''
+    unsure = []
+    if keep_code:
+        def strip(m):
+            if m.group(2) == u'code':
+                return m.group()
+            if '<' in m.group(2):
+                unsure.append(m.start())
+            return ''
+        stripped = _TAG.sub(strip, s)
+    else:
+        def strip(m):
+            if m.group(2) is not None: # A < or & that is just text.
+                return m.group(2)
+            if m.end() - m.start() == 1 or (m.group(1) is not None and m.group(1).lower() in _CDATA_ELEMENTS):
+                unsure.append(m.start())
+            return ''
+        stripped = _HTML_MARKUP.sub(strip, s)
+    if unsure:
+        return _strip_tags_one_by_one(s, keep_code)
+    return stripped
+
+def _strip_tags_one_by_one(s, keep_code=False):
+    ''' Takes a string as input and removes HTML tags from it like _strip_tags() does, the slow way: with an MLStripper, or by replacing the tags one by one. '''
+    if keep_code:
+        for tag in _TAG.findall(s): # list of tuples
+            if tag[1] != u'code':
+                s = s.replace(tag[0] + tag[1] + tag[2], '')
+        return s
+    stripper = MLStripper() # Source: http://stackoverflow.com/questions/753052/strip-html-from-strings-in-python
+    stripper.feed(s)
+    return stripper.get_data()
+
+def _restore_placeholders(s, placeholder, marker, values):
+    ''' Takes a string, a compiled placeholder pattern (four markers followed by a number), the marker character and the list of values the placeholders stand for as input.
+        Replaces all placeholders in the string by their values in one pass, with the same result as replacing marker * 4 + str(i) by values[i] for every i from high to low:
+        if the number of a placeholder is followed by more digits, the highest number that fits is used, and the rest of the digits stay.
+        Returns None if a value, once put back, could make a new placeholder together with the text around it, because replacing them one by one would replace that one as well. '''
+    if any(marker * 4 in value for value in values):
+        return None
+    size = len(values)
+    maxdigits = len(str(size - 1)) if size else 0
+    unsafe = []
+    def restore(m):
+        digits = m.group(1)
+        end = 1 if digits[0] == '0' else min(len(digits), maxdigits)
+        while end and int(digits[:end]) >= size:
+            end -= 1
+        if not end:
+            return m.group()
+        value = values[int(digits[:end])] + digits[end:]
+        before = s[m.start() - 1:m.start()]
+        if before == marker and (value + s[m.end():m.end() + 4]).lstrip(marker)[:1].isdigit():
+            unsafe.append(m.start())
+        if before.isdigit() and (value + s[m.end():m.end() + 1])[:1].isdigit(): # The digits before could be the number of a placeholder that is only put back later.
+            unsafe.append(m.start())
+        if s[m.end():m.end() + 1] == marker and (value == '' or value[-1] == marker):
+            unsafe.append(m.start())
+        return value
+    restored = placeholder.sub(restore, s)
+    if unsafe:
+        return None
+    return restored
+
+
+_worker_cleaner = None # The Cleaner of a process in the pool of clean_many().
+
+def _init_cleaning_worker(options, stopwords, stemmer, tokenizer):
+    global _worker_cleaner
+    _worker_cleaner = Cleaner(*options, stopwords=stopwords, stemmer=stemmer, tokenizer=tokenizer)
+
+def _clean_in_worker(s):
+    return _worker_cleaner.clean(s)
+
+def _clean_and_time_in_worker(item):
+    ''' Takes an (id, string) tuple as input, cleans the string and returns the id, the length of the string, the times of the stages and the cleaned string, for the CleaningTimer of the main process. '''
+    id, s = item
+    laps = [time.time()]
+    cleaned = _worker_cleaner._clean(s, laps)
+    return id, len(s), laps, cleaned
+
+def _clean_in_pool(texts, processes, chunksize, options, stopwords, stemmer, tokenizer, timer=None):
+    ''' Cleans the texts in a pool of processes that each have their own Cleaner, and yields the results in order.
+        Each process gets a copy of the stemmer, including the stems it has memorised so far.
+        If a timer is given, texts should be (id, text) tuples, and the processes send the times of the stages back to be added to the timer. '''
+    # Pool.imap() hands out all texts as fast as the processes can take them and keeps the results until they are asked for, so they would pile up when they are used more slowly than they are cleaned.
+    # Instead, chunks are handed out one at a time, and only while fewer than 4 chunks per process are being cleaned or waiting to be used.
+    texts = iter(texts)
+    worker = _clean_in_worker if timer is None else _clean_and_time_in_worker
+    pending = collections.deque()
+    pool = multiprocessing.Pool(processes, _init_cleaning_worker, (options, stopwords, stemmer, tokenizer))
+    try:
+        while True:
+            while len(pending) < 4 * processes:
+                chunk = list(itertools.islice(texts, chunksize))
+                if not chunk:
+                    break
+                pending.append(pool.map_async(worker, chunk, len(chunk)))
+            if not pending:
+                break
+            for result in pending.popleft().get():
+                if timer is None:
+                    yield result
+                else:
+                    id, length, laps, cleaned = result
+                    timer.add(id, length, laps)
+                    yield cleaned
+        pool.close()
+    finally:
+        pool.terminate() # Does nothing if the pool was closed, but stops the processes if we stopped early.
+        pool.join()
+
+
+def _init_ranking_worker(subforum, scorer, candidates, candidatedates, k):
+    global _worker_ranking
+    _worker_ranking = (subforum, scorer, candidates, candidatedates, k)
+
+def _rank_in_worker(item):
+    return _rank_query(_worker_ranking, item)
+
+def _rank_query(state, item):
+    ''' Takes the state of Subforum.rank_queries() (the subforum, scorer, candidates, their dates and k) and a (query id, query date) tuple as input, and returns the query id, and the ids and scores of the best candidates.
+        The date is None if all candidates should be ranked. '''
+    queryid, querydate = item
+    subforum, scorer, candidates, candidatedates, k = state
+    if querydate is None:
+        positions = xrange(len(candidates))
+    else:
+        positions = np.flatnonzero(candidatedates < querydate).tolist()
+    # Keep the k best candidates seen so far in a heap, lowest score (and latest position for equal scores) on top.
+    best = []
+    for position in positions:
+        candidateid = candidates[position]
+        if candidateid == queryid:
+            continue
+        entry = (scorer(subforum, queryid, candidateid), -position)
+        if len(best) < k:
+            heapq.heappush(best, entry)
+        elif best and entry > best[0]:
+            heapq.heapreplace(best, entry)
+    best.sort(reverse=True)
+    return queryid, [candidates[-position] for score, position in best], [score for score, position in best]
+
+def _rank_in_pool(items, processes, chunksize, state):
+    ''' Ranks the candidates for the queries in a pool of processes, and yields the results in order. The processes get the state (the subforum, scorer, candidates, their dates and k) when they are forked, without pickling it. '''
+    pool = multiprocessing.Pool(processes, _init_ranking_worker, state)
+    try:
+        for ranking in pool.imap(_rank_in_worker, items, chunksize):
+            yield ranking
+        pool.close()
+    finally:
+        pool.terminate() # Does nothing if the pool was closed, but stops the processes if we stopped early.
+        pool.join()
+
+
+class _CleanedTextCache(object):
+    ''' A file of cleaned texts that is only ever added to, with an index in memory of where each text is in it.
+        The first line is a header that identifies the subforum. It is followed by records, which consist of a line "optionshash field id length" and then length bytes of UTF-8 text.
+        New records are written at the end while holding a lock on the file, so several processes (and later runs) can use the same file at the same time.
+        A record that was never finished, because the process writing it was killed, is ignored, and overwritten by the next record. '''
+
+    def __init__(self, filename, header):
+        self.filename = filename
+        self._header = header
+        self._file = None
+        self._writable = False
+        self._pid = None # The process that opened the file. Forked processes share the file position and lock of their parent, so they open the file again.
+        self._index = {} # (optionshash, field, id) -> (offset, length)
+        self._end = 0 # The end of the last complete record that has been read.
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def refresh(self):
+        ''' Adds the records that other processes have written since the last time to the index. Returns False if the cache file can't be used. '''
+        if not self._ready():
+            return False
+        self._read_records()
+        return True
+
+    def get(self, key):
+        ''' Takes a key as input and returns the cleaned text stored under it, or None if there is none. '''
+        if not self._ready() or key not in self._index:
+            return None
+        offset, length = self._index[key]
+        self._file.seek(offset)
+        return self._file.read(length).decode('utf-8')
+
+    def add(self, key, s):
+        ''' Takes a key and a cleaned text as input and stores the text at the end of the file.
+            Failing to write it (for instance because the disk is full) is not an error: the text will simply be cleaned again next time. '''
+        if not self._ready() or not self._writable:
+            return
+        data = s.encode('utf-8')
+        line = (u'%s %s %s %d\n' % (key + (len(data),))).encode('utf-8') # Post ids come from json as unicode, and unicode + data would decode data as ASCII.
+        try:
+            self._lock()
+            try:
+                self._read_records() # Other processes may have added records since we last looked.
+                self._file.seek(self._end)
+                self._file.truncate() # Removes what is left of a record that was never finished, if there is one.
+                self._file.write(line + data)
+                self._file.flush()
+            finally:
+                self._unlock()
+        except (IOError, OSError):
+            self._writable = False
+            return
+        self._index[key] = (self._end + len(line), len(data))
+        self._end += len(line) + len(data)
+
+    def _ready(self):
+        ''' Opens the file if this process hasn't done so yet, and returns whether it can be used. '''
+        if self._pid != os.getpid():
+            if self._file is not None:
+                self._file.close()
+            self._open()
+        return self._file is not None
+
+    def _open(self):
+        ''' Opens the file, creating it if it doesn't exist, and reads the index. If its header doesn't match (because it is from an older version or a different zip file), the file is emptied first.
+            If the file can only be read, it is used without adding to it. If it can't be opened at all, self._file is None. '''
+        self._pid = os.getpid()
+        self._file = None
+        self._index = {}
+        self._end = 0
+        try:
+            f = os.fdopen(os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644), 'r+b')
+            self._writable = True
+        except (IOError, OSError):
+            try:
+                f = open(self.filename, 'rb')
+            except IOError:
+                return
+            self._writable = False
+        self._file = f
+        try:
+            self._lock()
+            try:
+                if f.readline() != self._header:
+                    if not self._writable:
+                        raise IOError('outdated cache file')
+                    f.seek(0)
+                    f.truncate()
+                    f.write(self._header)
+                    f.flush()
+            finally:
+                self._unlock()
+        except (IOError, OSError):
+            f.close()
+            self._file = None
+            return
+        self._end = len(self._header)
+        self._read_records()
+
+    def _read_records(self):
+        ''' Adds the records after self._end to the index. Only the line before each text is read, and the text itself is skipped, so the texts are never all in memory.
+            Stops at the end of the file, or at a record that is not complete (yet). '''
+        size = os.fstat(self._file.fileno()).st_size
+        self._file.seek(self._end)
+        while True:
+            line = self._file.readline()
+            fields = line[:-1].split(' ')
+            if not line.endswith('\n') or len(fields) != 4 or not fields[3].isdigit():
+                break
+            start = self._end + len(line)
+            length = int(fields[3])
+            if start + length > size:
+                break
+            self._index[tuple(fields[:3])] = (start, length)
+            self._end = start + length
+            self._file.seek(self._end)
+
+    def _lock(self):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+
+    def _unlock(self):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+class _JsonObjectReader():
+    ''' Reads a json object from a file object in chunks of chunksize characters, so that no more than a chunk plus the value that is being decoded is ever held in memory.
+        The values themselves are decoded by the (fast) json decoder. '''
+    def __init__(self, f, chunksize):
+        self.f = f
+        self.chunksize = chunksize
+        self.buf = u''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        ''' Takes no input, reads the next chunk into the buffer, dropping the part that has already been decoded, and returns False if the end of the file has been reached. '''
+        chunk = self.f.read(self.chunksize)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        ''' Takes no input, skips white space and returns the next character without consuming it, or an empty string at the end of the file. '''
+        while True:
+            self.pos = _JSON_WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        ''' Takes a string of allowed characters as input and consumes and returns the next non white space character, raising a ValueError if it is not one of them. '''
+        c = self.peek()
+        if c == '' or c not in chars:
+            raise ValueError('Expected one of ' + repr(chars) + ' in json file, found ' + repr(c))
+        self.pos += 1
+        return c
+
+    def decode(self):
+        ''' Takes no input and decodes and returns the next json value. '''
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self._fill(): # The value probably continues in the next chunk.
+                    continue
+                raise
+            if (end == len(self.buf) or self.buf[end] not in ' \t\n\r,:]}') and self._fill(): # A number at the end of the buffer may continue in the next chunk.
+                continue
+            self.pos = end
+            return value
+
+
+def _iter_json_items(f, chunksize=1048576):
+    ''' Takes a file object containing a json object as input and yields its (key, value) pairs in the order in which they appear in the file.
+        Unlike json.load() this gives us the order of the keys in the file, and the file is read in chunks instead of all at once. '''
+    reader = _JsonObjectReader(f, chunksize)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.decode()
+        reader.expect(':')
+        value = reader.decode()
+        yield key, value
+        if reader.expect(',}') == '}':
+            return
+
+
+class _ZipMemberReader():
+    ''' File object that decompresses one file in a zip file on the fly and returns its contents as unicode, without extracting it to disk.
+        Only the zip file is read, so several processes can read the same (read-only) zip file at the same time. '''
+    def __init__(self, zip_ref, membername):
+        self.zip_ref = zip_ref
+        if membername not in zip_ref.namelist():
+            # Fall back on the base name, in case the zip file has a different directory layout.
+            basename = membername.split('/')[-1]
+            matches = [n for n in zip_ref.namelist() if n.split('/')[-1] == basename]
+            if not matches:
+                zip_ref.close()
+                raise KeyError(basename + ' is not in the zip file.')
+            membername = matches[0]
+        self.member = zip_ref.open(membername, 'r')
+        self.reader = codecs.getreader('utf-8')(self.member)
+
+    def read(self, size=-1):
+        return self.reader.read(size)
+
+    def close(self):
+        self.member.close()
+        self.zip_ref.close()
+
+
+class CompactTable(object):
+    ''' Memory efficient, read-only replacement for the dictionaries of dictionaries in the json files of a subforum.
+        It is used just like the dictionary it replaces: table[id] returns a record that can be indexed with the same field names as before (e.g. table[postid]['score']),
+        and keys(), iteration, len() and the 'in' operator work as before, in the same order.
+        Instead of one dictionary per record, every field is stored in a column: numbers in NumPy arrays, long strings (titles, bodies) UTF-8 encoded in one big string with an array of offsets,
+        short strings (user ids, tags) in a vocabulary so that each of them is only stored once, and other values only for the records where they are not empty. '''
+
+    def __init__(self, items=()):
+        ''' Takes an iterable of (id, record dictionary) pairs as input, in the order in which they appear in the json file. '''
+        rows = {}
+        fields = []
+        values = {} # field -> list of values, in the order of the file
+        n = 0
+        for key, record in items:
+            rows[key] = n
+            for field, value in record.iteritems():
+                if field not in values:
+                    values[field] = [_MISSING] * n
+                    fields.append(field)
+                values[field].append(value)
+            n += 1
+            for field in fields:
+                if len(values[field]) < n:
+                    values[field].append(_MISSING)
+
+        # Inserting the ids into a dictionary in the order of the file gives the same dictionary json.load() would have given, so iterating over it gives us the order in which the ids used to be returned.
+        # That order matters: ties in get_ordered_list_of_posts() and thus the splits depend on it.
+        self._ids = list(rows)
+        order = [rows[key] for key in self._ids]
+        for row, key in enumerate(self._ids):
+            rows[key] = row
+        self._rows = rows
+        self._fields = fields
+        self._columns = {}
+        for field in fields:
+            column = values.pop(field)
+            self._columns[field] = _make_column([column[i] for i in order])
+
+    def state(self):
+        ''' Takes no input and returns the contents of the table as basic Python types, so it can be stored with marshal. '''
+        return {'ids': self._ids, 'fields': self._fields, 'columns': dict((field, column.state()) for field, column in self._columns.iteritems())}
+
+    @classmethod
+    def from_state(cls, state):
+        ''' Takes the output of state() as input and returns the table. '''
+        table = cls.__new__(cls)
+        table._ids = state['ids']
+        table._rows = dict(itertools.izip(table._ids, xrange(len(table._ids))))
+        table._fields = state['fields']
+        table._columns = dict((field, _column_from_state(s)) for field, s in state['columns'].iteritems())
+        return table
+
+    def __getitem__(self, key):
+        return CompactRecord(self, self._rows[key])
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, key, default=None):
+        if key in self._rows:
+            return CompactRecord(self, self._rows[key])
+        return default
+
+    def keys(self):
+        return list(self._ids)
+
+    def iterkeys(self):
+        return iter(self._ids)
+
+    def itervalues(self):
+        for row in xrange(len(self._ids)):
+            yield CompactRecord(self, row)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for row, key in enumerate(self._ids):
+            yield key, CompactRecord(self, row)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def has_key(self, key):
+        return key in self._rows
+
+    def intid(self, key):
+        ''' Takes an id as input and returns its integer id: its position in keys(). '''
+        return self._rows[key]
+
+    def strid(self, intid):
+        ''' Takes an integer id as input and returns the id. '''
+        return self._ids[intid]
+
+    def intids(self, keys):
+        ''' Takes a list of ids as input and returns a NumPy array with their integer ids. False and None (unknown users) become -1. '''
+        rows = self._rows
+        return np.fromiter((-1 if key is False or key is None else rows[key] for key in keys), dtype=np.int32, count=len(keys))
+
+    def strids(self, intids):
+        ''' Takes a list or array of integer ids as input and returns a list of the ids. -1 becomes False. '''
+        ids = self._ids
+        return [False if intid < 0 else ids[intid] for intid in intids]
+
+    def field_array(self, rows, field, missing):
+        ''' Takes an array of integer ids, the name of a field and a value for missing data as input and returns a NumPy array with the value of the field for each of the records.
+            Numbers are returned as they are, dates as seconds since 1970-01-01 and lists and dictionaries as their length. Records without the field or without a date get the missing value. '''
+        column = self._columns.get(field)
+        dtype = np.float64 if isinstance(missing, float) else np.int64
+        if column is None:
+            return np.full(len(rows), missing, dtype=dtype)
+        present = np.ones(len(rows), dtype=bool) if column.mask is None else column.mask[rows]
+        if isinstance(column, _IntColumn):
+            values = column.values[rows].astype(dtype)
+        elif isinstance(column, _DateColumn):
+            timestamps = column.values[rows]
+            present &= timestamps != _NO_DATE
+            values = (timestamps // 1000).astype(dtype)
+        elif isinstance(column, _ListColumn):
+            values = np.diff(column.offsets)[rows].astype(dtype)
+        elif isinstance(column, _CodedColumn) and all(type(v) in (int, long, float, type(None)) for v in column.vocab):
+            vocab = np.array([missing if v is None else v for v in column.vocab], dtype=dtype)
+            present &= np.array([v is not None for v in column.vocab], dtype=bool)[column.codes[rows]]
+            values = vocab[column.codes[rows]]
+        elif isinstance(column, (_SparseColumn, _ObjectColumn)):
+            values = np.empty(len(rows), dtype=dtype)
+            for i, row in enumerate(rows):
+                value = column.get(row) if present[i] else None
+                if isinstance(value, (list, dict)):
+                    values[i] = len(value)
+                elif type(value) in (int, long, float):
+                    values[i] = value
+                elif value is None:
+                    present[i] = False
+                else:
+                    raise ValueError(repr(field) + ' does not contain numbers, dates or lists.')
+        else:
+            raise ValueError(repr(field) + ' does not contain numbers, dates or lists.')
+        values[~present] = missing
+        return values
+
+    def inverted_index(self, field):
+        ''' Takes the name of a field as input and returns an _InvertedIndex from each value of that field (or each element, if the values are lists) to the integer ids of the records that have it. '''
+        column = self._columns.get(field)
+        if isinstance(column, _ListColumn):
+            vocab, codes = column.vocab, column.codes
+            rows = np.repeat(np.arange(len(self._ids), dtype=np.int32), np.diff(column.offsets))
+        elif isinstance(column, _CodedColumn):
+            vocab, codes = column.vocab, column.codes
+            rows = np.arange(len(self._ids), dtype=np.int32)
+            if column.mask is not None:
+                rows = rows[column.mask]
+                codes = codes[column.mask]
+        else:
+            values = [column.get(row) if column is not None and column.has(row) else _MISSING for row in xrange(len(self._ids))]
+            values = [(row, x) for row, v in enumerate(values) if v is not _MISSING for x in (v if isinstance(v, (list, dict)) else [v])]
+            vocab, codes = _encode_values([x for row, x in values])
+            rows = np.array([row for row, x in values], dtype=np.int32)
+        # A stable sort keeps the records of each value in the order of their integer ids.
+        order = np.argsort(codes, kind='mergesort')
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=len(vocab)), out=offsets[1:])
+        return _InvertedIndex(dict((v, i) for i, v in enumerate(vocab)), offsets, rows[order])
+
+    def timestamp(self, key, field):
+        ''' Takes an id and the name of a date field as input and returns the date as the number of milliseconds since 1970-01-01, or _NO_DATE if it is 0. '''
+        row = self._rows[key]
+        column = self._columns.get(field)
+        if isinstance(column, _DateColumn) and column.has(row):
+            return int(column.values[row])
+        return _parse_date(self[key][field])
+
+    def timestamps(self, rows, field):
+        ''' Takes an array of integer ids and the name of a date field as input and returns a NumPy array with the dates as the number of milliseconds since 1970-01-01.
+            Records that have no date (a date of 0, or no such field) get _NO_DATE. '''
+        column = self._columns.get(field)
+        if isinstance(column, _DateColumn):
+            timestamps = column.values[rows]
+        else:
+            timestamps = np.fromiter((_parse_date(column.get(row)) if column is not None and column.has(row) else _NO_DATE for row in rows), dtype=np.int64, count=len(rows))
+        if column is not None and column.mask is not None:
+            timestamps[~column.mask[rows]] = _NO_DATE
+        return timestamps
+
+    def _lookup(self, values, target):
+        # Returns a NumPy array with the integer id in the target table of each of the values, or -1 if it is not in there.
+        return np.fromiter((target._rows.get(v, -1) if isinstance(v, basestring) else -1 for v in values), dtype=np.int32, count=len(values))
+
+    def linked_intids(self, rows, field, target):
+        ''' Takes an array of integer ids, the name of a field containing ids of the table target, and target as input, and returns a NumPy array with the integer id in target for each input id (-1 if there is none). '''
+        column = self._columns.get(field)
+        if column is None:
+            return np.full(len(rows), -1, dtype=np.int32)
+        if isinstance(column, _CodedColumn):
+            linked = self._lookup(column.vocab, target)[column.codes[rows]]
+        else:
+            linked = self._lookup([column.get(row) if column.has(row) else None for row in rows], target)
+        if column.mask is not None:
+            linked[~column.mask[rows]] = -1
+        return linked
+
+    def linked_intid_lists(self, rows, field, target):
+        ''' Takes an array of integer ids, the name of a field containing lists of ids of the table target, and target as input.
+            Returns two arrays, offsets and linked, such that linked[offsets[i]:offsets[i+1]] are the integer ids in target in the field of the i-th input id. Ids that are not in target are left out. '''
+        column = self._columns.get(field)
+        if isinstance(column, _ListColumn):
+            starts = column.offsets[rows]
+            lengths = column.offsets[rows + 1] - starts
+            if column.mask is not None:
+                lengths[~column.mask[rows]] = 0
+            # Positions in column.codes of the elements of all requested rows, one row after the other.
+            firsts = np.cumsum(lengths) - lengths
+            positions = np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - firsts, lengths)
+            linked = self._lookup(column.vocab, target)[column.codes[positions]]
+            rownrs = np.repeat(np.arange(len(rows)), lengths)
+        else:
+            # Other columns, like the dictionaries of duplicates, are stored as Python objects.
+            values = [column.get(row) if column is not None and column.has(row) else [] for row in rows]
+            rownrs = np.repeat(np.arange(len(rows)), [len(v) for v in values])
+            linked = self._lookup([v for value in values for v in value], target)
+        found = linked >= 0
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(rownrs[found], minlength=len(rows)))
+        return offsets, linked[found]
+
+
+class CompactRecord(object):
+    ''' One record of a CompactTable. It behaves like the (read-only) dictionary it replaces. '''
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    def __getitem__(self, field):
+        column = self._table._columns.get(field)
+        if column is None or not column.has(self._row):
+            raise KeyError(field)
+        return column.get(self._row)
+
+    def __contains__(self, field):
+        column = self._table._columns.get(field)
+        return column is not None and column.has(self._row)
+
+    def get(self, field, default=None):
+        if field in self:
+            return self[field]
+        return default
+
+    def keys(self):
+        return [field for field in self._table._fields if field in self]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(field, self[field]) for field in self.keys()]
+
+    def todict(self):
+        ''' Takes no input and returns the record as a normal dictionary. '''
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.todict())
+
+
+_MISSING = object() # Marks absent fields while a CompactTable is built.
+_SCALAR_TYPES = (unicode, str, bool, int, long, float, type(None))
+
+def _make_column(values):
+    ''' Takes a list of the values of one field (with _MISSING for records that don't have the field) as input and returns the most compact column to store them in. '''
+    n = len(values)
+    present = [v for v in values if v is not _MISSING]
+    mask = None
+    if len(present) < n:
+        mask = np.array([v is not _MISSING for v in values], dtype=bool)
+    types = set(type(v) for v in present)
+
+    if present and types <= set([int, long]):
+        array = np.array([0 if v is _MISSING else v for v in values], dtype=np.int64)
+        if array.min() >= -2**31 and array.max() < 2**31:
+            array = array.astype(np.int32)
+        return _IntColumn(array, mask)
+
+    if unicode in types and types <= set([unicode, int]):
+        timestamps = _parse_dates(values)
+        if timestamps is not None:
+            return _DateColumn(timestamps, mask)
+
+    if present and types == set([unicode]) and sum(len(v) for v in present) >= 16 * len(present):
+        encoded = [u'' if v is _MISSING else v for v in values]
+        encoded = [v.encode('utf-8') for v in encoded]
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum([len(v) for v in encoded], out=offsets[1:])
+        return _TextColumn(''.join(encoded), offsets, mask)
+
+    if types <= set(_SCALAR_TYPES):
+        vocab, codes = _encode_values(values)
+        return _CodedColumn(vocab, codes, mask)
+
+    if types == set([list]) and all(type(x) in _SCALAR_TYPES for v in present for x in v):
+        lengths = [0 if v is _MISSING else len(v) for v in values]
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        vocab, codes = _encode_values([x for v in values if v is not _MISSING for x in v])
+        return _ListColumn(vocab, codes, offsets, mask)
+
+    # Anything else (like the dictionaries of duplicates) is stored as it is. If most of the values are empty, only the others are stored.
+    empties = [v for v in present if type(v) in (list, dict) and not v]
+    if len(empties) > len(present) / 2 and len(set(type(v) for v in empties)) == 1:
+        empty = type(empties[0]).__name__
+        sparse = dict((row, v) for row, v in enumerate(values) if v is not _MISSING and not (type(v).__name__ == empty and not v))
+        return _SparseColumn(sparse, empty, mask)
+    if len(present) < n / 2:
+        return _SparseColumn(dict((row, v) for row, v in enumerate(values) if v is not _MISSING), None, None)
+    return _ObjectColumn([None if v is _MISSING else v for v in values], mask)
+
+def _parse_dates(values):
+    ''' Takes a list of the values of one field as input and, if they are all dates in %Y-%m-%dT%H:%M:%S.%f format with three decimals (or 0, or _MISSING),
+        returns a NumPy array with the number of milliseconds since 1970-01-01 of each of them (_NO_DATE for 0 and _MISSING). Else it returns None. '''
+    strings = []
+    for v in values:
+        if type(v) is unicode and len(v) == 23 and v[10] == u'T':
+            strings.append(v)
+        elif v is _MISSING or (type(v) is int and v == 0):
+            strings.append(u'NaT')
+        else:
+            return None
+    try:
+        parsed = np.array(strings).astype('datetime64[ms]')
+    except ValueError:
+        return None
+    # NumPy accepts more formats than strptime does, so only use the result if it gives back exactly the same strings.
+    if not (np.datetime_as_string(parsed, unit='ms').astype(unicode) == np.array(strings)).all():
+        return None
+    return parsed.view(np.int64)
+
+def _encode_values(values):
+    ''' Takes a list of hashable values as input and returns a list of the distinct values (the vocabulary) and a NumPy array with the position of each value in the vocabulary. '''
+    index = {}
+    vocab = []
+    codes = np.empty(len(values), dtype=np.int32)
+    for i, v in enumerate(values):
+        # Use (type, value) as key so that 1, 1.0 and True are not mixed up.
+        key = (type(v), v)
+        code = index.get(key)
+        if code is None:
+            code = index[key] = len(vocab)
+            vocab.append(None if v is _MISSING else v)
+        codes[i] = code
+    return vocab, codes
+
+def _mask_state(mask):
+    if mask is None:
+        return None
+    return mask.tostring()
+
+def _mask_from_state(state):
+    if state is None:
+        return None
+    return np.frombuffer(state, dtype=bool)
+
+def _column_from_state(state):
+    ''' Takes the output of the state() method of a column as input and returns the column. '''
+    kind = state[0]
+    if kind == 'int':
+        return _IntColumn(np.frombuffer(state[2], dtype=state[1]), _mask_from_state(state[3]))
+    if kind == 'date':
+        return _DateColumn(np.frombuffer(state[1], dtype=np.int64), _mask_from_state(state[2]))
+    if kind == 'text':
+        return _TextColumn(state[1], np.frombuffer(state[2], dtype=np.int64), _mask_from_state(state[3]))
+    if kind == 'coded':
+        return _CodedColumn(state[1], np.frombuffer(state[2], dtype=np.int32), _mask_from_state(state[3]))
+    if kind == 'list':
+        return _ListColumn(state[1], np.frombuffer(state[2], dtype=np.int32), np.frombuffer(state[3], dtype=np.int64), _mask_from_state(state[4]))
+    if kind == 'sparse':
+        return _SparseColumn(state[1], state[2], _mask_from_state(state[3]))
+    return _ObjectColumn(state[1], _mask_from_state(state[2]))
+
+
+class _Column(object):
+    ''' Base class of the columns of a CompactTable. Subclasses implement get(row) and state(). '''
+    def __init__(self, mask):
+        self.mask = mask # None if all records have this field.
+
+    def has(self, row):
+        return self.mask is None or bool(self.mask[row])
+
+class _IntColumn(_Column):
+    def __init__(self, values, mask):
+        _Column.__init__(self, mask)
+        self.values = values
+
+    def get(self, row):
+        return int(self.values[row])
+
+    def state(self):
+        return ('int', self.values.dtype.str, self.values.tostring(), _mask_state(self.mask))
+
+class _DateColumn(_Column):
+    ''' Stores dates as milliseconds since 1970-01-01, and gives them back in the %Y-%m-%dT%H:%M:%S.%f format they were in. '''
+    def __init__(self, values, mask):
+        _Column.__init__(self, mask)
+        self.values = values
+
+    def get(self, row):
+        timestamp = self.values[row]
+        if timestamp == _NO_DATE:
+            return 0
+        d = _to_datetime(timestamp)
+        return u'%04d-%02d-%02dT%02d:%02d:%02d.%03d' % (d.year, d.month, d.day, d.hour, d.minute, d.second, d.microsecond // 1000)
+
+    def state(self):
+        return ('date', self.values.tostring(), _mask_state(self.mask))
+
+class _TextColumn(_Column):
+    def __init__(self, blob, offsets, mask):
+        _Column.__init__(self, mask)
+        self.blob = blob
+        self.offsets = offsets
+
+    def get(self, row):
+        return self.blob[self.offsets[row]:self.offsets[row + 1]].decode('utf-8')
+
+    def state(self):
+        return ('text', self.blob, self.offsets.tostring(), _mask_state(self.mask))
+
+class _CodedColumn(_Column):
+    def __init__(self, vocab, codes, mask):
+        _Column.__init__(self, mask)
+        self.vocab = vocab
+        self.codes = codes
+
+    def get(self, row):
+        return self.vocab[self.codes[row]]
+
+    def state(self):
+        return ('coded', self.vocab, self.codes.tostring(), _mask_state(self.mask))
+
+class _ListColumn(_Column):
+    def __init__(self, vocab, codes, offsets, mask):
+        _Column.__init__(self, mask)
+        self.vocab = vocab
+        self.codes = codes
+        self.offsets = offsets
+
+    def get(self, row):
+        vocab = self.vocab
+        return [vocab[code] for code in self.codes[self.offsets[row]:self.offsets[row + 1]]]
+
+    def state(self):
+        return ('list', self.vocab, self.codes.tostring(), self.offsets.tostring(), _mask_state(self.mask))
+
+class _SparseColumn(_Column):
+    def __init__(self, values, empty, mask):
+        _Column.__init__(self, mask)
+        self.values = values # row -> value, for the rows that have a value that is not empty
+        self.empty = empty # 'list' or 'dict' if the other rows have an empty list or dictionary, None if they don't have this field
+
+    def has(self, row):
+        if self.mask is not None:
+            return bool(self.mask[row])
+        return self.empty is not None or row in self.values
+
+    def get(self, row):
+        if row in self.values:
+            return self.values[row]
+        if self.empty == 'dict':
+            return {}
+        return []
+
+    def state(self):
+        return ('sparse', self.values, self.empty, _mask_state(self.mask))
+
+class _ObjectColumn(_Column):
+    def __init__(self, values, mask):
+        _Column.__init__(self, mask)
+        self.values = values
+
+    def get(self, row):
+        return self.values[row]
+
+    def state(self):
+        return ('object', self.values, _mask_state(self.mask))
+
+
+class _InvertedIndex(object):
+    ''' Maps values to the integer ids of the records that have them: the records of the i-th value are rows[offsets[i]:offsets[i+1]]. '''
+    def __init__(self, positions, offsets, rows):
+        self.positions = positions
+        self.offsets = offsets
+        self.rows = rows
+
+    def get(self, value):
+        ''' Takes a value as input and returns an array with the integer ids of the records that have it, in increasing order. '''
+        i = self.positions.get(value)
+        if i is None:
+            return self.rows[:0]
+        return self.rows[self.offsets[i]:self.offsets[i + 1]]
+
+
+class _DuplicateGraph(object):
+    ''' The duplicate and related links between the posts of a subforum, in both directions, on integer post ids.
+        The links of each label are stored as a sparse adjacency matrix in compressed (CSR) format. '''
+    def __init__(self, size, dups, related):
+        ''' Takes the number of posts and the duplicate and related links, as returned by CompactTable.linked_intid_lists(), as input. '''
+        self.size = size
+        self._stored = {} # row * size + other -> 1 if other is in the dups of row, 2 if it is in its related posts, 3 if both.
+        self._matrices = {}
+        for flag, label, (offsets, targets) in ((1, 'dup', dups), (2, 'related', related)):
+            sources = np.repeat(np.arange(size, dtype=np.int64), np.diff(offsets))
+            for key in (sources * size + targets).tolist():
+                self._stored[key] = self._stored.get(key, 0) | flag
+            matrix = csr_matrix((np.ones(len(targets), dtype=np.int32), (sources, targets)), shape=(size, size))
+            self._matrices[label] = matrix + matrix.T
+        self._matrices['both'] = self._matrices['dup'] + self._matrices['related']
+        self._adjacency = {}
+        self._clusters = {}
+        self._cluster_index = {}
+
+    def _check(self, label):
+        if label not in self._matrices:
+            raise ValueError(repr(label) + " is not a valid label. Please choose 'dup', 'related' or 'both'.")
+
+    def label(self, row1, row2):
+        ''' Takes two integer post ids as input and returns 'dup', 'related' or 'nodup'.
+            Like the original lookups in the posts, links stored in the second post come first, and duplicate links come before related ones. '''
+        for key in (row2 * self.size + row1, row1 * self.size + row2):
+            flags = self._stored.get(key, 0)
+            if flags & 1:
+                return 'dup'
+            if flags & 2:
+                return 'related'
+        return 'nodup'
+
+    def adjacency(self, label):
+        ''' Takes a label as input and returns two arrays, offsets and neighbours, such that neighbours[offsets[i]:offsets[i+1]] are the sorted integer ids of the posts linked to post i. '''
+        self._check(label)
+        if label not in self._adjacency:
+            matrix = self._matrices[label].tocsr()
+            matrix.sort_indices()
+            self._adjacency[label] = (matrix.indptr.astype(np.int64), matrix.indices.astype(np.int32))
+        return self._adjacency[label]
+
+    def neighbours(self, row, label):
+        offsets, neighbours = self.adjacency(label)
+        return neighbours[offsets[row]:offsets[row + 1]]
+
+    def clusters(self, label):
+        ''' Takes a label as input and returns an array with the cluster id of each post: the number of the connected component of the graph it is in. '''
+        self._check(label)
+        if label not in self._clusters:
+            self._clusters[label] = connected_components(self._matrices[label], directed=False)[1].astype(np.int32)
+        return self._clusters[label]
+
+    def cluster_index(self, label):
+        ''' Takes a label as input and returns two arrays, offsets and posts, such that posts[offsets[c]:offsets[c+1]] are the integer ids of the posts in cluster c. '''
+        if label not in self._cluster_index:
+            clusters = self.clusters(label)
+            offsets = np.zeros(clusters.max() + 2 if len(clusters) else 1, dtype=np.int64)
+            np.cumsum(np.bincount(clusters), out=offsets[1:])
+            self._cluster_index[label] = (offsets, np.argsort(clusters, kind='mergesort').astype(np.int32))
+        return self._cluster_index[label]
+
+    def members(self, label, cluster):
+        offsets, posts = self.cluster_index(label)
+        return posts[offsets[cluster]:offsets[cluster + 1]]
+
+
 class MLStripper(HTMLParser):
     def __init__(self):
         self.reset()
@@ -1591,6 +4158,7 @@ def usage():
 
     The script contains a main function called load_subforum(). It has one argument: a StackExchange subforum.zip file.
     load_subforum() uses this file to create a 'Subforum' object and returns this.
+    Optional keyword arguments are passed on to the 'Subforum' class. See the documentation of the class below.
     Alternatively, you can make a subforum object directly by calling the class 'Subforum' yourself. Just like load_subforum() it needs a zipped subforum file as its only argument.
 
     Subforum objects can be queried using the following methods:
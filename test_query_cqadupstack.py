@@ -0,0 +1,580 @@
+# -*- coding: utf-8 -*-
+''' Tests for query_cqadupstack.py. Run them with: python -m unittest test_query_cqadupstack '''
+
+import os, sys, json, zlib, shutil, zipfile, calendar, datetime, tempfile, unittest, subprocess
+import nltk
+from xml.etree import ElementTree
+import numpy as np
+import query_cqadupstack as qcqa
+
+try:
+    nltk.data.find('tokenizers/punkt')
+    HAVE_PUNKT = True # The 'nltk' tokenizer needs the punkt models.
+except LookupError:
+    HAVE_PUNKT = False
+HAVE_STEMMER = hasattr(nltk.PorterStemmer, 'stem_word') # Stemmer uses the stem_word() method of older NLTK versions.
+
+
+def _question(title, body, date, dups=(), tags=(), **fields):
+    question = {'title': title, 'body': body, 'creationdate': date, 'viewcount': 10, 'favoritecount': 0, 'score': 1, 'userid': u'1',
+                'dups': dict((d, {'votedates': [date], 'voters': [u'2']}) for d in dups), 'related': [], 'tags': list(tags), 'answers': [], 'comments': []}
+    question.update(fields)
+    return question
+
+def subforum_tables():
+    ''' Returns the contents of the json files of the test subforum, as a dictionary from the name of each file to its table. '''
+    questions = {u'1': _question(u'Apache redirects', u'<p>How do I redirect with apache?</p>', u'2012-01-01T10:00:00.000', tags=[u'apache'],
+                                 answers=[u'11', u'12'], comments=[u'21'], acceptedanswer=u'12', viewcount=250, favoritecount=3, score=7),
+                 u'2': _question(u'Redirect in apache', u'<p>Redirects with apache and caf\xe9 php</p>', u'2012-01-02T10:00:00.100', dups=[u'1'], tags=[u'apache', u'php']),
+                 u'3': _question(u'Mysql server', u'<p>My mysql server is slow</p>', u'2012-01-02T10:00:00.900', tags=[u'mysql'], score=-2),
+                 u'4': _question(u'Slow php', u'<p>Why is my php page slow with mysql?</p>', u'2012-01-03T10:00:00.000', tags=[u'php', u'mysql'], related=[u'3'], userid=False)}
+    answers = {u'11': {'parentid': u'1', 'body': u'<p>Use a rewrite rule.</p>', 'creationdate': u'2012-01-01T11:00:00.000', 'score': 2, 'userid': u'2', 'comments': [u'22'], 'acceptedanswerdate': 0},
+               u'12': {'parentid': u'1', 'body': u'<p>Or try the other thing.</p>', 'creationdate': u'2012-01-01T12:30:15.500', 'score': 0, 'userid': False, 'comments': [], 'acceptedanswerdate': u'2012-01-05T09:30:00.000'}}
+    comments = {u'21': {'parentid': u'1', 'parenttype': u'question', 'body': u'Which version?', 'creationdate': u'2012-01-01T10:05:00.000', 'score': 0, 'userid': u'2'},
+                u'22': {'parentid': u'11', 'parenttype': u'answer', 'body': u'Thanks, that works.', 'creationdate': u'2012-01-01T11:10:00.000', 'score': 1, 'userid': u'1'}}
+    users = {u'1': {'rep': 101, 'views': 5, 'upvotes': 3, 'downvotes': 1, 'date_joined': u'2011-01-01T00:00:00.000', 'lastaccessdate': u'2013-01-01T00:00:00.000', 'age': 30,
+                    'questions': [u'1', u'2', u'3'], 'answers': [], 'badges': [u'Teacher', u'Student']},
+             u'2': {'rep': 1, 'views': 0, 'upvotes': 0, 'downvotes': 0, 'date_joined': u'2011-06-01T08:00:00.000', 'lastaccessdate': u'2012-02-01T00:00:00.000',
+                    'questions': [], 'answers': [u'11'], 'badges': []}}
+    return {'questions': questions, 'answers': answers, 'comments': comments, 'users': users}
+
+def write_subforum_zip(directory, tables=None):
+    ''' Takes a directory and optionally the tables of subforum_tables() as input, writes them to a subforum zip file in that directory and returns the name of the zip file. '''
+    if tables is None:
+        tables = subforum_tables()
+    zipped = os.path.join(directory, 'test.zip')
+    z = zipfile.ZipFile(zipped, 'w')
+    for name, table in sorted(tables.items()):
+        z.writestr('test/test_' + name + '.json', json.dumps(table))
+    z.close()
+    return zipped
+
+def make_subforum(directory):
+    ''' Takes a directory as input, writes a small subforum zip file to it and returns it as a Subforum that keeps its snapshots and cache in that directory. '''
+    return qcqa.Subforum(write_subforum_zip(directory), cachedir=directory, extract=False)
+
+
+class SubforumTestCase(unittest.TestCase):
+    ''' Gives each test a new temporary directory, self.dir, which is removed afterwards, with the subforum of make_subforum() in it as self.o. '''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.o = make_subforum(self.dir)
+
+
+class LoadingTest(SubforumTestCase):
+
+    def test_zip_directory_is_left_alone_without_extracting(self):
+        zipdir = os.path.join(self.dir, 'dataset')
+        os.mkdir(zipdir)
+        zipped = write_subforum_zip(zipdir)
+        before = sorted(os.listdir(zipdir))
+        o = qcqa.Subforum(zipped, extract=False)
+        self.assertEqual(o.cachedir, None)
+        self.assertEqual(o.get_posttitle(u'3'), u'Mysql server')
+        o.get_user_reputation(u'1')
+        list(o.clean_many(o.get_all_postids(), processes=1))
+        self.assertEqual(sorted(os.listdir(zipdir)), before)
+
+    def test_snapshots_in_cachedir(self):
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'test_questions.snapshot')))
+
+
+def _day(date):
+    return str(date[:10]) # The date accessors return str, made with strftime().
+
+def _time(date):
+    return str(date[11:19])
+
+# What each accessor returned before the data was stored in CompactTables: a function of the record in the json file.
+BASELINE_ACCESSORS = {
+    'questions': [('get_posttitle', lambda q: q['title']), ('get_postbody', lambda q: q['body']), ('get_post_title_and_body', lambda q: q['title'] + ' ' + q['body']),
+                  ('get_postdate', lambda q: _day(q['creationdate'])), ('get_posttime', lambda q: _time(q['creationdate'])),
+                  ('get_postviewcount', lambda q: q['viewcount']), ('get_postfavoritecount', lambda q: q['favoritecount']), ('get_postscore', lambda q: q['score']),
+                  ('get_postuserid', lambda q: q['userid']), ('get_duplicates', lambda q: q['dups']), ('get_related', lambda q: q['related']), ('get_posttags', lambda q: q['tags']),
+                  ('get_first_duptagdate', lambda q: min([d for v in q['dups'].values() for d in v['votedates']]) if q['dups'] else None),
+                  ('get_answers', lambda q: q['answers']), ('get_answercount', lambda q: len(q['answers'])), ('get_acceptedanswer', lambda q: q.get('acceptedanswer', False)),
+                  ('get_post_comments', lambda q: q['comments']), ('get_post_commentcount', lambda q: len(q['comments']))],
+    'answers': [('get_answer_parentid', lambda a: a['parentid']), ('get_answerbody', lambda a: a['body']), ('get_answerdate', lambda a: _day(a['creationdate'])),
+                ('get_answertime', lambda a: _time(a['creationdate'])), ('get_answerscore', lambda a: a['score']), ('get_answeruserid', lambda a: a['userid']),
+                ('get_acceptedanswer_date', lambda a: 0 if a['acceptedanswerdate'] == 0 else _day(a['acceptedanswerdate'])),
+                ('get_answer_comments', lambda a: a['comments']), ('get_answer_commentcount', lambda a: len(a['comments']))],
+    'comments': [('get_comment_parentid', lambda c: c['parentid']), ('get_comment_parenttype', lambda c: c['parenttype']), ('get_commentbody', lambda c: c['body']),
+                 ('get_commentdate', lambda c: _day(c['creationdate'])), ('get_commenttime', lambda c: _time(c['creationdate'])),
+                 ('get_commentscore', lambda c: c['score']), ('get_commentuserid', lambda c: c['userid'])],
+    'users': [('get_user_reputation', lambda u: u['rep']), ('get_user_views', lambda u: u['views']), ('get_user_upvotes', lambda u: u['upvotes']),
+              ('get_user_downvotes', lambda u: u['downvotes']), ('get_user_joindate', lambda u: _day(u['date_joined'])), ('get_user_lastaccess', lambda u: _day(u['lastaccessdate'])),
+              ('get_user_age', lambda u: u.get('age', 'unknown')), ('get_user_posts', lambda u: u['questions']), ('get_user_answers', lambda u: u['answers']),
+              ('get_user_badges', lambda u: u['badges'])]}
+
+def _baseline_label(questions, postid1, postid2):
+    if postid1 in questions[postid2]['dups'] or postid2 in questions[postid1]['dups']:
+        return 'dup'
+    if postid1 in questions[postid2]['related'] or postid2 in questions[postid1]['related']:
+        return 'related'
+    return 'nodup'
+
+
+class _JsonOnlySubforum(qcqa.Subforum):
+    ''' A Subforum that fails if it has to read a json file, to check that it is loaded from the snapshots. '''
+
+    def _open_json_file(self, table):
+        raise AssertionError('The ' + table + ' were not read from the snapshot.')
+
+
+class AccessorTest(SubforumTestCase):
+    ''' The accessors should return the same as they did when the json files were loaded into dictionaries, however the subforum is loaded. '''
+
+    def check_baseline(self, o):
+        tables = subforum_tables()
+        for name, accessors in BASELINE_ACCESSORS.items():
+            for key, record in tables[name].items():
+                for method, baseline in accessors:
+                    value = getattr(o, method)(key)
+                    self.assertEqual((type(value), value), (type(baseline(record)), baseline(record)), method + '(' + key + ')')
+        questions = tables['questions']
+        self.assertEqual(sorted(o.get_all_postids()), sorted(questions))
+        self.assertEqual(sorted(o.get_all_users()), sorted(tables['users']))
+        for postid1 in questions:
+            for postid2 in questions:
+                self.assertEqual(o.get_true_label(postid1, postid2), _baseline_label(questions, postid1, postid2))
+        self.assertEqual(o.get_duptagdates(u'1', u'2'), [u'2012-01-02T10:00:00.100'])
+        self.assertEqual(o.get_dupvoters(u'2', u'1'), [u'2'])
+        # Posts from the same day stay in the order of get_all_postids(), as sorted() kept them in the order of the dictionary.
+        ordered = sorted([(i, datetime.datetime.strptime(_day(questions[i]['creationdate']), '%Y-%m-%d')) for i in o.get_all_postids()], key=lambda x: x[1], reverse=True)
+        self.assertEqual(o.get_ordered_list_of_posts(), ordered)
+        for postid in questions:
+            self.assertEqual(o.get_older_posts(postid), [i for i, d in ordered][[i for i, d in ordered].index(postid):])
+
+    def test_from_json(self):
+        zipdir = os.path.join(self.dir, 'extracted')
+        os.mkdir(zipdir)
+        self.check_baseline(qcqa.Subforum(write_subforum_zip(zipdir), use_snapshot=False))
+        self.assertTrue(os.path.exists(os.path.join(zipdir, 'test', 'test_questions.json')))
+
+    def test_from_snapshot(self):
+        zipped = os.path.join(self.dir, 'test.zip')
+        qcqa.Subforum(zipped, cachedir=self.dir, extract=False, preload=True)
+        self.check_baseline(_JsonOnlySubforum(zipped, cachedir=self.dir, extract=False))
+
+    def test_from_zip_without_extracting(self):
+        self.check_baseline(qcqa.Subforum(os.path.join(self.dir, 'test.zip'), extract=False))
+
+    def test_snapshot_is_replaced_when_the_zip_changes(self):
+        qcqa.Subforum(os.path.join(self.dir, 'test.zip'), cachedir=self.dir, extract=False, preload=True)
+        tables = subforum_tables()
+        tables['questions'][u'3']['title'] = u'Postgres server'
+        zipped = write_subforum_zip(self.dir, tables)
+        self.assertEqual(qcqa.Subforum(zipped, cachedir=self.dir, extract=False).get_posttitle(u'3'), u'Postgres server')
+        self.assertEqual(_JsonOnlySubforum(zipped, cachedir=self.dir, extract=False).get_posttitle(u'3'), u'Postgres server')
+
+    def test_field_array_missing_values(self):
+        self.assertEqual(self.o.get_field_array([u'1', u'2'], 'age', 'user').tolist(), [30, -1])
+        ages = self.o.get_field_array([u'1', u'2'], 'age', 'user', missing=np.nan)
+        self.assertEqual(ages[0], 30)
+        self.assertTrue(np.isnan(ages[1]))
+        self.assertEqual(self.o.get_field_array([u'1', u'2', u'4'], 'acceptedanswer').tolist(), [self.o.get_intid(u'12', 'answer'), -1, -1])
+        self.assertEqual(self.o.get_field_array([u'4', u'1'], 'userid', missing=-5).tolist(), [-5, self.o.get_intid(u'1', 'user')])
+        accepted = calendar.timegm(datetime.datetime(2012, 1, 5, 9, 30).timetuple())
+        self.assertEqual(self.o.get_field_array([u'11', u'12'], 'acceptedanswerdate', 'answer').tolist(), [-1, accepted])
+        self.assertEqual(self.o.get_field_array(self.o.get_intids([u'1', u'3']), 'answers').tolist(), [2, 0])
+        self.assertRaises(ValueError, self.o.get_field_array, [u'1'], 'title')
+
+
+class CleanedTextCacheTest(SubforumTestCase):
+
+    def setUp(self):
+        SubforumTestCase.setUp(self)
+        self.filename = os.path.join(self.dir, 'test_cleaned.cache')
+
+    def test_non_ascii_text(self):
+        cache = qcqa._CleanedTextCache(self.filename, 'header\n')
+        cache.add(('abc', 'body', u'13'), u'caf\xe9 ☃')
+        self.assertEqual(cache.get(('abc', 'body', u'13')), u'caf\xe9 ☃')
+        reopened = qcqa._CleanedTextCache(self.filename, 'header\n')
+        self.assertTrue(reopened.refresh())
+        self.assertEqual(reopened.get(('abc', 'body', u'13')), u'caf\xe9 ☃')
+
+    def test_unfinished_record_is_ignored(self):
+        cache = qcqa._CleanedTextCache(self.filename, 'header\n')
+        cache.add(('abc', 'title', u'1'), u'first text')
+        cache.add(('abc', 'title', u'2'), u'second text')
+        f = open(self.filename, 'ab')
+        f.write('abc title 3 100\nonly part of it')
+        f.close()
+        reopened = qcqa._CleanedTextCache(self.filename, 'header\n')
+        self.assertTrue(reopened.refresh())
+        self.assertEqual(sorted(k[2] for k in reopened._index), ['1', '2'])
+        self.assertEqual(reopened.get(('abc', 'title', u'2')), u'second text')
+        reopened.add(('abc', 'title', u'4'), u'fourth text')
+        self.assertEqual(open(self.filename, 'rb').read(), 'header\nabc title 1 10\nfirst textabc title 2 11\nsecond textabc title 4 11\nfourth text')
+
+
+class TokenizerTest(unittest.TestCase):
+    ''' The 'regex' tokenizer should give the same cleaned texts as the 'nltk' tokenizer (the texts below), except in the cases that Subforum.change_tokenizer() describes. '''
+
+    stopwords = ['a', 'the', 'to', 'is', 'in', 'i', 'it', 'do', 'of']
+
+    same = [(u"How do I redirect all pages to the new domain with apache", u"how redirect all pages new domain with apache", u"how redirect all page new domain with apach"),
+            (u"<p>I can't get the <b>mysql</b> server to start, it's giving an error</p>", u"can not get mysql server start , giving an error", u"can not get mysql server start , give an error"),
+            (u"What is the best way to set up e.g. a cron job on the server", u"what best way set up e.g. cron job on server", u"what best way set up e.g. cron job on server"),
+            (u"I cannot find the .htaccess file in the root folder", u"can not find . htaccess file root folder", u"can not find . htaccess file root folder"),
+            (u"Is it possible to use the U.S. version of the site (i.e. without a login)", u"possible use u.s. version site ( . e . without login )", u"possibl use u.s. version site ( . e . without login )"),
+            (u"The caf\xe9 page shows 1,000 visitors at 10:30 every day", u"caf\xe9 page shows 1,000 visitors at 10:30 every day", u"caf\xe9 page show 1,000 visitor at 10:30 everi day"),
+            (u"<code>x = 5; y(z)</code> does not work in php", u"x = 5; y(z) does not work php", u"x = 5; y(z) doe not work php")]
+
+    def cleaner(self, tokenizer, stem=False):
+        return qcqa.Cleaner(remove_stopwords=True, stem=stem, stopwords=self.stopwords, tokenizer=tokenizer)
+
+    def test_regex(self):
+        cleaner = self.cleaner('regex')
+        for s, cleaned, stemmed in self.same:
+            self.assertEqual(cleaner.clean(s), cleaned)
+
+    @unittest.skipUnless(HAVE_STEMMER, 'needs an NLTK version with PorterStemmer.stem_word()')
+    def test_regex_with_stemming(self):
+        cleaner = self.cleaner('regex', stem=True)
+        for s, cleaned, stemmed in self.same:
+            self.assertEqual(cleaner.clean(s), stemmed)
+
+    @unittest.skipUnless(HAVE_PUNKT, 'needs the NLTK punkt models')
+    def test_nltk(self):
+        cleaner = self.cleaner('nltk')
+        for s, cleaned, stemmed in self.same:
+            self.assertEqual(cleaner.clean(s), cleaned)
+
+    @unittest.skipUnless(HAVE_PUNKT and HAVE_STEMMER, 'needs the NLTK punkt models and PorterStemmer.stem_word()')
+    def test_nltk_with_stemming(self):
+        cleaner = self.cleaner('nltk', stem=True)
+        for s, cleaned, stemmed in self.same:
+            self.assertEqual(cleaner.clean(s), stemmed)
+
+    def test_regex_differences(self):
+        cleaner = self.cleaner('regex')
+        self.assertEqual(cleaner.clean(u'She said "hello" to the server'), u'she said " hello " server') # 'nltk': she said ``hello``totheserver
+        self.assertEqual(cleaner.clean(u'I cannot do it and I cannot fix it'), u'can not and can not fix') # 'nltk': can not and cannot fix
+
+
+class _StubPorterStemmer(object):
+    ''' Stands in for nltk.PorterStemmer, so Stemmer can be tested with any NLTK version. Cuts off the last letter and counts how often it was called. '''
+
+    def __init__(self):
+        self.calls = []
+
+    def stem_word(self, w):
+        self.calls.append(w)
+        return w[:-1]
+
+
+class StemmerTest(SubforumTestCase):
+
+    def setUp(self):
+        SubforumTestCase.setUp(self)
+        self.stemmer = qcqa.Stemmer(maxsize=3)
+        self.stemmer._stemmer = _StubPorterStemmer()
+
+    def test_memo(self):
+        self.assertEqual([self.stemmer.stem(w) for w in [u'cats', u'dogs', u'cats', u'cats']], [u'cat', u'dog', u'cat', u'cat'])
+        self.assertEqual((self.stemmer.hits, self.stemmer.misses), (2, 2))
+        self.assertEqual(self.stemmer._stemmer.calls, [u'cats', u'dogs'])
+        self.stemmer.reset_counts()
+        self.assertEqual((self.stemmer.hits, self.stemmer.misses), (0, 0))
+
+    def test_maxsize(self):
+        words = [u'ones', u'twos', u'threes', u'fours', u'fives']
+        self.assertEqual([self.stemmer.stem(w) for w in words + words], [w[:-1] for w in words + words])
+        self.assertEqual(len(self.stemmer), 3)
+        self.assertEqual((self.stemmer.hits, self.stemmer.misses), (3, 7)) # The words after the first three are stemmed again each time.
+
+    def test_warm(self):
+        filename = os.path.join(self.dir, 'words.txt')
+        f = open(filename, 'w')
+        f.write(u'caf\xe9s 120\ncats 100\n\ncats 90\ndogs\nbirds 5\n'.encode('utf-8'))
+        f.close()
+        self.assertEqual(self.stemmer.warm(filename), 3)
+        self.assertEqual(len(self.stemmer), 3)
+        self.assertEqual((self.stemmer.hits, self.stemmer.misses), (0, 0))
+        self.assertEqual(self.stemmer.stem(u'caf\xe9s'), u'caf\xe9')
+        self.assertEqual(self.stemmer.stem(u'birds'), u'bird')
+        self.assertEqual((self.stemmer.hits, self.stemmer.misses), (1, 1))
+        self.assertEqual(self.stemmer.warm(filename), 0)
+
+
+class CleaningTimerTest(SubforumTestCase):
+
+    def setUp(self):
+        SubforumTestCase.setUp(self)
+        self.timer = qcqa.CleaningTimer(slowest=2)
+        self.timer.add(u'1', 10, [10.0, ('a', 11.0), ('b', 11.5)])
+        self.timer.add(u'2', 20, [0.0, ('a', 2.0), ('b', 4.0)])
+        self.timer.add(u'3', 30, [5.0, ('a', 8.0)])
+        self.timer.add(None, 40, [0.0, ('a', 4.0), ('b', 4.5)])
+
+    def test_summary(self):
+        summary = self.timer.summary()
+        self.assertEqual(summary['texts'], 4)
+        self.assertEqual(list(summary['stages']), ['a', 'b', 'total'])
+        expected = {'a': {'calls': 4, 'seconds': 10.0, 'mean': 2.5, 'p50': 2.5, 'p90': 3.7, 'p99': 3.97, 'max': 4.0},
+                    'b': {'calls': 3, 'seconds': 3.0, 'mean': 1.0, 'p50': 0.5, 'p90': 1.7, 'p99': 1.97, 'max': 2.0},
+                    'total': {'calls': 4, 'seconds': 13.0, 'mean': 3.25, 'p50': 3.5, 'p90': 4.35, 'p99': 4.485, 'max': 4.5}}
+        for stage, values in expected.items():
+            self.assertEqual(sorted(summary['stages'][stage]), sorted(values))
+            for name, value in values.items():
+                self.assertAlmostEqual(summary['stages'][stage][name], value, msg=stage + ' ' + name)
+        self.assertEqual(summary['slowest'], [{'id': None, 'length': 40, 'seconds': 4.5, 'stages': {'a': 4.0, 'b': 0.5}},
+                                              {'id': u'2', 'length': 20, 'seconds': 4.0, 'stages': {'a': 2.0, 'b': 2.0}}])
+
+    def test_to_json(self):
+        self.assertEqual(json.loads(self.timer.to_json()), json.loads(json.dumps(self.timer.summary())))
+        filename = os.path.join(self.dir, 'timings.json')
+        self.timer.to_json(filename)
+        self.assertEqual(open(filename).read(), self.timer.to_json())
+
+    def test_reset(self):
+        self.timer.reset()
+        self.assertEqual(self.timer.summary(), {'texts': 0, 'stages': {}, 'slowest': []})
+
+
+class StripTagsTest(unittest.TestCase):
+    ''' The one-pass tag stripper should give the same results as the slow way (an HTMLParser, or a replace per tag). '''
+
+    strings = [u'<p>Use <code>a < b</code> and <b>bold</b> &amp; <i>italic</i> text</p>',
+               u'<a href="http://example.com/?a=1&b=2" title=\'x > y\'>link</a> after',
+               u'<!-- a comment --> text <script>var x = "<p>";</script> more <style>p {}</style>',
+               u'<!DOCTYPE html><p>caf&eacute; &#233; &#xe9; &unknown; & alone</p>',
+               u'broken <p tag and < text > here <',
+               u'<pre><code>&lt;div&gt;</code></pre> <<b>>nested<</b>> <br/><BR >',
+               u'no tags at all']
+
+    def test_strip_tags(self):
+        for s in self.strings:
+            self.assertEqual(qcqa._strip_tags(s), qcqa._strip_tags_one_by_one(s))
+
+    def test_remove_tags_keeping_code(self):
+        for s in self.strings:
+            self.assertEqual(qcqa._strip_tags(s, keep_code=True), qcqa._strip_tags_one_by_one(s, keep_code=True))
+
+
+class CleanManyTest(SubforumTestCase):
+
+    def test_repeated_ids_when_the_cache_cannot_be_written(self):
+        cache = self.o._cleaned_text_cache()
+        self.assertTrue(cache.refresh())
+        cache._writable = False
+        cleaned = list(self.o.clean_many([u'2', u'1', u'2', u'2'], processes=1))
+        self.assertEqual(cleaned[0], self.o.perform_cleaning(self.o.get_post_title_and_body(u'2')))
+        self.assertEqual(cleaned[2:], cleaned[:1] * 2)
+
+    def test_repeated_ids_are_read_from_the_cache(self):
+        first = list(self.o.clean_many([u'1', u'2'], processes=1))
+        self.assertEqual(list(self.o.clean_many([u'2', u'3', u'1', u'3', u'2'], processes=1)), [first[1], self.o.get_cleaned_text(u'3'), first[0], self.o.get_cleaned_text(u'3'), first[1]])
+
+    def test_same_texts_in_several_processes(self):
+        ids = self.o.get_all_postids() * 3
+        self.assertEqual(list(self.o.clean_many(ids, processes=2, chunksize=2)), list(self.o.clean_many(ids, processes=1)))
+
+    def test_cleaned_documents(self):
+        documents = list(self.o.iter_cleaned_documents(processes=2, chunksize=1))
+        self.assertEqual([d[0] for d in documents], self.o.get_all_postids())
+        self.assertEqual([d[1] for d in documents], list(self.o.clean_many(self.o.get_all_postids(), processes=1)))
+        self.assertEqual(documents[0][2]['tags'], self.o.get_posttags(documents[0][0]))
+
+
+class TermStatisticsTest(SubforumTestCase):
+
+    def setUp(self):
+        SubforumTestCase.setUp(self)
+        self.stats = qcqa.TermStatistics('title', 'options')
+        self.stats.add_documents([(u'1', u'x y y'), (u'2', u'y z'), (u'3', u'')], u'one', batchsize=2)
+
+    def check(self, stats, terms, df, cf, docids, doclengths, sources):
+        self.assertEqual(stats.terms, terms)
+        self.assertEqual(stats.vocabulary, dict((t, i) for i, t in enumerate(terms)))
+        self.assertEqual(stats.df.tolist(), df)
+        self.assertEqual(stats.cf.tolist(), cf)
+        self.assertEqual(stats.docids, docids)
+        self.assertEqual(stats.doclengths.tolist(), doclengths)
+        self.assertEqual(stats.sources, sources)
+
+    def test_add_documents(self):
+        self.check(self.stats, [u'x', u'y', u'z'], [1, 2, 1], [1, 3, 1], [u'1', u'2', u'3'], [3, 2, 0], [(u'one', 3)])
+        termids = []
+        self.stats.add_documents([(u'4', u'z w')], u'one', termids=termids)
+        self.assertEqual(termids, [2, 3])
+        self.check(self.stats, [u'x', u'y', u'z', u'w'], [1, 2, 2, 1], [1, 3, 2, 1], [u'1', u'2', u'3', u'4'], [3, 2, 0, 2], [(u'one', 4)])
+
+    def test_failing_documents(self):
+        def documents():
+            yield u'4', u'z w'
+            raise RuntimeError('cleaning failed')
+        self.assertRaises(RuntimeError, self.stats.add_documents, documents(), u'two', batchsize=1)
+        self.check(self.stats, [u'x', u'y', u'z', u'w'], [1, 2, 2, 1], [1, 3, 2, 1], [u'1', u'2', u'3', u'4'], [3, 2, 0, 2], [(u'one', 3), (u'two', 1)])
+
+    def test_merge(self):
+        other = qcqa.TermStatistics('title', 'options')
+        other.add_documents([(u'7', u'w z z')], u'two')
+        self.stats.merge(other)
+        self.check(self.stats, [u'x', u'y', u'z', u'w'], [1, 2, 2, 1], [1, 3, 3, 1], [u'1', u'2', u'3', u'7'], [3, 2, 0, 3], [(u'one', 3), (u'two', 1)])
+        self.assertRaises(ValueError, self.stats.merge, qcqa.TermStatistics('body', 'options'))
+        self.assertRaises(ValueError, self.stats.merge, qcqa.TermStatistics('title', 'other options'))
+
+    def test_save_and_load(self):
+        filename = os.path.join(self.dir, 'title.stats')
+        self.stats.save(filename)
+        loaded = qcqa.TermStatistics.load(filename)
+        self.assertEqual((loaded.field, loaded.options), ('title', 'options'))
+        self.check(loaded, [u'x', u'y', u'z'], [1, 2, 1], [1, 3, 1], [u'1', u'2', u'3'], [3, 2, 0], [(u'one', 3)])
+        loaded.add_documents([(u'4', u'x')], u'one')
+        self.assertEqual(loaded.df.tolist(), [2, 2, 1])
+        self.assertRaises(ValueError, qcqa.TermStatistics.load, os.path.join(self.dir, 'test.zip'))
+
+
+class ExportTest(SubforumTestCase):
+
+    def test_trec_markup_in_texts_is_escaped(self):
+        tables = subforum_tables()
+        tables['questions'][u'3']['body'] = u'<p>a</p><code>x</TEXT>y & <DOC>z</code>'
+        zipdir = os.path.join(self.dir, 'markup')
+        os.mkdir(zipdir)
+        o = qcqa.Subforum(write_subforum_zip(zipdir, tables), cachedir=zipdir, extract=False)
+        self.assertEqual(o.get_cleaned_text(u'3'), u'mysql server a <code> x y & z </code>')
+        shards = o.export_cleaned_corpus(self.dir, format='trec', processes=1)
+        documents = ElementTree.fromstring('<shard>' + open(shards[0]).read() + '</shard>').findall('DOC')
+        self.assertEqual([d.find('DOCNO').text for d in documents], o.get_all_postids())
+        self.assertEqual([d.find('TEXT').text.strip() for d in documents], list(o.clean_many(o.get_all_postids(), processes=1)))
+
+
+class BM25IndexTest(SubforumTestCase):
+
+    def test_search(self):
+        index = self.o.get_bm25_index([u'1', u'3', u'4'], processes=2, chunksize=1)
+        ids, scores = index.search(self.o.get_cleaned_text(u'2'))
+        self.assertEqual(ids[0], u'1')
+        self.assertEqual(list(scores), sorted(scores, reverse=True))
+        self.assertEqual(index.search(u'mysql', exclude=[u'3'])[0], [u'4'])
+
+    def test_statistics(self):
+        index = qcqa.BM25Index()
+        index.add_documents([(u'a', [u'x y', u'y y', u'']), (u'b', [u'z', u'', u'x x'])], batchsize=1)
+        index.finish()
+        stats = index.statistics
+        self.assertEqual(stats.docids, [u'a', u'b'])
+        self.assertEqual(list(stats.doclengths), [4, 3])
+        self.assertEqual(dict((term, stats.df[i]) for term, i in stats.vocabulary.items()), {u'x': 2, u'y': 1, u'z': 1})
+        self.assertEqual(list(index.df), list(np.diff(index.offsets)))
+        self.assertEqual(index.doclengths.tolist(), [[2, 1], [2, 0], [0, 2]])
+        docs, tfs = index.postings(stats.vocabulary[u'x'])
+        self.assertEqual(list(docs), [0, 1])
+        self.assertEqual(tfs.tolist(), [[1, 0], [0, 0], [0, 2]])
+
+    def test_document_numbers(self):
+        index = self.o.get_bm25_index([u'4', u'1', u'3'], processes=1)
+        self.assertEqual(index.docids, [u'4', u'1', u'3'])
+        docs, tfs = index.postings(index.vocabulary[u'mysql'])
+        self.assertEqual([index.docids[d] for d in docs], [u'4', u'3'])
+        self.assertEqual(self.o.get_strids(self.o.get_intids(index.docids)[docs]), [u'4', u'3'])
+
+    def test_saved_index(self):
+        index = self.o.get_bm25_index([u'1', u'3', u'4'], processes=1)
+        index.save(os.path.join(self.dir, 'test.bm25'))
+        mapped = qcqa.load_bm25_index(os.path.join(self.dir, 'test.bm25'))
+        for query in [u'mysql server', u'apache redirect', u'php slow mysql']:
+            self.assertEqual(mapped.search(query)[0], index.search(query)[0])
+            self.assertEqual(list(mapped.search(query)[1]), list(index.search(query)[1]))
+        for attribute in ['field', 'options', 'terms', 'docids', 'sources']:
+            self.assertEqual(getattr(mapped.statistics, attribute), getattr(index.statistics, attribute))
+        for attribute in ['df', 'cf', 'doclengths']:
+            self.assertEqual(list(getattr(mapped.statistics, attribute)), list(getattr(index.statistics, attribute)))
+        mapped.close()
+
+
+class TfidfMatrixTest(SubforumTestCase):
+
+    def test_matrix(self):
+        matrix, terms = self.o.get_tfidf_matrix(processes=1)
+        stats = self.o.get_term_statistics(self.o.get_all_postids(), processes=1)
+        self.assertEqual(terms, stats.terms)
+        self.assertEqual(matrix.shape, (len(self.o.get_all_postids()), len(terms)))
+        self.assertEqual(list(np.bincount(matrix.indices, minlength=len(terms))), list(stats.df))
+        norms = np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel()
+        self.assertTrue(np.allclose(norms[norms > 0], 1))
+
+    def test_rankings(self):
+        matrix, terms = self.o.get_tfidf_matrix(processes=1)
+        rankings = list(self.o.get_tfidf_rankings(matrix, [u'2'], [u'1', u'2', u'3', u'4']))
+        self.assertEqual(rankings[0][1][0], u'1')
+        self.assertNotIn(u'2', rankings[0][1])
+
+
+class MinHashTest(SubforumTestCase):
+
+    def test_shingle_hashes(self):
+        words = self.o.get_cleaned_text(u'3').split()
+        hashes = np.array(sorted(set(zlib.crc32(u' '.join(words[i:i + 3]).encode('utf-8')) & 0xffffffff for i in range(len(words) - 2))), dtype=np.uint64)
+        expected = qcqa._minhash_signatures(hashes, np.array([len(hashes)]), 16, 5)
+        self.assertEqual(self.o.get_minhash_signatures([u'3'], 16, seed=5, processes=1).tolist(), expected.tolist())
+
+    def test_same_signatures_with_another_hash_seed(self):
+        script = 'import query_cqadupstack as q; print q.Subforum(%r, cachedir=%r, extract=False).get_minhash_signatures(processes=1).tolist()' % (self.o._zipped_catfile, self.dir)
+        outputs = []
+        for hashseed in ['1', '2']:
+            env = dict(os.environ, PYTHONHASHSEED=hashseed)
+            outputs.append(subprocess.check_output([sys.executable, '-c', script], env=env, cwd=os.path.dirname(os.path.abspath(qcqa.__file__))).splitlines()[-1])
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], str(self.o.get_minhash_signatures(processes=1).tolist()))
+
+
+class CandidatePairsTest(unittest.TestCase):
+
+    def test_pair_blocks(self):
+        for size, maxpairs in [(5, 100), (50, 100), (51, 1)]:
+            pairs = [(i, j) for firsts, seconds in qcqa._pair_blocks(size, maxpairs) for i, j in zip(firsts, seconds)]
+            self.assertEqual(sorted(pairs), [(i, j) for i in range(size) for j in range(i + 1, size)])
+            self.assertTrue(all(len(firsts) <= max(maxpairs, 1) for firsts, seconds in qcqa._pair_blocks(size, maxpairs)))
+
+    def test_one_big_bucket(self):
+        generator = np.random.RandomState(0)
+        signatures = generator.randint(0, 4, (300, 8)).astype(np.uint32)
+        signatures[:200, :2] = 7 # One bucket with 200 documents in the first band.
+        first, second = qcqa._lsh_candidate_pairs(signatures, 0.5, bands=4, maxpairs=500)
+        expected = set()
+        for band in range(4):
+            for i in range(300):
+                for j in range(i + 1, 300):
+                    if (signatures[i, 2 * band:2 * band + 2] == signatures[j, 2 * band:2 * band + 2]).all() and (signatures[i] == signatures[j]).mean() >= 0.5:
+                        expected.add((i, j))
+        self.assertEqual(set(zip(first.tolist(), second.tolist())), expected)
+        self.assertEqual([first.tolist(), second.tolist()], [x.tolist() for x in qcqa._lsh_candidate_pairs(signatures, 0.5, bands=4)])
+
+
+class RankQueriesTest(SubforumTestCase):
+
+    def test_rankings(self):
+        rankings = list(self.o.rank_queries(lambda o, q, c: int(c), [u'1', u'3'], [u'1', u'2', u'3', u'4'], 2, processes=1))
+        self.assertEqual(rankings, [(u'1', [u'4', u'3'], [4, 3]), (u'3', [u'4', u'2'], [4, 2])])
+
+    def test_same_rankings_in_several_processes(self):
+        scorer = lambda o, q, c: len(set(o.get_posttags(q)) & set(o.get_posttags(c)))
+        queries = self.o.get_all_postids()
+        self.assertEqual(list(self.o.rank_queries(scorer, queries, queries, 2, processes=2)), list(self.o.rank_queries(scorer, queries, queries, 2, processes=1)))
+
+    def test_iterators_keep_their_own_scorer(self):
+        first = self.o.rank_queries(lambda o, q, c: int(c), [u'1'], [u'2', u'3'], 2, processes=1)
+        second = self.o.rank_queries(lambda o, q, c: -int(c), [u'1'], [u'2', u'3'], 2, processes=1)
+        self.assertEqual(list(first), [(u'1', [u'3', u'2'], [3, 2])])
+        self.assertEqual(list(second), [(u'1', [u'2', u'3'], [-2, -3])])
+
+    def test_older_within_the_same_second(self):
+        # Posts 2 and 3 were posted 800 milliseconds after each other.
+        rankings = list(self.o.rank_queries(lambda o, q, c: int(c), [u'2', u'3'], [u'1', u'2', u'3', u'4'], 4, processes=1, older=True))
+        self.assertEqual(rankings, [(u'2', [u'1'], [1]), (u'3', [u'2', u'1'], [2, 1])])
+
+    def test_scorefile(self):
+        scorefile = os.path.join(self.dir, 'scores.txt')
+        self.o.rank_queries(lambda o, q, c: int(c), [u'1', u'3'], [u'1', u'2', u'3', u'4'], 2, processes=1, scorefile=scorefile)
+        self.assertEqual(open(scorefile).read(), '1 4 3\n3 4 2\n')
+
+
+if __name__ == '__main__':
+    unittest.main()